@@ -0,0 +1,358 @@
+"""
+Asynchronous federated learning (FedAsync / FedBuff) on a virtual clock.
+
+example test command:
+    python FedAsync.py --mode fedasync \
+                       --dataset mnist \
+                       --skew quantity \
+                       --nclient 8 \
+                       --target_acc 0.9 \
+                       --baseline
+
+    Every client trains on its own partition from prepare_data and takes a
+    simulated amount of time to do so, set by its speed. Nothing waits for real
+    time: the event loop jumps its clock to the next client that finishes.
+
+parameters you HAVE TO set:
+
+        mode:
+            fedasync: the server mixes in every update as it arrives,
+                      weighted by alpha * (staleness + 1) ^ -staleness_a
+            fedbuff: the server buffers client deltas and applies their
+                     staleness-weighted mean every buffer_k updates
+        dataset, skew, nclient: same as FedBN_label_weighted.py
+        speed_sigma: spread of the log-normal client speeds, 0 makes every client equally fast
+        baseline: also run synchronous FedAvg rounds on the same clock, every
+                  round waits for the slowest client
+
+    Both paths get the same budget of iters * nclient client updates and
+    report their time-to-accuracy for target_acc in virtual seconds.
+
+details in args
+"""
+
+import asyncio
+import torch
+import time
+import os
+import copy
+import torch.nn as nn
+import torch.optim as optim
+import argparse
+import numpy as np
+from models.digit import DigitModel
+from models.resnet import *
+from skew import prepare_data
+from datafiles.prefetch import summary_line as prefetch_summary, stats as prefetch_stats
+from datafiles.utils import setseed
+from tr_utils import train
+from runlog import RunLog, SERVER
+from timeline import Timeline
+
+# for GPU server selection, a launcher (sweep.py) may choose another one
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '1')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--lr', type=float, default=1e-2, help='learning rate')
+parser.add_argument('--batch_size', type=int, default=32, help ='batch size')
+parser.add_argument('--iters', type=int, default=50, help='client updates per client, the same compute as iters synchronous rounds')
+parser.add_argument('--wk_iters', type=int, default=1, help='optimization iters in local worker between communication')
+parser.add_argument('--mode', type=str, default='fedasync', help='fedasync | fedbuff')
+parser.add_argument('--async_alpha', type=float, default=0.6, help='mixing weight of FedAsync')
+parser.add_argument('--staleness_a', type=float, default=0.5, help='exponent of the polynomial staleness function')
+parser.add_argument('--buffer_k', type=int, default=4, help='updates buffered by FedBuff before each server step')
+parser.add_argument('--glo_lr', type=float, default=1.0, help='server learning rate of FedBuff')
+parser.add_argument('--batch_time', type=float, default=0.05, help='virtual seconds per batch of a client with speed 1')
+parser.add_argument('--speed_sigma', type=float, default=0.5, help='sigma of the log-normal client speeds')
+parser.add_argument('--target_acc', type=float, default=0.9, help='test accuracy for time-to-accuracy')
+parser.add_argument('--baseline', action='store_true', help='also run synchronous fedavg on the same virtual clock')
+parser.add_argument('--log_path', type=str, default='./logs/', help='path to save the log')
+parser.add_argument('--model', type=str, default="DigitModel", help = 'model used:| DigitModel | resnet20 | resnet32 | resnet44 | resnet56 | resnet110 | resnet1202 |')
+parser.add_argument('--dataset', type=str, default="mnist", help = '| mnist | kmnist | svhn | cifar10 | synth_mnist | synth_cifar10 |')
+parser.add_argument('--synth_size', type=int, default=0, help='training samples of the synth_* datasets (--nlabel classes, drawn from --seed), 0 for the size of the real one')
+parser.add_argument('--augment', type=str, default='off', help='batch augmentation of the training data: | off | on (the dataset\'s defaults) | comma separated crop,flip,cutout |')
+parser.add_argument('--augment_pad', type=int, default=4, help='padding of the random crop')
+parser.add_argument('--cutout', type=int, default=8, help='side of the cutout square')
+parser.add_argument('--prefetch', type=int, default=0, help='training batches prepared ahead on a background thread (moved to the device, augmented), 0 for none')
+parser.add_argument('--skew', type=str, default='none', help='| none | quantity | feat_filter | feat_noise | label_across | label_within |')
+parser.add_argument('--noise_std', type=float, default=0.5, help='noise level for gaussion noise')
+parser.add_argument('--filter_sz', type=int, default=3, help='filter size for filter')
+parser.add_argument('--Di_alpha', type=float, default=0.5, help='alpha level for dirichlet distribution')
+parser.add_argument('--overlap', type=bool, default=True, help='If lskew_across allows label distribution to overlap')
+parser.add_argument('--nlabel', type=int, default=10, help='number of label for dirichlet label skew')
+parser.add_argument('--nclient', type=int, default=4, help='client number')
+parser.add_argument('--seed', type=int, default=400, help='random seed')
+parser.add_argument('--trace', action='store_true', help='write a Chrome trace (Perfetto) of the clients and the server on the virtual clock, one per run')
+args = parser.parse_args()
+
+print(f"args: {args}")
+
+assert(args.dataset in ['svhn', 'cifar10', 'mnist', 'kmnist', 'synth_mnist', 'synth_cifar10'])
+assert(args.skew in ['none', 'quantity', 'feat_filter', 'feat_noise', 'label_across', 'label_within'])
+assert(args.mode in ['fedasync', 'fedbuff'])
+
+setseed(args.seed)
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    '''
+        An event loop whose clock only moves when no task can run: it then
+        jumps to the earliest timer. asyncio.sleep(dt) costs dt simulated
+        seconds and no real time, local training costs no simulated time.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.virtual_time = 0.
+
+    def time(self):
+        return self.virtual_time
+
+    def _run_once(self):
+        if not self._ready and self._scheduled:
+            self.virtual_time = max(self.virtual_time, self._scheduled[0]._when)
+        super()._run_once()
+
+
+def test(model, test_loader, loss_fun, device):
+    model.eval()
+    test_loss = 0
+    correct = 0
+
+    with torch.no_grad():
+        for data, target in test_loader:
+            data = data.to(device).float()
+            target = target.to(device).long()
+
+            output = model(data)
+
+            test_loss += loss_fun(output, target).item()
+            pred = output.data.max(1)[1]
+
+            correct += pred.eq(target.view(-1)).sum().item()
+
+    return test_loss/len(test_loader), correct /len(test_loader.dataset)
+
+
+def staleness_weight(staleness):
+    # polynomial staleness function of FedAsync: s(t - tau) = (t - tau + 1) ^ -a
+    return (staleness + 1) ** (-args.staleness_a)
+
+
+def local_update(model, global_state, train_loader, loss_fun, device):
+    model.load_state_dict(global_state)
+    optimizer = optim.SGD(params=model.parameters(), lr=args.lr)
+    for wi in range(args.wk_iters):
+        train(model, train_loader, optimizer, loss_fun, args.nclient, device)
+    return {key: value.detach().clone() for key, value in model.state_dict().items()}
+
+
+class Server():
+    def __init__(self, model, test_loader, loss_fun, device, name):
+        self.model = model
+        self.test_loader = test_loader
+        self.loss_fun = loss_fun
+        self.device = device
+        self.name = name
+
+        self.version = 0 # bumped by every server step
+        self.received = 0 # client updates received so far
+        self.buffer = []
+        self.history = [] # (virtual time, received, test acc)
+
+    def pull(self):
+        return copy.deepcopy(self.model.state_dict()), self.version
+
+    def push_fedasync(self, state, version):
+        alpha = args.async_alpha * staleness_weight(self.version - version)
+        with torch.no_grad():
+            for key, param in self.model.state_dict().items():
+                if 'num_batches_tracked' in key:
+                    param.copy_(state[key])
+                else:
+                    param.mul_(1 - alpha).add_(state[key], alpha=alpha)
+        self.version += 1
+        self.received += 1
+
+    def push_fedbuff(self, delta, version):
+        self.buffer.append((delta, staleness_weight(self.version - version)))
+        self.received += 1
+        if len(self.buffer) < args.buffer_k:
+            return
+        with torch.no_grad():
+            for key, param in self.model.state_dict().items():
+                if 'num_batches_tracked' in key:
+                    param.add_(self.buffer[-1][0][key])
+                    continue
+                step = torch.zeros_like(param)
+                for d, w in self.buffer:
+                    step += w * d[key]
+                param.add_(step, alpha=args.glo_lr / len(self.buffer))
+        self.buffer = []
+        self.version += 1
+
+    def evaluate(self, now):
+        test_loss, test_acc = test(self.model, self.test_loader, self.loss_fun, self.device)
+        self.history.append((now, self.received, test_acc))
+        print(' server | Test  Loss: {:.4f} | Test  Acc: {:.4f} | Time: {:.2f}s | Updates: {}'.format(test_loss, test_acc, now, self.received))
+        logfile.write(' server | Test  Loss: {:.4f} | Test  Acc: {:.4f} | Time: {:.2f}s | Updates: {}\n'.format(test_loss, test_acc, now, self.received))
+        # an evaluation is the closest thing to a round here
+        runlog.metric(len(self.history) - 1, SERVER, 'test', loss=test_loss, acc=test_acc, time=now, updates=self.received)
+        runlog.flush()
+        if timeline:
+            # the span between two evaluations is the round of the metric records
+            last = self.history[-2][0] if len(self.history) > 1 else 0.
+            timeline.add_span('round {}'.format(timeline.round), last, now, SERVER, cat='round', acc=test_acc, updates=self.received)
+            timeline.round = len(self.history)
+        logfile.flush()
+
+    def time_to_accuracy(self, target):
+        for now, received, acc in self.history:
+            if acc >= target:
+                return now, received
+        return None, None
+
+
+async def run_client(client_idx, server, model, train_loader, duration, budget, loss_fun, device):
+    loop = asyncio.get_running_loop()
+    while server.received < budget:
+        start = loop.time()
+        global_state, version = server.pull()
+        state = local_update(model, global_state, train_loader, loss_fun, device)
+        await asyncio.sleep(duration)
+        if timeline:
+            # virtual seconds, the overlap and the idle gaps of the clients are what the trace is for
+            timeline.add_span('train', start, loop.time(), client_idx, version=version, staleness=server.version - version)
+        if server.received >= budget:
+            break
+        if args.mode == 'fedasync':
+            server.push_fedasync(state, version)
+        else:
+            server.push_fedbuff({key: state[key] - global_state[key] for key in state.keys()}, version)
+        print(' client {}| Version: {} | Time: {:.2f}s'.format(client_idx, version, loop.time()))
+        # evaluate as often as a synchronous run would
+        if server.received % args.nclient == 0:
+            server.evaluate(loop.time())
+
+
+async def run_async(server, model, train_loaders, durations, loss_fun, device):
+    budget = args.iters * args.nclient
+    await asyncio.gather(*[
+        run_client(client_idx, server, model, train_loaders[client_idx], durations[client_idx], budget, loss_fun, device)
+        for client_idx in range(args.nclient)
+    ])
+
+
+async def run_sync(server, model, train_loaders, durations, loss_fun, device):
+    '''
+        FedAvg rounds as in communication(): all clients start from the same
+        global model and the round lasts as long as its slowest client
+    '''
+    loop = asyncio.get_running_loop()
+    total = sum(len(train_loader) for train_loader in train_loaders)
+    client_weights = [len(train_loader) / total for train_loader in train_loaders]
+    for a_iter in range(args.iters):
+        global_state, _ = server.pull()
+        states = [local_update(model, global_state, train_loaders[client_idx], loss_fun, device)
+                  for client_idx in range(args.nclient)]
+        start = loop.time()
+        await asyncio.sleep(max(durations))
+        if timeline:
+            # every client trains for its own duration, then waits for the slowest
+            for client_idx in range(args.nclient):
+                timeline.add_span('train', start, start + durations[client_idx], client_idx)
+                timeline.add_span('wait', start + durations[client_idx], loop.time(), client_idx, cat='idle')
+        with torch.no_grad():
+            for key, param in server.model.state_dict().items():
+                if 'num_batches_tracked' in key:
+                    param.copy_(states[0][key])
+                else:
+                    temp = torch.zeros_like(param)
+                    for client_idx in range(args.nclient):
+                        temp += client_weights[client_idx] * states[client_idx][key]
+                    param.copy_(temp)
+        server.version += 1
+        server.received += args.nclient
+        server.evaluate(loop.time())
+
+
+def simulate(runner, server, model, train_loaders, durations, loss_fun, device):
+    loop = VirtualClockLoop()
+    try:
+        loop.run_until_complete(runner(server, model, train_loaders, durations, loss_fun, device))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    seed= 1
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+
+    print('Device:', device)
+
+    log_path = os.path.join(args.log_path, args.model)
+    if not os.path.exists(log_path):
+        os.makedirs(log_path)
+    logfile = open(os.path.join(log_path,'{}_{}_{}_{}.log'.format(args.mode ,args.dataset,args.skew,args.nclient)), 'w')
+    runlog = RunLog(logfile.name)
+    logfile.write('==={}===\n'.format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
+    logfile.write('===Setting===\n')
+    logfile.write('    lr: {}\n'.format(args.lr))
+    logfile.write('    batch: {}\n'.format(args.batch_size))
+    logfile.write('    iters: {}\n'.format(args.iters))
+    logfile.write('    wk_iters: {}\n'.format(args.wk_iters))
+    logfile.write('    speed_sigma: {}\n'.format(args.speed_sigma))
+
+    init_model = eval(args.model)().to(device)
+    loss_fun = nn.CrossEntropyLoss()
+
+    # prepare the data
+    train_loaders, test_loaders = prepare_data(args, device)
+
+    # simulated client speeds, the same for both paths
+    rng = np.random.RandomState(args.seed)
+    speeds = rng.lognormal(0., args.speed_sigma, args.nclient)
+    durations = [args.wk_iters * len(train_loaders[client_idx]) * args.batch_time / speeds[client_idx]
+                 for client_idx in range(args.nclient)]
+    for client_idx in range(args.nclient):
+        logfile.write(' client {}| Speed: {:.3f} | Duration: {:.2f}s\n'.format(client_idx, speeds[client_idx], durations[client_idx]))
+
+    runs = [(args.mode, run_async)]
+    if args.baseline:
+        runs.append(('sync', run_sync))
+
+    results = []
+    for name, runner in runs:
+        print("============ {} ============".format(name))
+        logfile.write("============ {} ============\n".format(name))
+        server = Server(copy.deepcopy(init_model), test_loaders[0], loss_fun, device, name)
+        # one working model, the clients take turns on it
+        model = copy.deepcopy(init_model)
+        timeline = Timeline() if args.trace else None
+        if timeline:
+            timeline.round = 0
+        simulate(runner, server, model, train_loaders, durations, loss_fun, device)
+        if timeline:
+            timeline.save(os.path.splitext(logfile.name)[0] + '_{}.trace.json'.format(name))
+        results.append(server)
+
+    for server in results:
+        tta, updates = server.time_to_accuracy(args.target_acc)
+        final_time = server.history[-1][0] if server.history else 0.
+        if tta is None:
+            line = ' {} | target acc {:.4f} not reached | total time: {:.2f}s'.format(server.name, args.target_acc, final_time)
+        else:
+            line = ' {} | target acc {:.4f} | time-to-acc: {:.2f}s | updates: {} | total time: {:.2f}s'.format(
+                server.name, args.target_acc, tta, updates, final_time)
+        print(line)
+        logfile.write(line + '\n')
+
+    if args.prefetch:
+        print(prefetch_summary())
+        logfile.write(prefetch_summary() + '\n')
+        runlog.write('prefetch', **prefetch_stats())
+    logfile.flush()
+    logfile.close()
+    runlog.close()
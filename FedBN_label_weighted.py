@@ -53,13 +53,24 @@ import torchvision.transforms as transforms
 from models.digit import DigitModel
 from models.resnet import *
 from skew import label_skew_across_labels, label_skew_by_within_labels, quantity_skew, feature_skew_noise, feature_skew_filter, prepare_data
+from datafiles.prefetch import summary_line as prefetch_summary, stats as prefetch_stats
 from datafiles.loaders import dset2loader
 from datafiles.utils import setseed
 from datafiles.preprocess import preprocess
-from tr_utils import train, train_fedprox,train_LW
-
-# for GPU server selection
-os.environ['CUDA_VISIBLE_DEVICES']='1'
+from tr_utils import train, train_fedprox,train_LW, count_labels
+from client_store import ClientStateStore
+from simulate import HeteroSimulator, apply_credits, state_nbytes
+from compress import UpdateCompressor
+from comm_cost import CommMeter
+from runlog import RunLog, SERVER
+from hierarchy import HierarchicalAggregator
+from checkpoint import AsyncCheckpointer, checkpoint_path, load_checkpoint, rng_state, set_rng_state
+from profiler import Profiler, set_profiler, phase, on_client
+from timeline import Timeline
+from memprof import MemoryProfiler
+
+# for GPU server selection, a launcher (sweep.py) may choose another one
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '1')
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--test', action='store_true', help='test the pretrained model')
@@ -74,10 +85,17 @@ parser.add_argument('--save_path', type=str, default='./checkpoint', help='path
 parser.add_argument('--load_path', type=str, default='./checkpoint', help='path to save the checkpoint')
 parser.add_argument('--log_path', type=str, default='./logs_label_weighted/', help='path to save the checkpoint')
 parser.add_argument('--resume', action='store_true', help='resume training from the save path checkpoint')
+parser.add_argument('--save_every', type=int, default=1, help='checkpoint every k rounds in the background, 0 only after the last one')
+parser.add_argument('--ckpt_format', type=str, default='sharded', help='| sharded | single |, sharded: a manifest plus one file per client, unchanged ones shared across rounds')
 parser.add_argument('--choke', action = 'store_true', help='choke those bad clients when communicating')
 parser.add_argument('--label', action='store_true', help = 'reweight according to label number in FedBN')
 parser.add_argument('--model', type=str, default="DigitModel", help = 'model used:| DigitModel | resnet20 | resnet32 | resnet44 | resnet56 | resnet110 | resnet1202 |')
-parser.add_argument('--dataset', type=str, default="mnist", help = '| mnist | kmnist | svhn | cifar10 |')
+parser.add_argument('--dataset', type=str, default="mnist", help = '| mnist | kmnist | svhn | cifar10 | synth_mnist | synth_cifar10 |')
+parser.add_argument('--synth_size', type=int, default=0, help='training samples of the synth_* datasets (--nlabel classes, drawn from --seed), 0 for the size of the real one')
+parser.add_argument('--augment', type=str, default='off', help='batch augmentation of the training data: | off | on (the dataset\'s defaults) | comma separated crop,flip,cutout |')
+parser.add_argument('--augment_pad', type=int, default=4, help='padding of the random crop')
+parser.add_argument('--cutout', type=int, default=8, help='side of the cutout square')
+parser.add_argument('--prefetch', type=int, default=0, help='training batches prepared ahead on a background thread (moved to the device, augmented), 0 for none')
 parser.add_argument('--skew', type=str, default='none', help='| none | quantity | feat_filter | feat_noise | label_across | label_within |')
 parser.add_argument('--noise_std', type=float, default=0.5, help='noise level for gaussion noise')
 parser.add_argument('--filter_sz', type=int, default=3, help='filter size for filter')
@@ -86,11 +104,32 @@ parser.add_argument('--overlap', type=bool, default=True, help='If lskew_across
 parser.add_argument('--nlabel', type=int, default=10, help='number of label for dirichlet label skew')
 parser.add_argument('--nclient', type=int, default=4, help='client number')
 parser.add_argument('--seed', type=int, default=400, help='random seed')
+parser.add_argument('--store_capacity', type=int, default=0, help='client states kept in memory, the rest spill to disk, 0 keeps all')
+parser.add_argument('--store_path', type=str, default='./client_states', help='path to spill client states to')
+parser.add_argument('--sim', action='store_true', help='simulate client speeds and bandwidths on a virtual clock')
+parser.add_argument('--sim_speed', type=str, default='lognormal:0,0.5', help='distribution of client compute speeds, e.g. const:1 | uniform:0.5,2 | lognormal:0,0.5')
+parser.add_argument('--sim_bandwidth', type=str, default='lognormal:2,0.5', help='distribution of client bandwidths in MB/s')
+parser.add_argument('--sim_batch_time', type=float, default=0.05, help='virtual seconds per batch of a client with speed 1')
+parser.add_argument('--sim_deadline', type=float, default=0., help='round deadline in virtual seconds, 0 waits for every client')
+parser.add_argument('--sim_late', type=str, default='drop', help='what happens to clients missing the deadline: | drop | partial |')
+parser.add_argument('--compress', type=str, default='none', help='compression of client uploads: | none | topk | randk | q8 | q4 | sign |')
+parser.add_argument('--compress_ratio', type=float, default=0.01, help='share of entries kept by topk and randk')
+parser.add_argument('--no_ef', action='store_true', help='disable error feedback of the compressed uploads')
+parser.add_argument('--edges', type=int, default=0, help='edge aggregators between clients and server, 0 aggregates flat')
+parser.add_argument('--regions', type=int, default=0, help='regional aggregators between edges and server, 0 for two tiers')
+parser.add_argument('--edge_workers', type=int, default=0, help='threads running the edge aggregators, 0 runs them in turn')
+parser.add_argument('--profile', action='store_true', help='time the phases of every round (data, forward, backward, step, aggregate, eval, ...)')
+parser.add_argument('--profile_round', type=int, default=-1, help='also run torch.profiler over this round, its Chrome trace goes next to the log')
+parser.add_argument('--profile_sync', action='store_true', help='wait for the GPU at the end of every phase, slower but GPU time goes to the right phase')
+parser.add_argument('--trace', action='store_true', help='write a Chrome trace (Perfetto) of the client and server phases next to the log')
+parser.add_argument('--profile_memory', action='store_true', help='record peak RSS / CUDA memory per phase and live tensor bytes per category every round')
+parser.add_argument('--profile_memory_top', type=int, default=3, help='top allocators flagged per round')
+parser.add_argument('--profile_memory_lines', type=int, default=0, help='also flag the source lines allocating most per round (tracemalloc, slow), 0 off')
 args = parser.parse_args()
 
 print(f"args: {args}")
 
-assert(args.dataset in ['svhn', 'cifar10', 'mnist', 'kmnist'])
+assert(args.dataset in ['svhn', 'cifar10', 'mnist', 'kmnist', 'synth_mnist', 'synth_cifar10'])
 assert(args.skew in ['none', 'quantity', 'feat_filter', 'feat_noise', 'label_across', 'label_within'])
 assert(args.mode in ['fedavg', 'fedprox', 'fedbn'])
 
@@ -119,45 +158,167 @@ def test(model, test_loader, loss_fun, device):
     
     return test_loss/len(test_loader), correct /len(test_loader.dataset)
 
-################# Key Function ########################
-def communication(args, server_model, models, client_weights, train_losses):
-    with torch.no_grad():
-        # aggregate params
-        if args.mode.lower() == 'fedbn':
-            for key in server_model.state_dict().keys():
-                if 'bn' not in key:
-                    temp = torch.zeros_like(server_model.state_dict()[key], dtype=torch.float32)
-                    for client_idx in range(client_num):
-                        temp += client_weights[client_idx] * models[client_idx].state_dict()[key]
-                    server_model.state_dict()[key].data.copy_(temp)
-                    for client_idx in range(client_num):
-                        models[client_idx].state_dict()[key].data.copy_(server_model.state_dict()[key])
-        else:
-            if args.choke and len(train_losses)!=0:
-                loss_mean = np.mean(train_losses)
-                loss_std = np.std(train_losses, ddof=1)
-                if loss_std > 0.2:
-                    tmp_total = 0
-                    for client_idx in range(len(client_weights)):
-                        if(train_losses[client_idx]>(loss_mean+loss_std)):
-                            client_weights[client_idx] = 0
-                        else:
-                            tmp_total += client_weights[client_idx]
-                    client_weights = [client_weights[client_idx]/tmp_total for client_idx in range(len(client_weights))]
-            for key in server_model.state_dict().keys():
-                # num_batches_tracked is a non trainable LongTensor and
-                # num_batches_tracked are the same for all clients for the given datasets
-                if 'num_batches_tracked' in key:
-                    server_model.state_dict()[key].data.copy_(models[0].state_dict()[key])
+def is_personal(key):
+    # FedBN keeps the BatchNorm layers (affine params and running stats) local
+    return 'bn' in key
+
+
+def load_client(model, server_model, store, client_idx):
+    '''
+        Swap client_idx into the working model: the shared weights of the
+        server, overlaid by what the store keeps for that client (its BN
+        state for FedBN, nothing for the other modes)
+    '''
+    state = store.get(client_idx)
+    if state is None or len(state) < len(server_model.state_dict()):
+        model.load_state_dict(server_model.state_dict())
+    if state is not None:
+        model.load_state_dict(state, strict=False)
+
+
+def accumulate(temps, server_state, state, weight, client_idx, compressor):
+    '''
+        temps[key] += weight * what the client uploads for key: its weights,
+        or its compressed delta to the server weights when compressing.
+        Returns the upload.
+    '''
+    if compressor is None:
+        for key in temps.keys():
+            temps[key] += weight * state[key].to(temps[key].device)
+        return {key: state[key] for key in temps.keys()}
+    update = {key: state[key].to(server_state[key].device) - server_state[key] for key in temps.keys()}
+    upload = compressor.encode(client_idx, update)
+    compressor.decode_add(temps, upload, weight)
+    return upload
+
+
+def shared_keys(args, server_model):
+    # what goes over the wire each way, FedBN keeps BN local
+    if args.mode.lower() == 'fedbn':
+        return [key for key in server_model.state_dict().keys() if not is_personal(key)]
+    return list(server_model.state_dict().keys())
+
+
+def checkpoint_state(a_iter, server_model, store, compressor, train_losses):
+    server_state = server_model.state_dict()
+    state = {
+        'a_iter': a_iter,
+        'server_model': server_state,
+        'train_losses': train_losses,
+        'rng': rng_state(),
+    }
+    if args.mode.lower() == 'fedbn':
+        # each client's BN state, its full model is the server model with that on top
+        state['clients'] = store
+    if compressor:
+        state['residuals'] = compressor.residuals
+    return state
+
+
+def round_weights(args, train_loaders, train_losses, labels, sim=None):
+    '''
+        The aggregation weights of a round, all known before the clients
+        train: loader sizes (fedavg), label counts (fedbn --label), the
+        simulated deadline and the choking of the last round's losses
+    '''
+    client_num = len(train_loaders)
+    client_weights = [1/client_num for i in range(client_num)]
+    if args.mode.lower() == 'fedavg':
+        total = sum(len(train_loader) for train_loader in train_loaders)
+        client_weights = [len(train_loaders[i])/total for i in range(client_num)]
+    if args.mode.lower() == 'fedbn' and args.label:
+        total_label = torch.sum(labels,dim=0)
+        client_w = [0 for i in range(client_num)]
+        for i in range(args.nlabel):
+            for j in range(client_num):
+                client_w[j] += labels[j][i]/total_label[i]
+        client_weights = [client_w[i]/args.nlabel for i in range(client_num)]
+    if sim:
+        client_weights = apply_credits(client_weights, sim.end_round())
+    if args.mode.lower() != 'fedbn' and args.choke and len(train_losses)!=0:
+        loss_mean = np.mean(train_losses)
+        loss_std = np.std(train_losses, ddof=1)
+        if loss_std > 0.2:
+            tmp_total = 0
+            for client_idx in range(len(client_weights)):
+                if(train_losses[client_idx]>(loss_mean+loss_std)):
+                    client_weights[client_idx] = 0
                 else:
-                    temp = torch.zeros_like(server_model.state_dict()[key])
-                    for client_idx in range(len(client_weights)):
-                        temp += client_weights[client_idx] * models[client_idx].state_dict()[key]
-                    server_model.state_dict()[key].data.copy_(temp)
-                    for client_idx in range(len(client_weights)):
-                        models[client_idx].state_dict()[key].data.copy_(server_model.state_dict()[key])
+                    tmp_total += client_weights[client_idx]
+            client_weights = [client_weights[client_idx]/tmp_total for client_idx in range(len(client_weights))]
+    return client_weights
+
+
+class RoundSums():
+    '''
+        The weighted sum of the round's uploads, added client by client
+        right after each one trained, so no client model is kept until the
+        aggregation. With edges every edge keeps its own partial sum and
+        the aggregator combines them at the end, as reduce_clients() would.
+    '''
+    def __init__(self, args, server_model, client_weights, compressor=None, meter=None, aggregator=None):
+        self.server_state = server_model.state_dict()
+        self.client_weights = client_weights
+        self.compressor = compressor
+        self.meter = meter
+        self.aggregator = aggregator
+        self.fedbn = args.mode.lower() == 'fedbn'
+        if self.fedbn:
+            self.keys = [key for key in self.server_state.keys() if not is_personal(key)]
+        else:
+            self.keys = [key for key in self.server_state.keys() if 'num_batches_tracked' not in key]
+        self.partials = {} # edge -> partial sum
+        self.edge_times = {}
+        self.tracked = {} # num_batches_tracked, from client 0
+
+    def zeros(self):
+        if self.fedbn:
+            return {key: torch.zeros_like(self.server_state[key], dtype=torch.float32) for key in self.keys}
+        return {key: torch.zeros_like(self.server_state[key]) for key in self.keys}
+
+    def add(self, client_idx, state):
+        edge = client_idx % self.aggregator.edges if self.aggregator else 0
+        start = time.perf_counter()
+        with torch.no_grad(), phase('aggregate'):
+            if edge not in self.partials:
+                self.partials[edge] = self.zeros()
+            upload = accumulate(self.partials[edge], self.server_state, state, self.client_weights[client_idx], client_idx, self.compressor)
+        self.edge_times[edge] = self.edge_times.get(edge, 0.) + time.perf_counter() - start
+        if self.meter:
+            self.meter.add(client_idx, 'up', upload)
+        if not self.fedbn:
+            if self.meter:
+                self.meter.add(client_idx, 'up', state, keys=[key for key in state.keys() if 'num_batches_tracked' in key])
+            # num_batches_tracked is a non trainable LongTensor and
+            # num_batches_tracked are the same for all clients for the given datasets
+            if client_idx == 0:
+                self.tracked = {key: state[key].clone() for key in state.keys() if 'num_batches_tracked' in key}
+
+    def total(self):
+        if self.aggregator is None:
+            return self.partials[0] if 0 in self.partials else self.zeros()
+        edges = sorted(self.partials)
+        return self.aggregator.combine([self.partials[e] for e in edges], self.zeros,
+                                       max([self.edge_times[e] for e in edges] + [0.]))
 
-    return server_model, models
+
+################# Key Function ########################
+def communication(args, server_model, sums, compressor=None):
+    '''
+        The server update from the sums of the round. FedBN leaves the BN
+        layers out, the clients keep their own (in the store).
+    '''
+    with torch.no_grad(), phase('aggregate'):
+        server_state = server_model.state_dict()
+        temps = sums.total()
+        for key in temps.keys():
+            if compressor is None:
+                server_state[key].data.copy_(temps[key])
+            else:
+                server_state[key].data.add_(temps[key])
+        for key, value in sums.tracked.items():
+            server_state[key].data.copy_(value)
+    return server_model
 
 
 if __name__ == '__main__':
@@ -179,6 +340,12 @@ if __name__ == '__main__':
         logfile = open(os.path.join(log_path,'{}_{}_{}_{}.log'.format(args.mode + "Labeling",args.dataset,args.skew,args.nclient)), 'w')
     else:
         logfile = open(os.path.join(log_path,'{}_{}_{}_{}.log'.format(args.mode ,args.dataset,args.skew,args.nclient)), 'w')
+    runlog = RunLog(logfile.name)
+    timeline = Timeline() if args.trace else None
+    memory = MemoryProfiler(runlog, args.profile_memory_top, args.profile_memory_lines) if args.profile_memory else None
+    profiler = Profiler(args.profile, args.profile_sync, args.profile_round,
+                        os.path.splitext(logfile.name)[0] + '.torch.json', runlog, timeline, memory)
+    set_profiler(profiler)
     
     logfile.write('==={}===\n'.format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
     logfile.write('===Setting===\n')
@@ -190,105 +357,208 @@ if __name__ == '__main__':
     if not os.path.exists(args.save_path):
         os.makedirs(args.save_path)
     SAVE_PATH = os.path.join(args.save_path, '{}_{}_{}.bin'.format(args.mode,args.dataset,args.skew))
+    SAVE_PATH = checkpoint_path(SAVE_PATH, args.ckpt_format)
    
    
     server_model = eval(args.model)().to(device)
     loss_fun = nn.CrossEntropyLoss()
 
     # prepare the data
-    train_loaders, test_loaders = prepare_data(args)
+    train_loaders, test_loaders = prepare_data(args, device)
     # federated setting
     client_num = args.nclient
     client_weights = [1/client_num for i in range(client_num)]
-    models = [copy.deepcopy(server_model).to(device) for idx in range(client_num)]
-
+    # one working model, the client states live in the store and are swapped in
+    model = copy.deepcopy(server_model).to(device)
+    store = ClientStateStore(args.store_capacity,
+                             os.path.join(args.store_path, '{}_{}_{}'.format(args.mode, args.dataset, args.skew)))
+
+    compressor = None
+    if args.compress != 'none':
+        residuals = ClientStateStore(args.store_capacity,
+                                     os.path.join(args.store_path, '{}_{}_{}_residuals'.format(args.mode, args.dataset, args.skew)))
+        compressor = UpdateCompressor(args.compress, args.compress_ratio, not args.no_ef, residuals)
+    train_losses = []
     if args.resume:
-        checkpoint = torch.load(SAVE_PATH)
+        checkpoint = load_checkpoint(SAVE_PATH)
         server_model.load_state_dict(checkpoint['server_model'])
         if args.mode.lower()=='fedbn':
+            clients = checkpoint.get('clients', {})
             for client_idx in range(client_num):
-                models[client_idx].load_state_dict(checkpoint['model_{}'.format(client_idx)])
-        else:
-            for client_idx in range(client_num):
-                models[client_idx].load_state_dict(checkpoint['server_model'])
+                # older checkpoints keep full client models
+                client_state = clients[client_idx] if client_idx in clients else checkpoint['model_{}'.format(client_idx)]
+                store.put(client_idx, {key: client_state[key] for key in client_state.keys() if is_personal(key)})
+        if compressor and 'residuals' in checkpoint:
+            compressor.residuals.restore(checkpoint['residuals'])
+        train_losses = checkpoint.get('train_losses', [])
+        if 'rng' in checkpoint:
+            set_rng_state(checkpoint['rng'])
         resume_iter = int(checkpoint['a_iter']) + 1
         print('Resume training from epoch {}'.format(resume_iter))
     else:
         resume_iter = 0
+    checkpointer = AsyncCheckpointer(SAVE_PATH, args.save_every, args.ckpt_format)
+    sim = None
+    if args.sim:
+        sim = HeteroSimulator(client_num, args.sim_speed, args.sim_bandwidth, args.sim_batch_time,
+                              args.sim_deadline, args.sim_late, args.seed)
+    meter = CommMeter(server_model, runlog)
+    aggregator = None
+    if args.edges > 0:
+        aggregator = HierarchicalAggregator(args.edges, args.regions, args.edge_workers)
+    if memory:
+        # the aggregation temporaries show up as the rise of the aggregate phase
+        memory.track('datasets', lambda: (train_loaders, test_loaders))
+        memory.track('client models', lambda: (server_model, model, store))
+        memory.track('optimizer state', lambda: optimizer)
+        memory.track('error feedback', lambda: compressor.residuals if compressor else None)
+    # the label counts of the clients' data, for the label weighted FedBN
+    labels = None
+    if args.mode.lower() == 'fedbn' and args.label:
+        labels = torch.stack([count_labels(train_loader, args) for train_loader in train_loaders]).float()
     # start training
-    train_losses = []
     for a_iter in range(resume_iter, args.iters):
-        optimizers = [optim.SGD(params=models[idx].parameters(), lr=args.lr) for idx in range(client_num)]
-        samples = [0 for i in range(client_num)]
-        total = 0
-        labels = torch.tensor([])
-        for wi in range(args.wk_iters):
-            print("============ Train epoch {} ============".format(wi + a_iter * args.wk_iters))
-            logfile.write("============ Train epoch {} ============\n".format(wi + a_iter * args.wk_iters)) 
-            
+        profiler.start_round(a_iter)
+        # plain SGD keeps no state, so one optimizer serves every client
+        optimizer = optim.SGD(params=model.parameters(), lr=args.lr)
+        # broadcast of the shared weights
+        meter.start_round(a_iter)
+        keys = shared_keys(args, server_model)
+        for client_idx in range(client_num):
+            meter.add(client_idx, 'down', server_model.state_dict(), keys=keys)
+        if sim:
+            sim.start_round()
+            up_bytes = state_nbytes({key: server_model.state_dict()[key] for key in keys})
+            if compressor:
+                up_bytes = compressor.expected_nbytes(server_model.state_dict(), keys)
             for client_idx in range(client_num):
-                model, train_loader, optimizer = models[client_idx], train_loaders[client_idx], optimizers[client_idx]
-                if args.mode.lower() == 'fedprox':
-                    if a_iter > 0:
-                        train_fedprox(args, model, server_model, train_loader, optimizer, loss_fun, client_num, device)
+                sim.add_transfer(client_idx, meter.client_bytes(client_idx, 'down'), up_bytes)
+                # virtual time, known before the clients train
+                sim.add_compute(client_idx, args.wk_iters * len(train_loaders[client_idx]))
+        client_weights = round_weights(args, train_loaders, train_losses, labels, sim)
+        sums = RoundSums(args, server_model, client_weights, compressor, meter, aggregator)
+        first = a_iter * args.wk_iters
+        epochs = first if args.wk_iters == 1 else '{}-{}'.format(first, first + args.wk_iters - 1)
+        print("============ Train epoch {} ============".format(epochs))
+        logfile.write("============ Train epoch {} ============\n".format(epochs))
+
+        # every client trains its wk_iters epochs in one go and its upload
+        # goes into the sums right away, only its BN state (FedBN) is kept
+        for client_idx in range(client_num):
+            store.prefetch(client_idx + 1)
+            with on_client(client_idx):
+                with phase('broadcast'):
+                    load_client(model, server_model, store, client_idx)
+                train_loader = train_loaders[client_idx]
+                for wi in range(args.wk_iters):
+                    if args.mode.lower() == 'fedprox':
+                        if a_iter > 0:
+                            train_fedprox(args, model, server_model, train_loader, optimizer, loss_fun, client_num, device)
+                        else:
+                            train(model, train_loader, optimizer, loss_fun, client_num, device)
                     else:
-                        train(model, train_loader, optimizer, loss_fun, client_num, device)
-                else:
-                    if args.mode.lower() == 'fedavg':
-                        samples[client_idx] += len(train_loader)
-                        total += len(train_loader)
-                    _, _, labels_num = train_LW(model, train_loader, optimizer, loss_fun, client_num, device,args)
-                    if wi == 0 :
-                        labels = torch.cat((labels,labels_num.unsqueeze(0)),0)
-
-         
+                        train_LW(model, train_loader, optimizer, loss_fun, client_num, device,args)
+                state = model.state_dict()
+                sums.add(client_idx, state)
+                if args.mode.lower() == 'fedbn':
+                    store.put(client_idx, {key: state[key] for key in state.keys() if is_personal(key)})
+
+        if memory:
+            memory.snapshot('train')
         # aggregation
-        client_weights = [1/client_num for i in range(client_num)]
-        if args.mode.lower() == 'fedavg':
-            client_weights = [samples[i]/total for i in range(client_num)]
-        if args.mode.lower() == 'fedbn' and args.label:
-            total = 0
-            total_label = torch.sum(labels,dim=0)
-            client_w = [0 for i in range(client_num)]
-            for i in range(args.nlabel):
-                for j in range(client_num):
-                    client_w[j] += labels[j][i]/total_label[i]
-            client_weights = [client_w[i]/args.nlabel for i in range(client_num)]
-            # print(client_weights)
-        server_model, models = communication(args, server_model, models, client_weights, train_losses)
+        server_model = communication(args, server_model, sums, compressor)
+        del sums
+        if aggregator:
+            print(aggregator.log_line())
+            logfile.write(aggregator.log_line() + '\n')
+        down, up, total = meter.end_round()
+        print(meter.log_line(down, up, total))
+        logfile.write(meter.log_line(down, up, total) + '\n')
+        if compressor:
+            ratio, sent = compressor.round_ratio()
+            print(' compress | Ratio: {:.2f}x | Sent: {:.2f} MB'.format(ratio, sent / 2**20))
+            logfile.write(' compress | Ratio: {:.2f}x | Sent: {:.2f} MB\n'.format(ratio, sent / 2**20))
         min_test_loss = 1000
         max_test_acc = 0
         # report after aggregation
         train_losses = []
         for client_idx in range(client_num):
-                model, train_loader, optimizer = models[client_idx], train_loaders[client_idx], optimizers[client_idx]
-                train_loss, train_acc = test(model, train_loader, loss_fun, device) 
+                store.prefetch(client_idx + 1)
+                load_client(model, server_model, store, client_idx)
+                train_loader = train_loaders[client_idx]
+                with on_client(client_idx), phase('eval'):
+                    train_loss, train_acc = test(model, train_loader, loss_fun, device)
                 train_losses.append(train_loss)
                 print(' client {}| Train Loss: {:.4f} | Train Acc: {:.4f}'.format(client_idx, train_loss, train_acc))
-                logfile.write(' client {}| Train Loss: {:.4f} | Train Acc: {:.4f}\n'.format(client_idx ,train_loss, train_acc))\
+                logfile.write(' client {}| Train Loss: {:.4f} | Train Acc: {:.4f}\n'.format(client_idx ,train_loss, train_acc))
+                runlog.metric(a_iter, client_idx, 'train', loss=train_loss, acc=train_acc)
 
         # start testing
+        best_state = None
         for test_idx, test_loader in enumerate(test_loaders):
-            test_loss, test_acc = test(models[test_idx], test_loader, loss_fun, device)
+            store.prefetch(test_idx + 1)
+            load_client(model, server_model, store, test_idx)
+            with on_client(test_idx), phase('eval'):
+                test_loss, test_acc = test(model, test_loader, loss_fun, device)
             print(' client {}| Test  Loss: {:.4f} | Test  Acc: {:.4f}'.format(test_idx, test_loss, test_acc))
             logfile.write(' client {}| Test  Loss: {:.4f} | Test  Acc: {:.4f}\n'.format(test_idx, test_loss, test_acc))
+            runlog.metric(a_iter, test_idx, 'test', loss=test_loss, acc=test_acc)
             if test_acc > max_test_acc:
-                server_model = models[test_idx]
+                best_state = copy.deepcopy(model.state_dict())
                 max_test_acc = test_acc
                 min_test_loss = test_loss
+        if best_state is not None:
+            server_model.load_state_dict(best_state)
         print(' server | Test  Loss: {:.4f} | Test  Acc: {:.4f}'.format(min_test_loss, max_test_acc))
         logfile.write(' server | Test  Loss: {:.4f} | Test  Acc: {:.4f}\n'.format(min_test_loss, max_test_acc))
+        runlog.metric(a_iter, SERVER, 'test', loss=min_test_loss, acc=max_test_acc)
+        if sim:
+            print(sim.log_line())
+            logfile.write(sim.log_line() + '\n')
+        stats = store.stats()
+        print(' store  | hits: {} | misses: {} | spilled: {:.2f} MB | resident: {:.2f} MB'.format(
+            stats['hits'], stats['misses'], stats['bytes_spilled'] / 2**20, stats['bytes_in_memory'] / 2**20))
+        logfile.write(' store  | hits: {} | misses: {} | spilled: {:.2f} MB | resident: {:.2f} MB\n'.format(
+            stats['hits'], stats['misses'], stats['bytes_spilled'] / 2**20, stats['bytes_in_memory'] / 2**20))
+        # written in the background, the next round starts right away
+        if checkpointer.due(a_iter, last=a_iter == args.iters - 1):
+            checkpointer.save(checkpoint_state(a_iter, server_model, store, compressor, train_losses))
+        if profiler.end_round():
+            print(profiler.table())
+            logfile.write(profiler.table() + '\n')
+        if memory:
+            print(memory.table())
+            logfile.write(memory.table() + '\n')
         logfile.flush()
 
-    # Save checkpoint
+    # the last round's checkpoint may still be writing
     print(' Saving checkpoints to {}...'.format(SAVE_PATH))
-    if args.mode.lower() == 'fedbn':
-        dic = {'model_{}'.format(num):models[num].state_dict() for num in range(client_num)}
-        dic.update({'server_model': server_model.state_dict()})
-        torch.save(dic, SAVE_PATH)
-    else:
-        torch.save({
-            'server_model': server_model.state_dict(),
-        }, SAVE_PATH)
+    checkpointer.close()
+    print(checkpointer.log_line())
+    logfile.write(checkpointer.log_line() + '\n')
+    store.close()
+    if args.profile:
+        print(profiler.summary_lines())
+        logfile.write(profiler.summary_lines() + '\n')
+        profiler.save_summary(os.path.splitext(logfile.name)[0] + '.profile.json')
+    if memory:
+        print(memory.summary_lines())
+        logfile.write(memory.summary_lines() + '\n')
+        memory.save_summary(os.path.splitext(logfile.name)[0] + '.memory.json')
+        memory.close()
+    if args.prefetch:
+        print(prefetch_summary())
+        logfile.write(prefetch_summary() + '\n')
+        runlog.write('prefetch', **prefetch_stats())
+    if timeline:
+        timeline.save(os.path.splitext(logfile.name)[0] + '.trace.json')
+    runlog.close()
+    if aggregator:
+        aggregator.close()
+    if compressor:
+        compressor.residuals.close()
+    if sim:
+        print(sim.summary_line())
+        logfile.write(sim.summary_line() + '\n')
     logfile.flush()
     logfile.close()
@@ -0,0 +1,342 @@
+"""
+Multi-process FedAvg / FedProx / FedBN over torch.distributed (gloo) on localhost.
+
+example test command:
+    python FedDist.py --mode fedbn \
+                      --dataset mnist \
+                      --skew quantity \
+                      --nclient 8 \
+                      --nproc 4
+
+    Rank 0 is the server, ranks 1..nproc each run a group of clients
+    (client i lives on rank 1 + i % nproc). No GPU and no external service
+    is needed, everything goes through gloo over 127.0.0.1.
+
+    Every round
+        1. the server broadcasts the shared weights
+        2. every client rank trains its clients and sums their weighted
+           shared weights into one vector
+        3. a SUM reduce to the server gives the weighted mean, the same
+           aggregation as communication() in FedBN_label_weighted.py
+        4. the new weights are broadcast again and the clients report
+           their train / test metrics through another reduce
+
+    The shared weights of the working models are laid out in one flat
+    buffer (wire.flatten_module), so every collective moves a single
+    contiguous tensor, plus one for the shared BN running stats (fedavg,
+    fedprox): these live in a storage of their own, the in-place updates
+    of a train-mode forward would otherwise break backward. The server logs the time spent waiting for the
+    clients, in the reduce and in the broadcast, which are the real
+    serialization and communication costs.
+
+parameters you HAVE TO set:
+
+        mode: fedavg | fedprox | fedbn, as in FedBN_label_weighted.py
+              (fedbn keeps the BN layers of every client on its rank)
+        dataset, skew, nclient: same as FedBN_label_weighted.py
+        nproc: number of client processes
+
+    num_batches_tracked stays local to every client rank.
+
+details in args
+"""
+
+import torch
+import time
+import os
+import copy
+import torch.nn as nn
+import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import argparse
+import numpy as np
+from models.digit import DigitModel
+from models.resnet import *
+from skew import prepare_data
+from datafiles.prefetch import summary_line as prefetch_summary, stats as prefetch_stats
+from datafiles.utils import setseed
+from tr_utils import train, train_fedprox
+from client_store import ClientStateStore
+from wire import flatten_module
+from runlog import RunLog, SERVER
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--lr', type=float, default=1e-1, help='learning rate')
+parser.add_argument('--batch_size', type=int, default=32, help ='batch size')
+parser.add_argument('--iters', type=int, default=50, help='iterations for communication')
+parser.add_argument('--wk_iters', type=int, default=3, help='optimization iters in local worker between communication')
+parser.add_argument('--mode', type=str, default='fedbn', help='fedavg | fedprox | fedbn')
+parser.add_argument('--mu', type=float, default=1e-2, help='The hyper parameter for fedprox')
+parser.add_argument('--log_path', type=str, default='./logs_dist/', help='path to save the log')
+parser.add_argument('--model', type=str, default="DigitModel", help = 'model used:| DigitModel | resnet20 | resnet32 | resnet44 | resnet56 | resnet110 | resnet1202 |')
+parser.add_argument('--dataset', type=str, default="mnist", help = '| mnist | kmnist | svhn | cifar10 | synth_mnist | synth_cifar10 |')
+parser.add_argument('--synth_size', type=int, default=0, help='training samples of the synth_* datasets (--nlabel classes, drawn from --seed), 0 for the size of the real one')
+parser.add_argument('--augment', type=str, default='off', help='batch augmentation of the training data: | off | on (the dataset\'s defaults) | comma separated crop,flip,cutout |')
+parser.add_argument('--augment_pad', type=int, default=4, help='padding of the random crop')
+parser.add_argument('--cutout', type=int, default=8, help='side of the cutout square')
+parser.add_argument('--prefetch', type=int, default=0, help='training batches prepared ahead on a background thread (moved to the device, augmented), 0 for none')
+parser.add_argument('--skew', type=str, default='none', help='| none | quantity | feat_filter | feat_noise | label_across | label_within |')
+parser.add_argument('--noise_std', type=float, default=0.5, help='noise level for gaussion noise')
+parser.add_argument('--filter_sz', type=int, default=3, help='filter size for filter')
+parser.add_argument('--Di_alpha', type=float, default=0.5, help='alpha level for dirichlet distribution')
+parser.add_argument('--overlap', type=bool, default=True, help='If lskew_across allows label distribution to overlap')
+parser.add_argument('--nlabel', type=int, default=10, help='number of label for dirichlet label skew')
+parser.add_argument('--nclient', type=int, default=4, help='client number')
+parser.add_argument('--seed', type=int, default=400, help='random seed')
+parser.add_argument('--nproc', type=int, default=2, help='client processes, rank 0 is the server on top')
+parser.add_argument('--master_port', type=int, default=29500, help='localhost port of the gloo rendezvous')
+parser.add_argument('--store_capacity', type=int, default=0, help='client states kept in memory per rank, the rest spill to disk, 0 keeps all')
+parser.add_argument('--store_path', type=str, default='./client_states', help='path to spill client states to')
+args = parser.parse_args()
+
+assert(args.dataset in ['svhn', 'cifar10', 'mnist', 'kmnist', 'synth_mnist', 'synth_cifar10'])
+assert(args.skew in ['none', 'quantity', 'feat_filter', 'feat_noise', 'label_across', 'label_within'])
+assert(args.mode.lower() in ['fedavg', 'fedprox', 'fedbn'])
+assert(1 <= args.nproc <= args.nclient)
+
+SERVER_RANK = 0 # the gloo rank of the server, runlog.SERVER is its id in the metrics
+PREFETCH_KEYS = ['batches', 'prepare', 'wait', 'empty']
+
+
+def test(model, test_loader, loss_fun, device):
+    model.eval()
+    test_loss = 0
+    correct = 0
+
+    with torch.no_grad():
+        for data, target in test_loader:
+            data = data.to(device).float()
+            target = target.to(device).long()
+
+            output = model(data)
+
+            test_loss += loss_fun(output, target).item()
+            pred = output.data.max(1)[1]
+
+            correct += pred.eq(target.view(-1)).sum().item()
+
+    return test_loss/len(test_loader), correct /len(test_loader.dataset)
+
+
+def is_personal(key):
+    return args.mode.lower() == 'fedbn' and 'bn' in key
+
+
+def shared_keys(model):
+    # what goes through the collectives
+    return [key for key in model.state_dict().keys() if not is_personal(key) and 'num_batches_tracked' not in key]
+
+
+def shared_vecs(model, keys):
+    # one vector over the shared parameters, one over the shared buffers if there are any
+    params, buffers = flatten_module(model, first=keys)
+    vecs = [params.span([key for key in keys if key in params])]
+    buffer_keys = [key for key in keys if key in buffers]
+    if buffer_keys:
+        vecs.append(buffers.span(buffer_keys))
+    return vecs
+
+
+def rank_of(client_idx):
+    return 1 + client_idx % args.nproc
+
+
+def client_weights_of(train_loaders):
+    # the weights of communication(), every rank can compute them from the loader sizes
+    client_num = len(train_loaders)
+    if args.mode.lower() == 'fedavg':
+        total = sum(len(train_loader) for train_loader in train_loaders)
+        return [len(train_loader) / total for train_loader in train_loaders]
+    return [1 / client_num for i in range(client_num)]
+
+
+def run_server(model):
+    log_path = os.path.join(args.log_path, args.model)
+    if not os.path.exists(log_path):
+        os.makedirs(log_path)
+    logfile = open(os.path.join(log_path, '{}_{}_{}_{}_dist{}.log'.format(args.mode, args.dataset, args.skew, args.nclient, args.nproc)), 'w')
+    runlog = RunLog(logfile.name)
+    logfile.write('==={}===\n'.format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
+    logfile.write('===Setting===\n')
+    logfile.write('    lr: {}\n'.format(args.lr))
+    logfile.write('    batch: {}\n'.format(args.batch_size))
+    logfile.write('    iters: {}\n'.format(args.iters))
+    logfile.write('    wk_iters: {}\n'.format(args.wk_iters))
+    logfile.write('    processes: {} clients + 1 server\n'.format(args.nproc))
+
+    keys = shared_keys(model)
+    global_vecs = shared_vecs(model, keys)
+    accs = [torch.zeros_like(vec) for vec in global_vecs]
+    metrics = torch.zeros(args.nclient, 4)
+
+    # rank 1 prepares the data before the other client ranks
+    dist.barrier()
+    for vec in global_vecs:
+        dist.broadcast(vec, src=SERVER_RANK)
+
+    compute_total = reduce_total = broadcast_total = 0.
+    for a_iter in range(args.iters):
+        print("============ Train epoch {} ============".format(a_iter))
+        logfile.write("============ Train epoch {} ============\n".format(a_iter))
+
+        # the clients train, the barrier returns when the slowest rank is done
+        start = time.perf_counter()
+        dist.barrier()
+        compute_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for acc in accs:
+            acc.zero_()
+            dist.reduce(acc, dst=SERVER_RANK, op=dist.ReduceOp.SUM)
+        reduce_time = time.perf_counter() - start
+        # the client weights sum to 1, the sum is the weighted mean
+        for vec, acc in zip(global_vecs, accs):
+            vec.copy_(acc)
+
+        start = time.perf_counter()
+        for vec in global_vecs:
+            dist.broadcast(vec, src=SERVER_RANK)
+        broadcast_time = time.perf_counter() - start
+
+        metrics.zero_()
+        dist.reduce(metrics, dst=SERVER_RANK, op=dist.ReduceOp.SUM)
+        for client_idx in range(args.nclient):
+            train_loss, train_acc, _, _ = metrics[client_idx].tolist()
+            print(' client {}| Train Loss: {:.4f} | Train Acc: {:.4f}'.format(client_idx, train_loss, train_acc))
+            logfile.write(' client {}| Train Loss: {:.4f} | Train Acc: {:.4f}\n'.format(client_idx, train_loss, train_acc))
+            runlog.metric(a_iter, client_idx, 'train', loss=train_loss, acc=train_acc)
+        min_test_loss = 1000
+        max_test_acc = 0
+        for client_idx in range(args.nclient):
+            _, _, test_loss, test_acc = metrics[client_idx].tolist()
+            print(' client {}| Test  Loss: {:.4f} | Test  Acc: {:.4f}'.format(client_idx, test_loss, test_acc))
+            logfile.write(' client {}| Test  Loss: {:.4f} | Test  Acc: {:.4f}\n'.format(client_idx, test_loss, test_acc))
+            runlog.metric(a_iter, client_idx, 'test', loss=test_loss, acc=test_acc)
+            if test_acc > max_test_acc:
+                max_test_acc = test_acc
+                min_test_loss = test_loss
+        print(' server | Test  Loss: {:.4f} | Test  Acc: {:.4f}'.format(min_test_loss, max_test_acc))
+        logfile.write(' server | Test  Loss: {:.4f} | Test  Acc: {:.4f}\n'.format(min_test_loss, max_test_acc))
+        runlog.metric(a_iter, SERVER, 'test', loss=min_test_loss, acc=max_test_acc)
+
+        payload = sum(vec.nelement() * vec.element_size() for vec in global_vecs) / 2**20
+        line = ' dist   | Compute: {:.3f}s | Reduce: {:.4f}s | Broadcast: {:.4f}s | Payload: {:.2f} MB'.format(
+            compute_time, reduce_time, broadcast_time, payload)
+        print(line)
+        logfile.write(line + '\n')
+        logfile.flush()
+        runlog.flush()
+        compute_total += compute_time
+        reduce_total += reduce_time
+        broadcast_total += broadcast_time
+
+    line = ' dist   | Rounds: {} | Compute: {:.2f}s | Reduce: {:.2f}s | Broadcast: {:.2f}s'.format(
+        args.iters, compute_total, reduce_total, broadcast_total)
+    print(line)
+    logfile.write(line + '\n')
+    if args.prefetch:
+        # the clients' prefetch totals, summed over the ranks
+        counts = torch.zeros(len(PREFETCH_KEYS), dtype=torch.float64)
+        dist.reduce(counts, dst=SERVER_RANK, op=dist.ReduceOp.SUM)
+        prefetch = prefetch_stats(dict(zip(PREFETCH_KEYS, counts.tolist())))
+        print(prefetch_summary(prefetch))
+        logfile.write(prefetch_summary(prefetch) + '\n')
+        runlog.write('prefetch', **prefetch)
+    logfile.close()
+    runlog.close()
+
+
+def run_clients(rank, model, device):
+    setseed(args.seed)
+    # rank 1 prepares (and caches) the data first, the others read it afterwards
+    if rank == 1:
+        train_loaders, test_loaders = prepare_data(args, device)
+    dist.barrier()
+    if rank != 1:
+        train_loaders, test_loaders = prepare_data(args, device)
+    mine = [client_idx for client_idx in range(args.nclient) if rank_of(client_idx) == rank]
+    client_weights = client_weights_of(train_loaders)
+    loss_fun = nn.CrossEntropyLoss()
+
+    keys = shared_keys(model)
+    # the working model and the global model both keep the shared weights in flat vectors
+    server_model = copy.deepcopy(model)
+    local_vecs = shared_vecs(model, keys)
+    global_vecs = shared_vecs(server_model, keys)
+    accs = [torch.zeros_like(vec) for vec in global_vecs]
+
+    # fedbn: every client of this rank keeps its own BN state
+    personal = {key: value.clone() for key, value in model.state_dict().items() if is_personal(key)}
+    store = ClientStateStore(args.store_capacity,
+                             os.path.join(args.store_path, '{}_{}_{}_rank{}'.format(args.mode, args.dataset, args.skew, rank)))
+
+    def load_client(client_idx):
+        for local_vec, global_vec in zip(local_vecs, global_vecs):
+            local_vec.copy_(global_vec)
+        if personal:
+            model.load_state_dict(store.get(client_idx, personal), strict=False)
+
+    for vec in global_vecs:
+        dist.broadcast(vec, src=SERVER_RANK)
+
+    for a_iter in range(args.iters):
+        optimizer = optim.SGD(params=model.parameters(), lr=args.lr)
+        for acc in accs:
+            acc.zero_()
+        for client_idx in mine:
+            load_client(client_idx)
+            for wi in range(args.wk_iters):
+                if args.mode.lower() == 'fedprox' and a_iter > 0:
+                    train_fedprox(args, model, server_model, train_loaders[client_idx], optimizer, loss_fun, args.nclient, device)
+                else:
+                    train(model, train_loaders[client_idx], optimizer, loss_fun, args.nclient, device)
+            for acc, local_vec in zip(accs, local_vecs):
+                acc.add_(local_vec, alpha=client_weights[client_idx])
+            if personal:
+                store.put(client_idx, {key: value for key, value in model.state_dict().items() if is_personal(key)})
+
+        dist.barrier()
+        for acc in accs:
+            dist.reduce(acc, dst=SERVER_RANK, op=dist.ReduceOp.SUM)
+        for vec in global_vecs:
+            dist.broadcast(vec, src=SERVER_RANK)
+
+        # report after aggregation
+        metrics = torch.zeros(args.nclient, 4)
+        for client_idx in mine:
+            load_client(client_idx)
+            train_loss, train_acc = test(model, train_loaders[client_idx], loss_fun, device)
+            test_loss, test_acc = test(model, test_loaders[client_idx], loss_fun, device)
+            metrics[client_idx] = torch.tensor([train_loss, train_acc, test_loss, test_acc])
+        dist.reduce(metrics, dst=SERVER_RANK, op=dist.ReduceOp.SUM)
+
+    store.close()
+    if args.prefetch:
+        print(' rank {} |{}'.format(rank, prefetch_summary()))
+        prefetch = prefetch_stats()
+        dist.reduce(torch.tensor([float(prefetch[key]) for key in PREFETCH_KEYS], dtype=torch.float64),
+                    dst=SERVER_RANK, op=dist.ReduceOp.SUM)
+
+
+def run(rank, world_size):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(args.master_port),
+                            rank=rank, world_size=world_size)
+    # the processes share the cores
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    device = torch.device('cpu')
+    # the same seed everywhere, every rank starts from the same model
+    np.random.seed(1)
+    torch.manual_seed(1)
+    model = eval(args.model)().to(device)
+    if rank == SERVER_RANK:
+        run_server(model)
+    else:
+        run_clients(rank, model, device)
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    print(f"args: {args}")
+    world_size = args.nproc + 1
+    mp.spawn(run, args=(world_size,), nprocs=world_size, join=True)
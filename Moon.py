@@ -11,13 +11,23 @@ import torchvision.transforms as transforms
 from models.digit import DigitModel, MoonDigitModel
 from models.resnet import *
 from skew import label_skew_across_labels, label_skew_by_within_labels, quantity_skew, feature_skew_noise, feature_skew_filter, prepare_data
+from datafiles.prefetch import summary_line as prefetch_summary, stats as prefetch_stats
 from datafiles.loaders import dset2loader
 from datafiles.utils import setseed
 from datafiles.preprocess import preprocess
 from tr_utils import train, train_fedprox
-
-# for GPU server selection
-os.environ['CUDA_VISIBLE_DEVICES']='1'
+from client_store import ClientStateStore
+from simulate import HeteroSimulator, apply_credits, weighted_mean
+from comm_cost import CommMeter
+from runlog import RunLog, SERVER
+from profiler import Profiler, set_profiler, phase, count, on_client
+from timeline import Timeline
+from memprof import MemoryProfiler
+from wire import FlatState
+from checkpoint import AsyncCheckpointer, checkpoint_path, load_checkpoint, rng_state, set_rng_state
+
+# for GPU server selection, a launcher (sweep.py) may choose another one
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '1')
 
 #
 # COURTESY: we reference from following link for experiment
@@ -37,8 +47,15 @@ parser.add_argument('--save_path', type=str, default='./checkpoint', help='path
 parser.add_argument('--load_path', type=str, default='./checkpoint', help='path to save the checkpoint')
 parser.add_argument('--log_path', type=str, default='./log_moon/', help='path to save the checkpoint')
 parser.add_argument('--resume', action='store_true',default=False, help='resume training from the save path checkpoint')
+parser.add_argument('--save_every', type=int, default=1, help='checkpoint every k rounds in the background, 0 only after the last one')
+parser.add_argument('--ckpt_format', type=str, default='sharded', help='| sharded | single |, sharded: a manifest plus one file per client, unchanged ones shared across rounds')
 parser.add_argument('--model', type=str, default="MoonDigitModel", help = 'model used:| MoonDigitModel | resnet20 | resnet32 | resnet44 | resnet56 | resnet110 | resnet1202 |')
-parser.add_argument('--dataset', type=str, default="mnist", help = '| mnist | kmnist | svhn | cifar10 |')
+parser.add_argument('--dataset', type=str, default="mnist", help = '| mnist | kmnist | svhn | cifar10 | synth_mnist | synth_cifar10 |')
+parser.add_argument('--synth_size', type=int, default=0, help='training samples of the synth_* datasets (--nlabel classes, drawn from --seed), 0 for the size of the real one')
+parser.add_argument('--augment', type=str, default='off', help='batch augmentation of the training data: | off | on (the dataset\'s defaults) | comma separated crop,flip,cutout |')
+parser.add_argument('--augment_pad', type=int, default=4, help='padding of the random crop')
+parser.add_argument('--cutout', type=int, default=8, help='side of the cutout square')
+parser.add_argument('--prefetch', type=int, default=0, help='training batches prepared ahead on a background thread (moved to the device, augmented), 0 for none')
 parser.add_argument('--skew', type=str, default="quantity", help='| none | quantity | feat_filter | feat_noise | label_across | label_within |')
 parser.add_argument('--noise_std', type=float, default=0.5, help='noise level for gaussion noise')
 parser.add_argument('--filter_sz', type=int, default=3, help='filter size for filter')
@@ -51,9 +68,24 @@ parser.add_argument('--cuda', type=bool, default=True, help='if cuda is availabl
 parser.add_argument('--max_grad_norm', type=float, default=1.0, help='max grad norm')
 parser.add_argument('--glo_lr', type=float, default=0.001, help='global learning rate')
 parser.add_argument('--reg_lamb', type=float, default=1.0, help='the moon parameter')
+parser.add_argument('--store_capacity', type=int, default=0, help='client states kept in memory, the rest spill to disk, 0 keeps all')
+parser.add_argument('--store_path', type=str, default='./client_states', help='path to spill client states to')
+parser.add_argument('--sim', action='store_true', help='simulate client speeds and bandwidths on a virtual clock')
+parser.add_argument('--sim_speed', type=str, default='lognormal:0,0.5', help='distribution of client compute speeds, e.g. const:1 | uniform:0.5,2 | lognormal:0,0.5')
+parser.add_argument('--sim_bandwidth', type=str, default='lognormal:2,0.5', help='distribution of client bandwidths in MB/s')
+parser.add_argument('--sim_batch_time', type=float, default=0.05, help='virtual seconds per batch of a client with speed 1')
+parser.add_argument('--sim_deadline', type=float, default=0., help='round deadline in virtual seconds, 0 waits for every client')
+parser.add_argument('--sim_late', type=str, default='drop', help='what happens to clients missing the deadline: | drop | partial |')
+parser.add_argument('--profile', action='store_true', help='time the phases of every round (data, forward, backward, step, aggregate, eval, ...)')
+parser.add_argument('--profile_round', type=int, default=-1, help='also run torch.profiler over this round, its Chrome trace goes next to the log')
+parser.add_argument('--profile_sync', action='store_true', help='wait for the GPU at the end of every phase, slower but GPU time goes to the right phase')
+parser.add_argument('--trace', action='store_true', help='write a Chrome trace (Perfetto) of the client and server phases next to the log')
+parser.add_argument('--profile_memory', action='store_true', help='record peak RSS / CUDA memory per phase and live tensor bytes per category every round')
+parser.add_argument('--profile_memory_top', type=int, default=3, help='top allocators flagged per round')
+parser.add_argument('--profile_memory_lines', type=int, default=0, help='also flag the source lines allocating most per round (tracemalloc, slow), 0 off')
 args = parser.parse_args()
 
-assert(args.dataset in ['svhn', 'cifar10', 'mnist', 'kmnist'])
+assert(args.dataset in ['svhn', 'cifar10', 'mnist', 'kmnist', 'synth_mnist', 'synth_cifar10'])
 assert(args.skew in ['none', 'quantity', 'feat_filter', 'feat_noise', 'label_across', 'label_within'])
 assert(args.mode in ['fedavg', 'fedprox', 'fedbn', 'moon'])
 setseed(args.seed)
@@ -88,65 +120,119 @@ class MOON():
 
         self.clients = args.nclient
 
-        # copy private models for each client
-        self.client_models = {}
-        for client in range(self.clients):
-            self.client_models[client] = copy.deepcopy(
-                model.cpu()
-            )
+        # private model states of each client, a client that has not trained
+        # yet starts from the global model
+        self.client_models = ClientStateStore(
+            args.store_capacity,
+            os.path.join(args.store_path, '{}_{}_{}'.format(args.mode, args.dataset, args.skew))
+        )
+
+        self.meter = CommMeter(model, runlog)
+
+        # every save_every rounds, written in the background
+        self.checkpointer = AsyncCheckpointer(SAVE_PATH, args.save_every, args.ckpt_format)
+        self.start_round = 1
+
+        self.sim = None
+        if args.sim:
+            self.sim = HeteroSimulator(self.clients, args.sim_speed, args.sim_bandwidth, args.sim_batch_time,
+                                       args.sim_deadline, args.sim_late, args.seed)
 
         # to cuda
         if self.args.cuda is True:
             self.model = self.model.cuda()
 
         # construct dataloaders
-        self.train_loaders, self.test_loaders = prepare_data(args)
+        self.train_loaders, self.test_loaders = prepare_data(args, device)
 
 
     def train(self):
         # Training
         max_acc = 0
         min_loss = 10000
-        for r in range(1, self.args.iters + 1):
+        for r in range(self.start_round, self.args.iters + 1):
             print("============ Train epoch {} ============".format(r))
             logfile.write("============ Train epoch {} ============\n".format(r))
+            profiler.start_round(r)
             local_models = {}
 
             avg_loss = Averager()
+            if self.sim:
+                self.sim.start_round()
+            self.meter.start_round(r)
             # all_per_accs = []
             for client in range(self.clients):
-                # to cuda
-                if self.args.cuda is True:
-                    self.client_models[client].cuda()
-
-                local_model, per_acc, loss = self.update_local(
-                    r=r,
-                    model=copy.deepcopy(self.model),
-                    local_model=copy.deepcopy(self.client_models[client]),
-                    train_loader=self.train_loaders[client],
-                    test_loader=self.test_loaders[client],
-                )
+                self.client_models.prefetch(client + 1)
+                with on_client(client):
+                    with phase('broadcast'):
+                        prev_model = copy.deepcopy(self.model)
+                        if client in self.client_models:
+                            prev_model.load_state_dict(self.client_models.get(client))
+                        global_copy = copy.deepcopy(self.model)
+
+                    local_model, per_acc, loss = self.update_local(
+                        r=r,
+                        model=global_copy,
+                        local_model=prev_model,
+                        train_loader=self.train_loaders[client],
+                        test_loader=self.test_loaders[client],
+                    )
                 print(' client {}| Loss: {:.4f} | Test  Acc: {:.4f}'.format(client, loss, per_acc))
                 logfile.write(
                     ' client {}| Loss: {:.4f} | Test  Acc: {:.4f}\n'.format(client, loss, per_acc))
-                local_models[client] = copy.deepcopy(local_model)
+                runlog.metric(r, client, 'train', loss=loss)
+                runlog.metric(r, client, 'test', acc=per_acc)
+                # one contiguous copy of the state instead of a deepcopy of the module
+                local_models[client] = FlatState.from_state(local_model.state_dict())
 
                 # update local model
-                self.client_models[client] = copy.deepcopy(local_model)
+                self.client_models.put(client, local_model.state_dict())
+                self.meter.add(client, 'down', self.model.state_dict())
+                self.meter.add(client, 'up', local_models[client])
+                if self.sim:
+                    self.sim.add_transfer(client, self.meter.client_bytes(client, 'down'), self.meter.client_bytes(client, 'up'))
+                    self.sim.add_compute(client, self.args.wk_iters * len(self.train_loaders[client]) + 1)
 
                 avg_loss.add(loss)
                 if per_acc > max_acc:
                     max_acc = per_acc
                     min_loss = loss
 
-            self.update_global(
-                r=r,
-                global_model=self.model,
-                local_models=local_models,
-            )
+            weights = None
+            if self.sim:
+                weights = apply_credits([1 / self.clients for _ in range(self.clients)], self.sim.end_round())
+            if memory:
+                memory.snapshot('train', {'client uploads': local_models})
+
+            with phase('aggregate'):
+                self.update_global(
+                    r=r,
+                    global_model=self.model,
+                    local_models=local_models,
+                    weights=weights,
+                )
+            down, up, total = self.meter.end_round()
+            print(self.meter.log_line(down, up, total))
+            logfile.write(self.meter.log_line(down, up, total) + '\n')
 
             print(' server  | Loss: {:.4f} | Test  Acc: {:.4f}'.format( min_loss, max_acc))
-            logfile.write(' server  | Loss: {:.4f} | Test  Acc: {:.4f}'.format( min_loss, max_acc))
+            logfile.write(' server  | Loss: {:.4f} | Test  Acc: {:.4f}\n'.format( min_loss, max_acc))
+            runlog.metric(r, SERVER, 'train', loss=min_loss)
+            runlog.metric(r, SERVER, 'test', acc=max_acc)
+            if self.sim:
+                print(self.sim.log_line())
+                logfile.write(self.sim.log_line() + '\n')
+            stats = self.client_models.stats()
+            print(' store   | hits: {} | misses: {} | spilled: {:.2f} MB'.format(stats['hits'], stats['misses'], stats['bytes_spilled'] / 2**20))
+            logfile.write(' store   | hits: {} | misses: {} | spilled: {:.2f} MB\n'.format(stats['hits'], stats['misses'], stats['bytes_spilled'] / 2**20))
+            if self.checkpointer.due(r - 1, last=r == self.args.iters):
+                self.checkpointer.save(self.checkpoint_state(r))
+            if profiler.end_round():
+                print(profiler.table())
+                logfile.write(profiler.table() + '\n')
+            if memory:
+                print(memory.table())
+                logfile.write(memory.table() + '\n')
 
 
     def update_local(self, r, model, local_model, train_loader, test_loader):
@@ -169,42 +255,51 @@ class MOON():
             
 
             model.train()
-            try:
-                batch_x, batch_y = loader_iter.next()
-            except Exception:
-                loader_iter = iter(train_loader)
-                batch_x, batch_y = loader_iter.next()
+            with phase('data'):
+                try:
+                    batch_x, batch_y = next(loader_iter)
+                except StopIteration:
+                    # the next pass over the client's data
+                    loader_iter = iter(train_loader)
+                    batch_x, batch_y = next(loader_iter)
 
-            if self.args.cuda:
-                batch_x, batch_y = batch_x.cuda(), batch_y.cuda()
+                if self.args.cuda:
+                    batch_x, batch_y = batch_x.cuda(), batch_y.cuda()
             #print(batch_x.shape)
-            hs, logits = model(batch_x)
-            hs1, _ = glo_model(batch_x)
-            hs0, _ = local_model(batch_x)
-
-            criterion = nn.CrossEntropyLoss()
-            ce_loss = criterion(logits, batch_y.long())
-
-            # moon loss
-            ct_loss = self.contrastive_loss(
-                hs, hs0.detach(), hs1.detach()
-            )
+            with phase('forward'):
+                hs, logits = model(batch_x)
+
+                criterion = nn.CrossEntropyLoss()
+                ce_loss = criterion(logits, batch_y.long())
+
+            # moon loss, with the extra forward passes of the global and the previous model
+            with phase('contrastive'):
+                hs1, _ = glo_model(batch_x)
+                hs0, _ = local_model(batch_x)
+                ct_loss = self.contrastive_loss(
+                    hs, hs0.detach(), hs1.detach()
+                )
 
-            loss = ce_loss + self.args.reg_lamb * ct_loss
+                loss = ce_loss + self.args.reg_lamb * ct_loss
 
-            optimizer.zero_grad()
-            loss.backward()
-            nn.utils.clip_grad_norm_(
-                model.parameters(), self.args.max_grad_norm
-            )
-            optimizer.step()
+            with phase('backward'):
+                optimizer.zero_grad()
+                loss.backward()
+                nn.utils.clip_grad_norm_(
+                    model.parameters(), self.args.max_grad_norm
+                )
+            with phase('step'):
+                optimizer.step()
+            count('batches')
+            count('samples', batch_y.size(0))
 
             avg_loss.add(loss.item())
 
-        per_acc = self.test(
-                model=model,
-                loader=test_loader,
-            )
+        with phase('eval'):
+            per_acc = self.test(
+                    model=model,
+                    loader=test_loader,
+                )
         loss = avg_loss.item()
         return model, per_acc, loss
 
@@ -221,20 +316,20 @@ class MOON():
         ct_loss = criterion(sims, labels)
         return ct_loss
 
-    def update_global(self, r, global_model, local_models):
+    def update_global(self, r, global_model, local_models, weights=None):
         mean_state_dict = {}
 
         for name, param in global_model.state_dict().items():
             vs = []
             for client in local_models.keys():
-                vs.append(local_models[client].state_dict()[name])
+                vs.append(local_models[client][name])
             vs = torch.stack(vs, dim=0)
 
             try:
-                mean_value = vs.mean(dim=0)
+                mean_value = weighted_mean(vs, weights)
             except Exception:
                 # for BN's cnt
-                mean_value = (1.0 * vs).mean(dim=0).long()
+                mean_value = weighted_mean(1.0 * vs, weights).long()
             mean_state_dict[name] = mean_value
 
         global_model.load_state_dict(mean_state_dict, strict=False)
@@ -256,10 +351,28 @@ class MOON():
         acc = acc_avg.item()
         return acc
 
-        def save_checkpoints(self, fpath):
-            torch.save({
-                'server_model': self.model.state_dict(),
-            }, fpath)
+    def checkpoint_state(self, r):
+        return {
+            'a_iter': r - 1,
+            'server_model': self.model.state_dict(),
+            'client_models': self.client_models,
+            'rng': rng_state(),
+        }
+
+    def load_checkpoint(self, checkpoint):
+        self.model.load_state_dict(checkpoint['server_model'])
+        self.client_models.restore(checkpoint.get('client_models', {}))
+        if 'rng' in checkpoint:
+            set_rng_state(checkpoint['rng'])
+        self.start_round = int(checkpoint['a_iter']) + 2
+        print('Resume training from epoch {}'.format(self.start_round))
+
+    def save_checkpoints(self, fpath):
+        # the rounds are checkpointed by the background writer, wait for the last one
+        print(' Saving checkpoints to {}...'.format(fpath))
+        self.checkpointer.close()
+        print(self.checkpointer.log_line())
+        logfile.write(self.checkpointer.log_line() + '\n')
 
 if __name__ == '__main__':
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -274,6 +387,12 @@ if __name__ == '__main__':
     if not os.path.exists(log_path):
         os.makedirs(log_path)
     logfile = open(os.path.join(log_path,'{}_{}_{}_{}.log'.format(args.mode ,args.dataset,args.skew,args.nclient)), 'w')
+    runlog = RunLog(logfile.name)
+    timeline = Timeline() if args.trace else None
+    memory = MemoryProfiler(runlog, args.profile_memory_top, args.profile_memory_lines) if args.profile_memory else None
+    profiler = Profiler(args.profile, args.profile_sync, args.profile_round,
+                        os.path.splitext(logfile.name)[0] + '.torch.json', runlog, timeline, memory)
+    set_profiler(profiler)
     
     logfile.write('==={}===\n'.format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
     logfile.write('===Setting===\n')
@@ -285,14 +404,37 @@ if __name__ == '__main__':
     if not os.path.exists(args.save_path):
         os.makedirs(args.save_path)
     SAVE_PATH = os.path.join(args.save_path, '{}_{}_{}.bin'.format(args.mode,args.dataset,args.skew))
+    SAVE_PATH = checkpoint_path(SAVE_PATH, args.ckpt_format)
     server_model = eval(args.model)().to(device)
     
-    if args.resume:
-        checkpoint = torch.load(SAVE_PATH)
-        server_model.load_state_dict(checkpoint['server_model'])
     moon = MOON(server_model, args)
+    if memory:
+        memory.track('datasets', lambda: (moon.train_loaders, moon.test_loaders))
+        memory.track('client models', lambda: (moon.model, moon.client_models))
+    if args.resume:
+        moon.load_checkpoint(load_checkpoint(SAVE_PATH))
     moon.train()
     moon.save_checkpoints(SAVE_PATH)
+    moon.client_models.close()
+    if moon.sim:
+        print(moon.sim.summary_line())
+        logfile.write(moon.sim.summary_line() + '\n')
+    if args.profile:
+        print(profiler.summary_lines())
+        logfile.write(profiler.summary_lines() + '\n')
+        profiler.save_summary(os.path.splitext(logfile.name)[0] + '.profile.json')
+    if memory:
+        print(memory.summary_lines())
+        logfile.write(memory.summary_lines() + '\n')
+        memory.save_summary(os.path.splitext(logfile.name)[0] + '.memory.json')
+        memory.close()
+    if args.prefetch:
+        print(prefetch_summary())
+        logfile.write(prefetch_summary() + '\n')
+        runlog.write('prefetch', **prefetch_stats())
+    if timeline:
+        timeline.save(os.path.splitext(logfile.name)[0] + '.trace.json')
+    runlog.close()
     logfile.flush()
     logfile.close()
 
@@ -50,14 +50,22 @@ import torchvision.transforms as transforms
 from models.digit import DigitModel
 from models.resnet import *
 from skew import label_skew_across_labels, label_skew_by_within_labels, quantity_skew, feature_skew_noise, feature_skew_filter, prepare_data
+from datafiles.prefetch import summary_line as prefetch_summary, stats as prefetch_stats
 from datafiles.loaders import dset2loader
 from datafiles.utils import setseed
 from datafiles.preprocess import preprocess
 from tr_utils import train, train_fedprox
+from simulate import HeteroSimulator, apply_credits
+from comm_cost import CommMeter
+from runlog import RunLog, SERVER
+from checkpoint import AsyncCheckpointer, checkpoint_path, load_checkpoint, rng_state, set_rng_state
+from profiler import Profiler, set_profiler, phase, count, on_client
+from timeline import Timeline
+from memprof import MemoryProfiler
 
 
-# for GPU server selection
-os.environ['CUDA_VISIBLE_DEVICES']='1'
+# for GPU server selection, a launcher (sweep.py) may choose another one
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '1')
 
 
 parser = argparse.ArgumentParser()
@@ -73,8 +81,15 @@ parser.add_argument('--save_path', type=str, default='./checkpoint', help='path
 parser.add_argument('--load_path', type=str, default='./checkpoint', help='path to save the checkpoint')
 parser.add_argument('--log_path', type=str, default='./logs/', help='path to save the checkpoint')
 parser.add_argument('--resume', action='store_true', help='resume training from the save path checkpoint')
+parser.add_argument('--save_every', type=int, default=1, help='checkpoint every k rounds in the background, 0 only after the last one')
+parser.add_argument('--ckpt_format', type=str, default='sharded', help='| sharded | single |, sharded: a manifest plus one file per client, unchanged ones shared across rounds')
 parser.add_argument('--model', type=str, default="DigitModel", help = 'model used:| DigitModel | resnet20 | resnet32 | resnet44 | resnet56 | resnet110 | resnet1202 |')
-parser.add_argument('--dataset', type=str, default="mnist", help = '| mnist | kmnist | svhn | cifar10 |')
+parser.add_argument('--dataset', type=str, default="mnist", help = '| mnist | kmnist | svhn | cifar10 | synth_mnist | synth_cifar10 |')
+parser.add_argument('--synth_size', type=int, default=0, help='training samples of the synth_* datasets (--nlabel classes, drawn from --seed), 0 for the size of the real one')
+parser.add_argument('--augment', type=str, default='off', help='batch augmentation of the training data: | off | on (the dataset\'s defaults) | comma separated crop,flip,cutout |')
+parser.add_argument('--augment_pad', type=int, default=4, help='padding of the random crop')
+parser.add_argument('--cutout', type=int, default=8, help='side of the cutout square')
+parser.add_argument('--prefetch', type=int, default=0, help='training batches prepared ahead on a background thread (moved to the device, augmented), 0 for none')
 parser.add_argument('--skew', type=str, default='none', help='| none | quantity | feat_filter | feat_noise | label_across | label_within |')
 parser.add_argument('--noise_std', type=float, default=0.5, help='noise level for gaussion noise')
 parser.add_argument('--filter_sz', type=int, default=3, help='filter size for filter')
@@ -87,12 +102,25 @@ parser.add_argument('--overlap', type=bool, default=True, help='If lskew_across
 parser.add_argument('--nlabel', type=int, default=10, help='number of label for dirichlet label skew')
 parser.add_argument('--nclient', type=int, default=5, help='client number')
 parser.add_argument('--seed', type=int, default=400, help='random seed')
+parser.add_argument('--sim', action='store_true', help='simulate client speeds and bandwidths on a virtual clock')
+parser.add_argument('--sim_speed', type=str, default='lognormal:0,0.5', help='distribution of client compute speeds, e.g. const:1 | uniform:0.5,2 | lognormal:0,0.5')
+parser.add_argument('--sim_bandwidth', type=str, default='lognormal:2,0.5', help='distribution of client bandwidths in MB/s')
+parser.add_argument('--sim_batch_time', type=float, default=0.05, help='virtual seconds per batch of a client with speed 1')
+parser.add_argument('--sim_deadline', type=float, default=0., help='round deadline in virtual seconds, 0 waits for every client')
+parser.add_argument('--sim_late', type=str, default='drop', help='what happens to clients missing the deadline: | drop | partial |')
+parser.add_argument('--profile', action='store_true', help='time the phases of every round (data, forward, backward, step, aggregate, eval, ...)')
+parser.add_argument('--profile_round', type=int, default=-1, help='also run torch.profiler over this round, its Chrome trace goes next to the log')
+parser.add_argument('--profile_sync', action='store_true', help='wait for the GPU at the end of every phase, slower but GPU time goes to the right phase')
+parser.add_argument('--trace', action='store_true', help='write a Chrome trace (Perfetto) of the client and server phases next to the log')
+parser.add_argument('--profile_memory', action='store_true', help='record peak RSS / CUDA memory per phase and live tensor bytes per category every round')
+parser.add_argument('--profile_memory_top', type=int, default=3, help='top allocators flagged per round')
+parser.add_argument('--profile_memory_lines', type=int, default=0, help='also flag the source lines allocating most per round (tracemalloc, slow), 0 off')
 
 args = parser.parse_args()
 
 print(f"args: {args}")
 
-assert(args.dataset in ['svhn', 'cifar10', 'mnist', 'kmnist'])
+assert(args.dataset in ['svhn', 'cifar10', 'mnist', 'kmnist', 'synth_mnist', 'synth_cifar10'])
 assert(args.skew in ['none', 'quantity', 'feat_filter', 'feat_noise', 'label_across', 'label_within'])
 assert(args.mode in ['fedavg', 'fedprox', 'fedbn', 'perfedavg', 'pfedme'])
 
@@ -122,7 +150,8 @@ def test(model, test_loader, loss_fun, device):
 
 ################# Key Function ########################
 def communication(args, server_model, models, client_weights):
-    with torch.no_grad():
+    # the copies back into the client models are the broadcast
+    with torch.no_grad(), phase('aggregate'):
         # aggregate params
         if args.mode.lower() == 'fedbn':
             for key in server_model.state_dict().keys():
@@ -156,40 +185,48 @@ def train_perfedavg(model, train_loader, optimizer, loss_fun, device):
     train_iter = iter(train_loader)
 
     for step in range(len(train_iter)):
-        X, y = next(train_iter)
+        with phase('data'):
+            X, y = next(train_iter)
 
         final_model = copy.deepcopy(model)
 
-        X = X.to(device).float()
-        y = y.to(device).long()
-
-        y_pred = model(X)
-        loss_function = loss_fun
-        loss = loss_function(y_pred, y)
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-
-        # get grad of loss
-        y_pred = model(X)
-        loss_function = loss_fun
-        loss = loss_function(y_pred, y)
-        loss.backward()
-
-        y_pred = model(X)
-        loss_function = loss_fun
-        loss = loss_function(y_pred, y)
-        grads = torch.autograd.grad(loss, model.parameters(),allow_unused=True)
-        for param, grad in zip(final_model.parameters(), grads):
-            param.data.sub_(args.PerFedAvg_alpha * grad)
-
-        y_pred = model(X)
-        loss_function = loss_fun
-        loss = loss_function(y_pred, y)
-        grads = torch.autograd.grad(loss, model.parameters(),allow_unused=True)
-        for param, grad in zip(final_model.parameters(), grads):
-            param.data.sub_(args.PerFedAvg_beta * grad)
+        with phase('data'):
+            X = X.to(device).float()
+            y = y.to(device).long()
+
+        with phase('forward'):
+            y_pred = model(X)
+            loss_function = loss_fun
+            loss = loss_function(y_pred, y)
+        with phase('backward'):
+            optimizer.zero_grad()
+            loss.backward()
+        with phase('step'):
+            optimizer.step()
+        count('batches')
+        count('samples', y.size(0))
+
+        # the meta update: the gradients after the step, applied to final_model
+        with phase('meta'):
+            # get grad of loss
+            y_pred = model(X)
+            loss_function = loss_fun
+            loss = loss_function(y_pred, y)
+            loss.backward()
+
+            y_pred = model(X)
+            loss_function = loss_fun
+            loss = loss_function(y_pred, y)
+            grads = torch.autograd.grad(loss, model.parameters(),allow_unused=True)
+            for param, grad in zip(final_model.parameters(), grads):
+                param.data.sub_(args.PerFedAvg_alpha * grad)
+
+            y_pred = model(X)
+            loss_function = loss_fun
+            loss = loss_function(y_pred, y)
+            grads = torch.autograd.grad(loss, model.parameters(),allow_unused=True)
+            for param, grad in zip(final_model.parameters(), grads):
+                param.data.sub_(args.PerFedAvg_beta * grad)
 
 
         model = copy.deepcopy(final_model)
@@ -204,37 +241,46 @@ def train_pFedMe(model, train_loader, optimizer, loss_fun, device):
     train_iter = iter(train_loader)
 
     for step in range(len(train_iter)):
-        X, y = next(train_iter)
+        with phase('data'):
+            X, y = next(train_iter)
         local_model = copy.deepcopy(model)
         final_model = copy.deepcopy(model)
-        X = X.to(device).float()
-        y = y.to(device).long()
+        with phase('data'):
+            X = X.to(device).float()
+            y = y.to(device).long()
         
         optimizer.zero_grad()
-        y_pred = model(X)
-        loss_function = loss_fun
-        loss = loss_function(y_pred, y)
-        loss.backward()
-        optimizer.step()
-
-
-        y_pred = model(X)
-        loss_function = loss_fun
-        loss = loss_function(y_pred, y)
-        grads = torch.autograd.grad(loss, model.parameters(),allow_unused=True)
-        for param, grad in zip(final_model.parameters(), grads):
-            param.data.sub_(args.PerFedAvg_alpha * grad)
-
-        y_pred = model(X)
-        loss_function = loss_fun
-        loss = loss_function(y_pred, y)
-        grads = torch.autograd.grad(loss, model.parameters(),allow_unused=True)
-        for param, grad in zip(final_model.parameters(), grads):
-            param.data.sub_(args.PerFedAvg_beta * grad)
-
-
-        for new_param, localweight in zip(final_model.parameters(), local_model.parameters()):
-            localweight.data = localweight.data - args.pFedMe_lamda * args.pFedMe_alpha * (localweight.data - new_param.data)
+        with phase('forward'):
+            y_pred = model(X)
+            loss_function = loss_fun
+            loss = loss_function(y_pred, y)
+        with phase('backward'):
+            loss.backward()
+        with phase('step'):
+            optimizer.step()
+        count('batches')
+        count('samples', y.size(0))
+
+
+        # the personalized update and the moreau envelope step of the local weights
+        with phase('meta'):
+            y_pred = model(X)
+            loss_function = loss_fun
+            loss = loss_function(y_pred, y)
+            grads = torch.autograd.grad(loss, model.parameters(),allow_unused=True)
+            for param, grad in zip(final_model.parameters(), grads):
+                param.data.sub_(args.PerFedAvg_alpha * grad)
+
+            y_pred = model(X)
+            loss_function = loss_fun
+            loss = loss_function(y_pred, y)
+            grads = torch.autograd.grad(loss, model.parameters(),allow_unused=True)
+            for param, grad in zip(final_model.parameters(), grads):
+                param.data.sub_(args.PerFedAvg_beta * grad)
+
+
+            for new_param, localweight in zip(final_model.parameters(), local_model.parameters()):
+                localweight.data = localweight.data - args.pFedMe_lamda * args.pFedMe_alpha * (localweight.data - new_param.data)
 
         model = copy.deepcopy(final_model)
 
@@ -257,6 +303,12 @@ if __name__ == '__main__':
     if not os.path.exists(log_path):
         os.makedirs(log_path)
     logfile = open(os.path.join(log_path,'{}_{}_{}_{}.log'.format(args.mode ,args.dataset,args.skew,args.nclient)), 'w')
+    runlog = RunLog(logfile.name)
+    timeline = Timeline() if args.trace else None
+    memory = MemoryProfiler(runlog, args.profile_memory_top, args.profile_memory_lines) if args.profile_memory else None
+    profiler = Profiler(args.profile, args.profile_sync, args.profile_round,
+                        os.path.splitext(logfile.name)[0] + '.torch.json', runlog, timeline, memory)
+    set_profiler(profiler)
     logfile.write('==={}===\n'.format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
     logfile.write('===Setting===\n')
     logfile.write('    lr: {}\n'.format(args.lr))
@@ -267,13 +319,14 @@ if __name__ == '__main__':
     if not os.path.exists(args.save_path):
         os.makedirs(args.save_path)
     SAVE_PATH = os.path.join(args.save_path, '{}_{}_{}.bin'.format(args.mode,args.dataset,args.skew))
+    SAVE_PATH = checkpoint_path(SAVE_PATH, args.ckpt_format)
    
    
     server_model = eval(args.model)().to(device)
     loss_fun = nn.CrossEntropyLoss()
 
     # prepare the data
-    train_loaders, test_loaders = prepare_data(args)
+    train_loaders, test_loaders = prepare_data(args, device)
     
 
     # federated setting
@@ -282,88 +335,156 @@ if __name__ == '__main__':
     models = [copy.deepcopy(server_model).to(device) for idx in range(client_num)]
 
     if args.resume:
-        checkpoint = torch.load(SAVE_PATH)
+        checkpoint = load_checkpoint(SAVE_PATH)
         server_model.load_state_dict(checkpoint['server_model'])
-        if args.mode.lower()=='fedbn':
-            for client_idx in range(client_num):
-                models[client_idx].load_state_dict(checkpoint['model_{}'.format(client_idx)])
-        else:
-            for client_idx in range(client_num):
-                models[client_idx].load_state_dict(checkpoint['server_model'])
+        for client_idx in range(client_num):
+            # older checkpoints only kept the client models of fedbn
+            models[client_idx].load_state_dict(checkpoint.get('model_{}'.format(client_idx), checkpoint['server_model']))
+        if 'rng' in checkpoint:
+            set_rng_state(checkpoint['rng'])
         resume_iter = int(checkpoint['a_iter']) + 1
         print('Resume training from epoch {}'.format(resume_iter))
     else:
         resume_iter = 0
 
 
+    sim = None
+    if args.sim:
+        sim = HeteroSimulator(client_num, args.sim_speed, args.sim_bandwidth, args.sim_batch_time,
+                              args.sim_deadline, args.sim_late, args.seed)
+    meter = CommMeter(server_model, runlog)
+    checkpointer = AsyncCheckpointer(SAVE_PATH, args.save_every, args.ckpt_format)
+    # what goes over the wire each way, FedBN keeps BN local
+    keys = list(server_model.state_dict().keys())
+    if args.mode.lower() == 'fedbn':
+        keys = [key for key in keys if 'bn' not in key]
+    if memory:
+        memory.track('datasets', lambda: (train_loaders, test_loaders))
+        memory.track('client models', lambda: (server_model, models))
+        memory.track('optimizer state', lambda: optimizers)
     # start training
     for a_iter in range(resume_iter, args.iters):
 
         #
+        profiler.start_round(a_iter)
         optimizers = [optim.SGD(params=models[idx].parameters(), lr=args.lr) for idx in range(client_num)]
         samples = [0 for i in range(client_num)]
         total = 0
+        meter.start_round(a_iter)
+        for client_idx in range(client_num):
+            meter.add(client_idx, 'down', server_model.state_dict(), keys=keys)
+        if sim:
+            sim.start_round()
+            for client_idx in range(client_num):
+                # uploads are the same keys, uncompressed
+                sim.add_transfer(client_idx, meter.client_bytes(client_idx, 'down'), meter.client_bytes(client_idx, 'down'))
         for wi in range(args.wk_iters):
             print("============ Train epoch {} ============".format(wi + a_iter * args.wk_iters))
             logfile.write("============ Train epoch {} ============\n".format(wi + a_iter * args.wk_iters)) 
             
             for client_idx in range(client_num):
                 model, train_loader, optimizer = models[client_idx], train_loaders[client_idx], optimizers[client_idx]
-                if args.mode.lower() == 'perfedavg':
-                    print('perfedavg')
-                    train_perfedavg(model, train_loader, optimizer, loss_fun, device)
-                if args.mode.lower() == 'pfedme':
-                    print("pFedMe")
-                    train_pFedMe(model, train_loader, optimizer, loss_fun, device)
-
-
-                if args.mode.lower() == 'fedprox':
-                    if a_iter > 0:
-                        train_fedprox(args, model, server_model, train_loader, optimizer, loss_fun, client_num, device)
+                with on_client(client_idx):
+                    if args.mode.lower() == 'perfedavg':
+                        print('perfedavg')
+                        train_perfedavg(model, train_loader, optimizer, loss_fun, device)
+                    if args.mode.lower() == 'pfedme':
+                        print("pFedMe")
+                        train_pFedMe(model, train_loader, optimizer, loss_fun, device)
+
+
+                    if args.mode.lower() == 'fedprox':
+                        if a_iter > 0:
+                            train_fedprox(args, model, server_model, train_loader, optimizer, loss_fun, client_num, device)
+                        else:
+                            train(model, train_loader, optimizer, loss_fun, client_num, device)
                     else:
+                        if args.mode.lower() == 'fedavg':
+                            samples[client_idx] += len(train_loader)
+                            total += len(train_loader)
                         train(model, train_loader, optimizer, loss_fun, client_num, device)
-                else:
-                    if args.mode.lower() == 'fedavg':
-                        samples[client_idx] += len(train_loader)
-                        total += len(train_loader)
-                    train(model, train_loader, optimizer, loss_fun, client_num, device)
-         
+                if sim:
+                    sim.add_compute(client_idx, len(train_loader))
+
+        if memory:
+            memory.snapshot('train')
         # aggregation
         if args.mode.lower() == 'fedavg':
             client_weights = [samples[i]/total for i in range(client_num)]
-        server_model, models = communication(args, server_model, models, client_weights)
+        for client_idx in range(client_num):
+            meter.add(client_idx, 'up', models[client_idx].state_dict(), keys=keys)
+        round_weights = client_weights
+        if sim:
+            round_weights = apply_credits(client_weights, sim.end_round())
+        server_model, models = communication(args, server_model, models, round_weights)
+        down, up, total = meter.end_round()
+        print(meter.log_line(down, up, total))
+        logfile.write(meter.log_line(down, up, total) + '\n')
 
         min_test_loss = 1000
         max_test_acc = 0
         # report after aggregation
         for client_idx in range(client_num):
                 model, train_loader, optimizer = models[client_idx], train_loaders[client_idx], optimizers[client_idx]
-                train_loss, train_acc = test(model, train_loader, loss_fun, device) 
+                with on_client(client_idx), phase('eval'):
+                    train_loss, train_acc = test(model, train_loader, loss_fun, device)
                 print(' client {}| Train Loss: {:.4f} | Train Acc: {:.4f}'.format(client_idx ,train_loss, train_acc))
-                logfile.write(' client {}| Train Loss: {:.4f} | Train Acc: {:.4f}\n'.format(client_idx ,train_loss, train_acc))\
+                logfile.write(' client {}| Train Loss: {:.4f} | Train Acc: {:.4f}\n'.format(client_idx ,train_loss, train_acc))
+                runlog.metric(a_iter, client_idx, 'train', loss=train_loss, acc=train_acc)
 
         # start testing
         for test_idx, test_loader in enumerate(test_loaders):
-            test_loss, test_acc = test(models[test_idx], test_loader, loss_fun, device)
+            with on_client(test_idx), phase('eval'):
+                test_loss, test_acc = test(models[test_idx], test_loader, loss_fun, device)
             print(' client {}| Test  Loss: {:.4f} | Test  Acc: {:.4f}'.format(test_idx, test_loss, test_acc))
             logfile.write(' client {}| Test  Loss: {:.4f} | Test  Acc: {:.4f}\n'.format(test_idx, test_loss, test_acc))
+            runlog.metric(a_iter, test_idx, 'test', loss=test_loss, acc=test_acc)
             if test_acc > max_test_acc:
                 server_model = models[test_idx]
                 max_test_acc = test_acc
                 min_test_loss = test_loss
         print(' server | Test  Loss: {:.4f} | Test  Acc: {:.4f}'.format(min_test_loss, max_test_acc))
         logfile.write(' server | Test  Loss: {:.4f} | Test  Acc: {:.4f}\n'.format(min_test_loss, max_test_acc))
+        runlog.metric(a_iter, SERVER, 'test', loss=min_test_loss, acc=max_test_acc)
+        if sim:
+            print(sim.log_line())
+            logfile.write(sim.log_line() + '\n')
+        # every client model, the personalized ones differ from the server
+        if checkpointer.due(a_iter, last=a_iter == args.iters - 1):
+            dic = {'model_{}'.format(num): models[num].state_dict() for num in range(client_num)}
+            dic.update({'a_iter': a_iter, 'server_model': server_model.state_dict(), 'rng': rng_state()})
+            checkpointer.save(dic)
+        if profiler.end_round():
+            print(profiler.table())
+            logfile.write(profiler.table() + '\n')
+        if memory:
+            print(memory.table())
+            logfile.write(memory.table() + '\n')
         logfile.flush()
 
-    # Save checkpoint
+    # the last round's checkpoint may still be writing
     print(' Saving checkpoints to {}...'.format(SAVE_PATH))
-    if args.mode.lower() == 'fedbn':
-        dic = {'model_{}'.format(num):models[num].state_dict() for num in range(client_num)}
-        dic.update({'server_model': server_model.state_dict()})
-        torch.save(dic, SAVE_PATH)
-    else:
-        torch.save({
-            'server_model': server_model.state_dict(),
-        }, SAVE_PATH)
+    checkpointer.close()
+    print(checkpointer.log_line())
+    logfile.write(checkpointer.log_line() + '\n')
+    if sim:
+        print(sim.summary_line())
+        logfile.write(sim.summary_line() + '\n')
+    if args.profile:
+        print(profiler.summary_lines())
+        logfile.write(profiler.summary_lines() + '\n')
+        profiler.save_summary(os.path.splitext(logfile.name)[0] + '.profile.json')
+    if memory:
+        print(memory.summary_lines())
+        logfile.write(memory.summary_lines() + '\n')
+        memory.save_summary(os.path.splitext(logfile.name)[0] + '.memory.json')
+        memory.close()
+    if args.prefetch:
+        print(prefetch_summary())
+        logfile.write(prefetch_summary() + '\n')
+        runlog.write('prefetch', **prefetch_stats())
+    if timeline:
+        timeline.save(os.path.splitext(logfile.name)[0] + '.trace.json')
+    runlog.close()
     logfile.flush()
     logfile.close()
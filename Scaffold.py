@@ -11,13 +11,25 @@ import torchvision.transforms as transforms
 from models.digit import DigitModel
 from models.resnet import *
 from skew import label_skew_across_labels, label_skew_by_within_labels, quantity_skew, feature_skew_noise, feature_skew_filter, prepare_data
+from datafiles.prefetch import summary_line as prefetch_summary, stats as prefetch_stats
 from datafiles.loaders import dset2loader
 from datafiles.utils import setseed
 from datafiles.preprocess import preprocess
 from tr_utils import train, train_fedprox
-
-# for GPU server selection
-os.environ['CUDA_VISIBLE_DEVICES']='1'
+from client_store import ClientStateStore
+from simulate import HeteroSimulator, apply_credits, weighted_mean
+from compress import UpdateCompressor
+from comm_cost import CommMeter
+from runlog import RunLog, SERVER
+from profiler import Profiler, set_profiler, phase, count, on_client
+from timeline import Timeline
+from memprof import MemoryProfiler
+from wire import FlatState
+from hierarchy import HierarchicalAggregator, reduce_clients
+from checkpoint import AsyncCheckpointer, checkpoint_path, load_checkpoint, rng_state, set_rng_state
+
+# for GPU server selection, a launcher (sweep.py) may choose another one
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '1')
 
 #
 # COURTESY: we referenced code from following link for experiment
@@ -37,8 +49,15 @@ parser.add_argument('--save_path', type=str, default='./checkpoint', help='path
 parser.add_argument('--load_path', type=str, default='./checkpoint', help='path to save the checkpoint')
 parser.add_argument('--log_path', type=str, default='./logs/', help='path to save the checkpoint')
 parser.add_argument('--resume', action='store_true',default=False, help='resume training from the save path checkpoint')
+parser.add_argument('--save_every', type=int, default=1, help='checkpoint every k rounds in the background, 0 only after the last one')
+parser.add_argument('--ckpt_format', type=str, default='sharded', help='| sharded | single |, sharded: a manifest plus one file per client, unchanged ones shared across rounds')
 parser.add_argument('--model', type=str, default="DigitModel", help = 'model used:| DigitModel | resnet20 | resnet32 | resnet44 | resnet56 | resnet110 | resnet1202 |')
-parser.add_argument('--dataset', type=str, default="mnist", help = '| mnist | kmnist | svhn | cifar10 |')
+parser.add_argument('--dataset', type=str, default="mnist", help = '| mnist | kmnist | svhn | cifar10 | synth_mnist | synth_cifar10 |')
+parser.add_argument('--synth_size', type=int, default=0, help='training samples of the synth_* datasets (--nlabel classes, drawn from --seed), 0 for the size of the real one')
+parser.add_argument('--augment', type=str, default='off', help='batch augmentation of the training data: | off | on (the dataset\'s defaults) | comma separated crop,flip,cutout |')
+parser.add_argument('--augment_pad', type=int, default=4, help='padding of the random crop')
+parser.add_argument('--cutout', type=int, default=8, help='side of the cutout square')
+parser.add_argument('--prefetch', type=int, default=0, help='training batches prepared ahead on a background thread (moved to the device, augmented), 0 for none')
 parser.add_argument('--skew', type=str, default='none', help='| none | quantity | feat_filter | feat_noise | label_across | label_within |')
 parser.add_argument('--noise_std', type=float, default=0.5, help='noise level for gaussion noise')
 parser.add_argument('--filter_sz', type=int, default=3, help='filter size for filter')
@@ -53,11 +72,32 @@ parser.add_argument('--weight_decay', type=int, default=0, help='test round')
 parser.add_argument('--cuda', type=bool, default=True, help='if cuda is available' )
 parser.add_argument('--max_grad_norm', type=float, default=1.0, help='max grad norm')
 parser.add_argument('--glo_lr', type=float, default=0.001, help='global learning rate')
+parser.add_argument('--store_capacity', type=int, default=0, help='client states kept in memory, the rest spill to disk, 0 keeps all')
+parser.add_argument('--store_path', type=str, default='./client_states', help='path to spill client states to')
+parser.add_argument('--sim', action='store_true', help='simulate client speeds and bandwidths on a virtual clock')
+parser.add_argument('--sim_speed', type=str, default='lognormal:0,0.5', help='distribution of client compute speeds, e.g. const:1 | uniform:0.5,2 | lognormal:0,0.5')
+parser.add_argument('--sim_bandwidth', type=str, default='lognormal:2,0.5', help='distribution of client bandwidths in MB/s')
+parser.add_argument('--sim_batch_time', type=float, default=0.05, help='virtual seconds per batch of a client with speed 1')
+parser.add_argument('--sim_deadline', type=float, default=0., help='round deadline in virtual seconds, 0 waits for every client')
+parser.add_argument('--sim_late', type=str, default='drop', help='what happens to clients missing the deadline: | drop | partial |')
+parser.add_argument('--compress', type=str, default='none', help='compression of client uploads: | none | topk | randk | q8 | q4 | sign |')
+parser.add_argument('--compress_ratio', type=float, default=0.01, help='share of entries kept by topk and randk')
+parser.add_argument('--no_ef', action='store_true', help='disable error feedback of the compressed uploads')
+parser.add_argument('--edges', type=int, default=0, help='edge aggregators between clients and server, 0 aggregates flat')
+parser.add_argument('--regions', type=int, default=0, help='regional aggregators between edges and server, 0 for two tiers')
+parser.add_argument('--edge_workers', type=int, default=0, help='threads running the edge aggregators, 0 runs them in turn')
+parser.add_argument('--profile', action='store_true', help='time the phases of every round (data, forward, backward, step, aggregate, eval, ...)')
+parser.add_argument('--profile_round', type=int, default=-1, help='also run torch.profiler over this round, its Chrome trace goes next to the log')
+parser.add_argument('--profile_sync', action='store_true', help='wait for the GPU at the end of every phase, slower but GPU time goes to the right phase')
+parser.add_argument('--trace', action='store_true', help='write a Chrome trace (Perfetto) of the client and server phases next to the log')
+parser.add_argument('--profile_memory', action='store_true', help='record peak RSS / CUDA memory per phase and live tensor bytes per category every round')
+parser.add_argument('--profile_memory_top', type=int, default=3, help='top allocators flagged per round')
+parser.add_argument('--profile_memory_lines', type=int, default=0, help='also flag the source lines allocating most per round (tracemalloc, slow), 0 off')
 args = parser.parse_args()
 
 # print(f"args: {args}")
 
-assert(args.dataset in ['svhn', 'cifar10', 'mnist', 'kmnist'])
+assert(args.dataset in ['svhn', 'cifar10', 'mnist', 'kmnist', 'synth_mnist', 'synth_cifar10'])
 assert(args.skew in ['none', 'quantity', 'feat_filter', 'feat_noise', 'label_across', 'label_within'])
 assert(args.mode in ['scaffold'])
 setseed(args.seed)
@@ -128,15 +168,42 @@ class Scaffold():
         self.clients = args.nclient
 
         # construct dataloaders
-        self.train_loaders, self.test_loaders = prepare_data(args)
+        self.train_loaders, self.test_loaders = prepare_data(args, device)
 
         # control variates
         self.server_control = self.init_control(model)
         self.set_control_cuda(self.server_control, True)
 
-        self.client_controls = {
-            client: self.init_control(model) for client in range(self.clients)
-        }
+        # a client without a stored control starts from zeros
+        self.client_controls = ClientStateStore(
+            args.store_capacity,
+            os.path.join(args.store_path, '{}_{}_{}'.format(args.mode, args.dataset, args.skew))
+        )
+
+        # delta_model uploads are compressed, error feedback residuals are client state too
+        self.compressor = None
+        if args.compress != 'none':
+            residuals = ClientStateStore(
+                args.store_capacity,
+                os.path.join(args.store_path, '{}_{}_{}_residuals'.format(args.mode, args.dataset, args.skew))
+            )
+            self.compressor = UpdateCompressor(args.compress, args.compress_ratio, not args.no_ef, residuals)
+
+        self.meter = CommMeter(model, runlog)
+
+        # every save_every rounds, written in the background
+        self.checkpointer = AsyncCheckpointer(SAVE_PATH, args.save_every, args.ckpt_format)
+        self.start_round = 1
+
+        # clients -> edges (-> regions) -> server
+        self.aggregator = None
+        if args.edges > 0:
+            self.aggregator = HierarchicalAggregator(args.edges, args.regions, args.edge_workers)
+
+        self.sim = None
+        if args.sim:
+            self.sim = HeteroSimulator(self.clients, args.sim_speed, args.sim_bandwidth, args.sim_batch_time,
+                                       args.sim_deadline, args.sim_late, args.seed)
 
     def set_control_cuda(self, control, cuda=True):
         for name in control.keys():
@@ -159,75 +226,136 @@ class Scaffold():
         # Training
         max_acc = 0
         min_loss = 10000
-        for r in range(1, self.args.max_round + 1):
+        for r in range(self.start_round, self.args.max_round + 1):
             print("============ Train epoch {} ============".format(r))
             logfile.write("============ Train epoch {} ============\n".format(r))
+            profiler.start_round(r)
             delta_models = {}
             delta_controls = {}
+            if self.sim:
+                self.sim.start_round()
+            self.meter.start_round(r)
 
             for client in range(self.clients):
-                # control to gpu
-                self.set_control_cuda(self.client_controls[client], True)
-                # update local with control variates / ScaffoldOptimizer
-                delta_model, per_acc, local_steps, loss = self.update_local(
-                    r=r,
-                    model=copy.deepcopy(self.model),
-                    train_loader=self.train_loaders[client],
-                    test_loader=self.test_loaders[client],
-                    server_control=self.server_control,
-                    client_control=self.client_controls[client],
-                )
-
-                print(' client {}| Loss: {:.4f} | Test  Acc: {:.4f}'.format(client, loss, per_acc))
-                logfile.write(
-                    ' client {}| Loss: {:.4f} | Test  Acc: {:.4f}\n'.format(client, loss, per_acc))
-
-                client_control, delta_control = self.update_local_control(
-                    delta_model=delta_model,
-                    server_control=self.server_control,
-                    client_control=self.client_controls[client],
-                    steps=local_steps,
-                    lr=self.args.lr,
-                )
-                self.client_controls[client] = copy.deepcopy(client_control)
-
-                delta_models[client] = copy.deepcopy(delta_model)
-                delta_controls[client] = copy.deepcopy(delta_control)
-
-                # control to cpu
-                self.set_control_cuda(self.client_controls[client], False)
+                self.client_controls.prefetch(client + 1)
+                with on_client(client):
+                    with phase('broadcast'):
+                        client_control = self.client_controls.get(client)
+                        if client_control is None:
+                            client_control = self.init_control(self.model)
+                        # control to gpu
+                        self.set_control_cuda(client_control, True)
+                        local_model = copy.deepcopy(self.model)
+                    # update local with control variates / ScaffoldOptimizer
+                    delta_model, per_acc, local_steps, loss = self.update_local(
+                        r=r,
+                        model=local_model,
+                        train_loader=self.train_loaders[client],
+                        test_loader=self.test_loaders[client],
+                        server_control=self.server_control,
+                        client_control=client_control,
+                    )
+
+                    print(' client {}| Loss: {:.4f} | Test  Acc: {:.4f}'.format(client, loss, per_acc))
+                    logfile.write(
+                        ' client {}| Loss: {:.4f} | Test  Acc: {:.4f}\n'.format(client, loss, per_acc))
+                    runlog.metric(r, client, 'train', loss=loss)
+                    runlog.metric(r, client, 'test', acc=per_acc)
+
+                    with phase('control'):
+                        client_control, delta_control = self.update_local_control(
+                            delta_model=delta_model,
+                            server_control=self.server_control,
+                            client_control=client_control,
+                            steps=local_steps,
+                            lr=self.args.lr,
+                        )
+                # the store keeps a cpu copy
+                self.client_controls.put(client, client_control)
+
+                # both deltas are fresh tensors already, no copy needed
+                if self.compressor:
+                    delta_models[client] = self.compressor.encode(client, delta_model)
+                else:
+                    delta_models[client] = delta_model
+                delta_controls[client] = delta_control
+
+                # weights and control variates go both ways
+                self.meter.add(client, 'down', self.model.state_dict())
+                self.meter.add(client, 'down', self.server_control, category='controls')
+                self.meter.add(client, 'up', delta_models[client])
+                self.meter.add(client, 'up', delta_control, category='controls')
+                if self.sim:
+                    self.sim.add_transfer(client, self.meter.client_bytes(client, 'down'), self.meter.client_bytes(client, 'up'))
+                    self.sim.add_compute(client, local_steps)
                 if per_acc > max_acc:
                     max_acc = per_acc
                     min_loss = loss
 
 
-            self.update_global(
-                r=r,
-                global_model=self.model,
-                delta_models=delta_models,
-            )
+            weights = None
+            if self.sim:
+                weights = apply_credits([1 / self.clients for _ in range(self.clients)], self.sim.end_round())
+            if memory:
+                memory.snapshot('train', {'client uploads': delta_models, 'control uploads': delta_controls})
 
-            new_control = self.update_global_control(
-                r=r,
-                control=self.server_control,
-                delta_controls=delta_controls,
-            )
+            with phase('aggregate'):
+                self.update_global(
+                    r=r,
+                    global_model=self.model,
+                    delta_models=delta_models,
+                    weights=weights,
+                )
 
-            self.server_control = copy.deepcopy(new_control)
+                new_control = self.update_global_control(
+                    r=r,
+                    control=self.server_control,
+                    delta_controls=delta_controls,
+                    weights=weights,
+                )
+
+                self.server_control = copy.deepcopy(new_control)
+            if self.aggregator:
+                print(self.aggregator.log_line())
+                logfile.write(self.aggregator.log_line() + '\n')
+            down, up, total = self.meter.end_round()
+            print(self.meter.log_line(down, up, total))
+            logfile.write(self.meter.log_line(down, up, total) + '\n')
 
             print(' server  | Loss: {:.4f} | Test  Acc: {:.4f}'.format(min_loss, max_acc))
-            logfile.write(' server  | Loss: {:.4f} | Test  Acc: {:.4f}'.format(min_loss, max_acc))
+            logfile.write(' server  | Loss: {:.4f} | Test  Acc: {:.4f}\n'.format(min_loss, max_acc))
+            runlog.metric(r, SERVER, 'train', loss=min_loss)
+            runlog.metric(r, SERVER, 'test', acc=max_acc)
+            if self.sim:
+                print(self.sim.log_line())
+                logfile.write(self.sim.log_line() + '\n')
+            if self.compressor:
+                ratio, sent = self.compressor.round_ratio()
+                print(' compress | Ratio: {:.2f}x | Sent: {:.2f} MB'.format(ratio, sent / 2**20))
+                logfile.write(' compress | Ratio: {:.2f}x | Sent: {:.2f} MB\n'.format(ratio, sent / 2**20))
+            stats = self.client_controls.stats()
+            print(' store   | hits: {} | misses: {} | spilled: {:.2f} MB'.format(stats['hits'], stats['misses'], stats['bytes_spilled'] / 2**20))
+            logfile.write(' store   | hits: {} | misses: {} | spilled: {:.2f} MB\n'.format(stats['hits'], stats['misses'], stats['bytes_spilled'] / 2**20))
+            if self.checkpointer.due(r - 1, last=r == self.args.max_round):
+                self.checkpointer.save(self.checkpoint_state(r))
+            if profiler.end_round():
+                print(profiler.table())
+                logfile.write(profiler.table() + '\n')
+            if memory:
+                print(memory.table())
+                logfile.write(memory.table() + '\n')
 
 
 
     def get_delta_model(self, model0, model1):
-        """ return a dict: {name: params}
+        """ return a FlatState: {name: params} in one contiguous buffer
         """
-        state_dict = {}
-        for name, param0 in model0.state_dict().items():
-            param1 = model1.state_dict()[name]
-            state_dict[name] = param0.detach() - param1.detach()
-        return state_dict
+        state0 = model0.state_dict()
+        state1 = model1.state_dict()
+        delta = FlatState.empty_like(state0)
+        for name, param0 in state0.items():
+            torch.sub(param0.detach(), state1[name].detach(), out=delta[name])
+        return delta
 
     def update_local(
             self, r, model, train_loader, test_loader,
@@ -253,30 +381,38 @@ class Scaffold():
         for t in range(n_total_bs):
 
             model.train()
-            try:
-                batch_x, batch_y = loader_iter.next()
-            except Exception:
-                loader_iter = iter(train_loader)
-                batch_x, batch_y = loader_iter.next()
+            with phase('data'):
+                try:
+                    batch_x, batch_y = next(loader_iter)
+                except StopIteration:
+                    # the next pass over the client's data
+                    loader_iter = iter(train_loader)
+                    batch_x, batch_y = next(loader_iter)
 
-            if self.args.cuda:
-                batch_x, batch_y = batch_x.cuda(), batch_y.cuda()
+                if self.args.cuda:
+                    batch_x, batch_y = batch_x.cuda(), batch_y.cuda()
 
-            logits = model(batch_x)
+            with phase('forward'):
+                logits = model(batch_x)
 
-            criterion = nn.CrossEntropyLoss()
-            loss = criterion(logits, batch_y.long())
+                criterion = nn.CrossEntropyLoss()
+                loss = criterion(logits, batch_y.long())
 
-            optimizer.zero_grad()
-            loss.backward()
-            nn.utils.clip_grad_norm_(
-                model.parameters(), self.args.max_grad_norm
-            )
+            with phase('backward'):
+                optimizer.zero_grad()
+                loss.backward()
+                nn.utils.clip_grad_norm_(
+                    model.parameters(), self.args.max_grad_norm
+                )
 
-            optimizer.step(
-                server_control=server_control,
-                client_control=client_control
-            )
+            # the control variates correct the step
+            with phase('step'):
+                optimizer.step(
+                    server_control=server_control,
+                    client_control=client_control
+                )
+            count('batches')
+            count('samples', batch_y.size(0))
 
             avg_loss.add(loss.item())
 
@@ -285,10 +421,11 @@ class Scaffold():
 
         loss = avg_loss.item()
         local_steps = n_total_bs
-        per_acc = self.test(
-            model=model,
-            loader=test_loader,
-        )
+        with phase('eval'):
+            per_acc = self.test(
+                model=model,
+                loader=test_loader,
+            )
 
         return delta_model, per_acc, local_steps, loss
 
@@ -308,9 +445,31 @@ class Scaffold():
             delta_control[name].data = ci.data - new_ci
         return new_control, delta_control
 
-    def update_global(self, r, global_model, delta_models):
+    def update_global(self, r, global_model, delta_models, weights=None):
         state_dict = {}
 
+        if self.compressor or self.aggregator:
+            # compressed uploads: decode straight into the weighted mean,
+            # edge aggregators: pre-reduce it per edge
+            if weights is None:
+                weights = [1 / len(delta_models) for _ in delta_models]
+            client_weights = dict(zip(delta_models.keys(), weights))
+
+            def contribute(acc, client):
+                if self.compressor:
+                    self.compressor.decode_add(acc, delta_models[client], client_weights[client])
+                else:
+                    for name in acc.keys():
+                        acc[name] += client_weights[client] * delta_models[client][name].float()
+            zeros = lambda: {
+                name: torch.zeros_like(param, dtype=torch.float32) for name, param in global_model.state_dict().items()
+            }
+            mean_values = reduce_clients(self.aggregator, list(delta_models.keys()), contribute, zeros)
+            for name, param in global_model.state_dict().items():
+                state_dict[name] = (param - self.args.glo_lr * mean_values[name]).to(param.dtype)
+            global_model.load_state_dict(state_dict, strict=True)
+            return
+
         for name, param in global_model.state_dict().items():
             vs = []
             for client in delta_models.keys():
@@ -318,11 +477,11 @@ class Scaffold():
             vs = torch.stack(vs, dim=0)
 
             try:
-                mean_value = vs.mean(dim=0)
+                mean_value = weighted_mean(vs, weights)
                 vs = param - self.args.glo_lr * mean_value
             except Exception:
                 # for BN's cnt
-                mean_value = (1.0 * vs).mean(dim=0).long()
+                mean_value = weighted_mean(1.0 * vs, weights).long()
                 vs = param - self.args.glo_lr * mean_value
                 vs = vs.long()
 
@@ -330,13 +489,26 @@ class Scaffold():
 
         global_model.load_state_dict(state_dict, strict=True)
 
-    def update_global_control(self, r, control, delta_controls):
+    def update_global_control(self, r, control, delta_controls, weights=None):
+        if self.aggregator:
+            if weights is None:
+                weights = [1 / len(delta_controls) for _ in delta_controls]
+            client_weights = dict(zip(delta_controls.keys(), weights))
+
+            def contribute(acc, client):
+                for name in acc.keys():
+                    acc[name] += client_weights[client] * delta_controls[client][name]
+            # float32 sums, the weights are fractions and num_batches_tracked is long
+            zeros = lambda: {name: torch.zeros_like(c, dtype=torch.float32) for name, c in control.items()}
+            mean_ci = self.aggregator.reduce(list(delta_controls.keys()), contribute, zeros)
+            return {name: (c - mean_ci[name]).to(c.dtype) for name, c in control.items()}
+
         new_control = copy.deepcopy(control)
         for name, c in control.items():
             mean_ci = []
             for _, delta_control in delta_controls.items():
                 mean_ci.append(delta_control[name])
-            ci = torch.stack(mean_ci).mean(dim=0)
+            ci = weighted_mean(torch.stack(mean_ci), weights)
             new_control[name] = c - ci
         return new_control
 
@@ -357,10 +529,37 @@ class Scaffold():
         return acc
 
 
-    def save_checkpoints(self,fpath):
-        torch.save({
+    def checkpoint_state(self, r):
+        state = {
+            'a_iter': r - 1,
             'server_model': self.model.state_dict(),
-        }, fpath)
+            'server_control': self.server_control,
+            'client_controls': self.client_controls,
+            'rng': rng_state(),
+        }
+        if self.compressor:
+            state['residuals'] = self.compressor.residuals
+        return state
+
+    def load_checkpoint(self, checkpoint):
+        self.model.load_state_dict(checkpoint['server_model'])
+        if 'server_control' in checkpoint:
+            self.server_control = checkpoint['server_control']
+            self.set_control_cuda(self.server_control, True)
+        self.client_controls.restore(checkpoint.get('client_controls', {}))
+        if self.compressor and 'residuals' in checkpoint:
+            self.compressor.residuals.restore(checkpoint['residuals'])
+        if 'rng' in checkpoint:
+            set_rng_state(checkpoint['rng'])
+        self.start_round = int(checkpoint['a_iter']) + 2
+        print('Resume training from epoch {}'.format(self.start_round))
+
+    def save_checkpoints(self, fpath):
+        # the rounds are checkpointed by the background writer, wait for the last one
+        print(' Saving checkpoints to {}...'.format(fpath))
+        self.checkpointer.close()
+        print(self.checkpointer.log_line())
+        logfile.write(self.checkpointer.log_line() + '\n')
 
 if __name__ == '__main__':
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -375,6 +574,12 @@ if __name__ == '__main__':
     if not os.path.exists(log_path):
         os.makedirs(log_path)
     logfile = open(os.path.join(log_path,'{}_{}_{}_{}.log'.format(args.mode ,args.dataset,args.skew,args.nclient)), 'w')
+    runlog = RunLog(logfile.name)
+    timeline = Timeline() if args.trace else None
+    memory = MemoryProfiler(runlog, args.profile_memory_top, args.profile_memory_lines) if args.profile_memory else None
+    profiler = Profiler(args.profile, args.profile_sync, args.profile_round,
+                        os.path.splitext(logfile.name)[0] + '.torch.json', runlog, timeline, memory)
+    set_profiler(profiler)
     logfile.write('==={}===\n'.format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
     logfile.write('===Setting===\n')
     logfile.write('    lr: {}\n'.format(args.lr))
@@ -385,15 +590,44 @@ if __name__ == '__main__':
     if not os.path.exists(args.save_path):
         os.makedirs(args.save_path)
     SAVE_PATH = os.path.join(args.save_path, '{}_{}_{}.bin'.format(args.mode,args.dataset,args.skew))
+    SAVE_PATH = checkpoint_path(SAVE_PATH, args.ckpt_format)
 
 
     server_model = eval(args.model)().to(device)
-    if args.resume:
-        checkpoint = torch.load(SAVE_PATH)
-        server_model.load_state_dict(checkpoint['server_model'])
     scaffold = Scaffold(server_model, args)
+    if memory:
+        memory.track('datasets', lambda: (scaffold.train_loaders, scaffold.test_loaders))
+        memory.track('client models', lambda: scaffold.model)
+        memory.track('control variates', lambda: (scaffold.server_control, scaffold.client_controls))
+        memory.track('error feedback', lambda: scaffold.compressor.residuals if scaffold.compressor else None)
+    if args.resume:
+        scaffold.load_checkpoint(load_checkpoint(SAVE_PATH))
     scaffold.train()
     scaffold.save_checkpoints(SAVE_PATH)
+    scaffold.client_controls.close()
+    if scaffold.aggregator:
+        scaffold.aggregator.close()
+    if scaffold.compressor:
+        scaffold.compressor.residuals.close()
+    if scaffold.sim:
+        print(scaffold.sim.summary_line())
+        logfile.write(scaffold.sim.summary_line() + '\n')
+    if args.profile:
+        print(profiler.summary_lines())
+        logfile.write(profiler.summary_lines() + '\n')
+        profiler.save_summary(os.path.splitext(logfile.name)[0] + '.profile.json')
+    if memory:
+        print(memory.summary_lines())
+        logfile.write(memory.summary_lines() + '\n')
+        memory.save_summary(os.path.splitext(logfile.name)[0] + '.memory.json')
+        memory.close()
+    if args.prefetch:
+        print(prefetch_summary())
+        logfile.write(prefetch_summary() + '\n')
+        runlog.write('prefetch', **prefetch_stats())
+    if timeline:
+        timeline.save(os.path.splitext(logfile.name)[0] + '.trace.json')
+    runlog.close()
     logfile.flush()
     logfile.close()
 
@@ -0,0 +1,342 @@
+'''
+    Microbenchmark of the server aggregation of every algorithm
+
+        Times the aggregation code of the scripts themselves on synthetic
+        client states, for a model and a number of clients:
+
+            fedavg            RoundSums + communication() of FedBN_label_weighted.py, num_batches_tracked from client 0
+            fedbn             the same with the BN layers kept local (masked out)
+            fedavg edges      the same through edge aggregators (hierarchy.py), with --edges
+            scaffold model    Scaffold.update_global, stacking the client deltas
+            scaffold reduce   Scaffold.update_global, summing them through reduce_clients
+            scaffold control  Scaffold.update_global_control, stacking
+            control reduce    Scaffold.update_global_control, summing
+            moon              MOON.update_global on FlatState uploads
+
+        and reports the best of --repeat runs in ms and in us per model
+        parameter, and how far the RSS (and the CUDA memory) rose above
+        where the call started, the aggregation temporaries.
+
+        Every result is checked against a float64 reference of what the
+        aggregation should give (the weighted mean, the BN layers left
+        alone by fedbn, num_batches_tracked within one): the error column is
+        the largest difference relative to the largest value. Above --rtol
+        the implementation is reported as MISMATCH and the exit code is 1.
+
+        The client states are --distinct random perturbations of the model,
+        client i gets number i % distinct, so 1000 clients of resnet1202 do
+        not need 1000 states in memory; what the implementations allocate
+        while aggregating them is what they would allocate in a run.
+
+    How to use:
+        python bench_aggregate.py --models DigitModel,resnet20,resnet110 --clients 2,10,100,1000
+        python bench_aggregate.py --models resnet1202 --clients 10,100 --edges 8 --weighted --report agg.json
+'''
+
+import argparse
+import copy
+import importlib
+import json
+import os
+import sys
+import time
+
+import torch
+
+from models.digit import DigitModel
+from models.resnet import *
+from hierarchy import HierarchicalAggregator
+from memprof import read_status, reset_peak
+from wire import FlatState
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--models', type=str, default='DigitModel,resnet20', help='comma separated models: | DigitModel | resnet20 | resnet32 | resnet44 | resnet56 | resnet110 | resnet1202 |')
+parser.add_argument('--clients', type=str, default='2,10,100,1000', help='comma separated client counts')
+parser.add_argument('--distinct', type=int, default=8, help='distinct client states, client i gets number i % distinct')
+parser.add_argument('--repeat', type=int, default=3, help='timed runs per case, the best one counts')
+parser.add_argument('--edges', type=int, default=0, help='also aggregate fedavg through this many edge aggregators, 0 skips it')
+parser.add_argument('--weighted', action='store_true', help='random client weights instead of the plain mean')
+parser.add_argument('--implementations', type=str, default='', help='comma separated subset of the implementations')
+parser.add_argument('--device', type=str, default='cpu', help='| cpu | cuda |')
+parser.add_argument('--rtol', type=float, default=1e-4, help='largest relative error still counted as equal')
+parser.add_argument('--report', type=str, default='', help='also write the rows as JSON')
+parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic states')
+args = parser.parse_args()
+
+MB = 2**20
+
+# the scripts default CUDA_VISIBLE_DEVICES to their GPU '1' on import, which a
+# single-GPU machine does not have: keep what was set, else the first GPU
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '0')
+
+
+def load_script(name):
+    # the scripts parse their own arguments on import, give them the defaults
+    saved = sys.argv
+    sys.argv = [name + '.py']
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.argv = saved
+
+
+def is_count(name):
+    return 'num_batches_tracked' in name
+
+
+def make_pool(template, distinct, generator):
+    '''
+        distinct client states around template, num_batches_tracked the same
+        for all of them like in a run over equally long loaders
+    '''
+    pool = []
+    for _ in range(distinct):
+        state = {}
+        for name, t in template.items():
+            if t.is_floating_point():
+                state[name] = t + 0.01 * torch.randn(t.shape, generator=generator).to(t.device)
+            else:
+                state[name] = torch.full_like(t, 100)
+        pool.append(state)
+    return pool
+
+
+def pool_weights(weights, distinct):
+    # the weight of every pool state, summed over the clients that use it
+    totals = [0. for _ in range(distinct)]
+    for client, w in enumerate(weights):
+        totals[client % distinct] += w
+    return totals
+
+
+def reference_mean(pool, weights):
+    totals = pool_weights(weights, len(pool))
+    mean = {}
+    for name in pool[0].keys():
+        mean[name] = sum(w * state[name].double() for w, state in zip(totals, pool))
+    return mean
+
+
+def relative_error(result, expected):
+    err = 0.
+    for name, value in expected.items():
+        if not value.numel():
+            continue
+        got = result[name].double().cpu()
+        value = value.double().cpu()
+        diff = (got - value).abs()
+        if not result[name].is_floating_point():
+            # integer counts may round either way
+            diff = (diff - 1).clamp(min=0)
+        err = max(err, diff.max().item() / max(value.abs().max().item(), 1.))
+    return err
+
+
+def measure(fn, setup):
+    '''
+        best seconds of fn(setup()) over --repeat runs, how far RSS / CUDA memory rose, the result
+    '''
+    best = None
+    rise = cuda_rise = 0
+    result = None
+    for _ in range(args.repeat):
+        state = setup()
+        if args.device == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        reset_peak()
+        rss, _ = read_status()
+        cuda_start = torch.cuda.memory_allocated() if args.device == 'cuda' else 0
+        start = time.perf_counter()
+        result = fn(state)
+        if args.device == 'cuda':
+            torch.cuda.synchronize()
+        seconds = time.perf_counter() - start
+        _, peak = read_status()
+        best = seconds if best is None else min(best, seconds)
+        if rss is not None and peak is not None:
+            rise = max(rise, peak - rss)
+        if args.device == 'cuda':
+            cuda_rise = max(cuda_rise, torch.cuda.max_memory_allocated() - cuda_start)
+    return best, rise, cuda_rise, result
+
+
+class Case():
+    '''
+        one model at one client count, the inputs every implementation shares
+    '''
+    def __init__(self, model_name, nclient):
+        self.model_name = model_name
+        self.nclient = nclient
+        generator = torch.Generator().manual_seed(args.seed)
+        self.model = eval(model_name)().to(args.device)
+        self.template = {name: t.detach().clone() for name, t in self.model.state_dict().items()}
+        self.nparams = sum(t.numel() for t in self.template.values())
+        self.distinct = min(args.distinct, nclient)
+        self.pool = make_pool(self.template, self.distinct, generator)
+        self.flat_pool = [FlatState.from_state(state) for state in self.pool]
+        self.deltas = [FlatState.from_state({name: state[name] - self.template[name] for name in state.keys()})
+                       for state in self.pool]
+        # the dtypes of the state_dict, like Scaffold's controls (num_batches_tracked is long)
+        self.controls = [{name: 0.01 * torch.randn(t.shape, generator=generator).to(t.device) if t.is_floating_point()
+                          else torch.zeros_like(t)
+                          for name, t in self.template.items()} for _ in range(self.distinct)]
+        self.server_control = {name: torch.zeros_like(t) for name, t in self.template.items()}
+
+        if args.weighted:
+            w = torch.rand(nclient, generator=generator).double() + 0.1
+            self.weights = (w / w.sum()).tolist()
+        else:
+            self.weights = [1. / nclient for _ in range(nclient)]
+        self.mean = reference_mean(self.pool, self.weights)
+
+    def global_model(self):
+        model = copy.deepcopy(self.model)
+        model.load_state_dict(self.template)
+        return model
+
+
+def bench_fedavg(fedbn, case, mode, edges=0):
+    script_args = copy.copy(fedbn.args)
+    script_args.mode = mode
+    script_args.choke = False
+
+    def setup():
+        return case.global_model()
+
+    def run(server_model):
+        aggregator = HierarchicalAggregator(edges) if edges > 0 else None
+        # the uploads as the training loop adds them, one client after the other
+        sums = fedbn.RoundSums(script_args, server_model, list(case.weights), aggregator=aggregator)
+        for client in range(case.nclient):
+            sums.add(client, case.pool[client % case.distinct])
+        server_model = fedbn.communication(script_args, server_model, sums)
+        if aggregator:
+            aggregator.close()
+        return server_model.state_dict()
+
+    expected = {}
+    for name, t in case.template.items():
+        if mode == 'fedbn' and fedbn.is_personal(name):
+            expected[name] = t # stays with the clients, the server keeps its own
+        elif is_count(name):
+            expected[name] = case.pool[0][name] # client 0's, the same for all of them
+        else:
+            expected[name] = case.mean[name]
+    return run, setup, expected
+
+
+def bench_scaffold_model(scaffold, case, reduce):
+    server = scaffold.Scaffold.__new__(scaffold.Scaffold)
+    server.args = scaffold.args
+    server.compressor = None
+    server.aggregator = None
+    weights = case.weights if args.weighted else None
+
+    def setup():
+        server.aggregator = HierarchicalAggregator(1) if reduce else None
+        deltas = {client: case.deltas[client % case.distinct] for client in range(case.nclient)}
+        return case.global_model(), deltas
+
+    def run(state):
+        global_model, deltas = state
+        server.update_global(0, global_model, deltas, weights)
+        return global_model.state_dict()
+
+    glo_lr = scaffold.args.glo_lr
+    expected = {}
+    for name, t in case.template.items():
+        expected[name] = t.double() - glo_lr * (case.mean[name] - t.double())
+    return run, setup, expected
+
+
+def bench_scaffold_control(scaffold, case, reduce):
+    server = scaffold.Scaffold.__new__(scaffold.Scaffold)
+    server.args = scaffold.args
+    server.compressor = None
+    server.aggregator = None
+    weights = case.weights if args.weighted else None
+
+    def setup():
+        server.aggregator = HierarchicalAggregator(1) if reduce else None
+        deltas = {client: case.controls[client % case.distinct] for client in range(case.nclient)}
+        return deltas
+
+    def run(deltas):
+        return server.update_global_control(0, case.server_control, deltas, weights)
+
+    totals = pool_weights(case.weights, case.distinct)
+    expected = {name: c.double() - sum(w * control[name].double() for w, control in zip(totals, case.controls))
+                for name, c in case.server_control.items()}
+    return run, setup, expected
+
+
+def bench_moon(moon, case):
+    server = moon.MOON.__new__(moon.MOON)
+    server.args = moon.args
+    weights = case.weights if args.weighted else None
+
+    def setup():
+        uploads = {client: case.flat_pool[client % case.distinct] for client in range(case.nclient)}
+        return case.global_model(), uploads
+
+    def run(state):
+        global_model, uploads = state
+        server.update_global(0, global_model, uploads, weights)
+        return global_model.state_dict()
+
+    return run, setup, case.mean
+
+
+def implementations(scripts, case):
+    fedbn, scaffold, moon = scripts
+    impls = [
+        ('fedavg', lambda: bench_fedavg(fedbn, case, 'fedavg')),
+        ('fedbn', lambda: bench_fedavg(fedbn, case, 'fedbn')),
+    ]
+    if args.edges > 0:
+        impls.append(('fedavg edges', lambda: bench_fedavg(fedbn, case, 'fedavg', args.edges)))
+    impls += [
+        ('scaffold model', lambda: bench_scaffold_model(scaffold, case, False)),
+        ('scaffold reduce', lambda: bench_scaffold_model(scaffold, case, True)),
+        ('scaffold control', lambda: bench_scaffold_control(scaffold, case, False)),
+        ('control reduce', lambda: bench_scaffold_control(scaffold, case, True)),
+        ('moon', lambda: bench_moon(moon, case)),
+    ]
+    if args.implementations:
+        keep = args.implementations.split(',')
+        impls = [(name, make) for name, make in impls if name in keep]
+    return impls
+
+
+if __name__ == '__main__':
+    scripts = [load_script(name) for name in ['FedBN_label_weighted', 'Scaffold', 'Moon']]
+    rows = []
+    failed = False
+    print('{:<10} {:>7} {:<17} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'model', 'clients', 'implementation', 'ms', 'us/param', 'rise MB', 'cuda MB', 'error', ''))
+    for model_name in args.models.split(','):
+        for nclient in [int(n) for n in args.clients.split(',')]:
+            case = Case(model_name, nclient)
+            for name, make in implementations(scripts, case):
+                run, setup, expected = make()
+                with torch.no_grad():
+                    seconds, rise, cuda_rise, result = measure(run, setup)
+                error = relative_error(result, expected)
+                ok = error <= args.rtol
+                failed = failed or not ok
+                row = {
+                    'model': model_name, 'clients': nclient, 'implementation': name, 'params': case.nparams,
+                    'seconds': seconds, 'us_per_param': seconds * 1e6 / case.nparams,
+                    'rise_mb': rise / MB, 'cuda_rise_mb': cuda_rise / MB, 'error': error, 'ok': ok,
+                }
+                rows.append(row)
+                print('{:<10} {:>7} {:<17} {:>10.2f} {:>10.4f} {:>10.1f} {:>10.1f} {:>10.2e} {:>10}'.format(
+                    model_name, nclient, name, seconds * 1000, row['us_per_param'], row['rise_mb'],
+                    row['cuda_rise_mb'], error, 'ok' if ok else 'MISMATCH'))
+            del case
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'args': vars(args), 'rows': rows}, f, indent=2)
+    sys.exit(1 if failed else 0)
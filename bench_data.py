@@ -0,0 +1,215 @@
+'''
+    Throughput benchmark of the data pipeline
+
+        Samples per second of every dataset class (MNIST_Dataset,
+        KMNIST_Dataset, SVHN_Dataset, CIFAR10_Dataset) under every skew
+        mode, through the transform chain of preprocess() and a loader:
+
+            none       the plain dataset
+            noise      gaussian noise on every sample (feature_skew_noise)
+            filter     the mean filter of feature_skew_filter
+            partition  a random index subset, what the quantity / label skews hand a client
+
+        The loaders are dset2loader() as the scripts use it (batch size
+        only) and a torch DataLoader swept over --batch_sizes, --workers and
+        pinned memory. Every row gives the time of the first and of the
+        following epochs and the samples per second of the latter.
+
+        The breakdown table gives the cost per sample of every step of the
+        transform chain, of the noise and the filter (what they add to a
+        sample's __getitem__), of the indexing and of the collation into
+        batches.
+
+        Nothing is downloaded: a dataset cached under ./datafiles/datasets is
+        used when it is there, otherwise the synthetic dataset of the same
+        shape (synth_mnist, synth_cifar10), which can also be asked for by
+        name. --samples caps the samples per epoch either way.
+
+    How to use:
+        python bench_data.py --datasets mnist,cifar10 --batch_sizes 32,128 --workers 0,2,4
+        python bench_data.py --skews none,filter --loaders torch --pin both --report data.json
+'''
+
+import argparse
+import copy
+import json
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+import torchvision.transforms as transforms
+
+from datafiles.loaders import dset2loader
+from datafiles.preprocess import name2func, transform_steps, synthetic_names, configure_synthetic
+from datafiles.shared import settings as shared_settings
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--datasets', type=str, default='mnist,kmnist,svhn,cifar10', help='comma separated datasets, synth_mnist and synth_cifar10 included')
+parser.add_argument('--skews', type=str, default='none,noise,filter,partition', help='comma separated skew modes: | none | noise | filter | partition |')
+parser.add_argument('--loaders', type=str, default='dset2loader,torch', help='comma separated loaders: | dset2loader | torch |')
+parser.add_argument('--batch_sizes', type=str, default='32,128', help='comma separated batch sizes')
+parser.add_argument('--workers', type=str, default='0,2', help='comma separated num_workers of the torch loader')
+parser.add_argument('--pin', type=str, default='off', help='pinned memory of the torch loader: | off | on | both |')
+parser.add_argument('--samples', type=int, default=4096, help='samples per epoch')
+parser.add_argument('--epochs', type=int, default=2, help='epochs per row, the first one is reported apart')
+parser.add_argument('--breakdown_samples', type=int, default=256, help='samples timed for the transform breakdown, 0 skips it')
+parser.add_argument('--noise_std', type=float, default=0.5, help='noise level for gaussion noise')
+parser.add_argument('--filter_sz', type=int, default=3, help='filter size for filter')
+parser.add_argument('--report', type=str, default='', help='also write the rows as JSON')
+parser.add_argument('--seed', type=int, default=0, help='random seed')
+args = parser.parse_args()
+
+ROOT = './datafiles/datasets/'
+# time the private pipeline, a dataset server would hand out pre-transformed samples
+shared_settings['attach'] = False
+# the synthetic stand-in of the same shape
+SYNTHETIC = {'mnist': 'synth_mnist', 'kmnist': 'synth_mnist', 'svhn': 'synth_cifar10', 'cifar10': 'synth_cifar10'}
+
+
+def base_dataset(name):
+    '''
+        the cached training set, or the synthetic one of its shape, no skew yet
+    '''
+    transform = transforms.Compose(transform_steps())
+    if name not in synthetic_names:
+        try:
+            dataset = name2func[name](rootp=ROOT + name, train=True, transform=transform, download=False)
+            return dataset, 'cached'
+        except (RuntimeError, OSError):
+            # torchvision: dataset not found, and we do not download
+            name = SYNTHETIC[name]
+    configure_synthetic(args.samples, 10, args.seed)
+    return name2func[name](rootp=ROOT + name, train=True, transform=transform), 'synthetic'
+
+
+def skewed(base, skew):
+    dataset = copy.copy(base)
+    n = min(args.samples, len(base))
+    if skew == 'partition':
+        indices = np.random.RandomState(args.seed).permutation(len(base))[:n]
+        dataset.indices = indices
+    else:
+        indices = np.arange(n)
+    dataset.x = base.x[indices]
+    dataset.y = base.y[indices]
+    dataset.noise = skew == 'noise'
+    dataset.noise_std = args.noise_std
+    dataset.filter = skew == 'filter'
+    dataset.filter_sz = args.filter_sz
+    return dataset
+
+
+def loader_configs():
+    configs = []
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    pins = {'off': [False], 'on': [True], 'both': [False, True]}[args.pin]
+    for loader in args.loaders.split(','):
+        for batch_size in batch_sizes:
+            if loader == 'dset2loader':
+                configs.append({'loader': loader, 'batch_size': batch_size, 'workers': 0, 'pin': False})
+                continue
+            for workers in [int(w) for w in args.workers.split(',')]:
+                for pin in pins:
+                    configs.append({'loader': loader, 'batch_size': batch_size, 'workers': workers, 'pin': pin})
+    return configs
+
+
+def make_loader(dataset, config):
+    if config['loader'] == 'dset2loader':
+        return dset2loader(dataset, config['batch_size'])
+    return DataLoader(dataset=dataset,
+                      batch_size=config['batch_size'],
+                      shuffle=True,
+                      num_workers=config['workers'],
+                      pin_memory=config['pin'],
+                      persistent_workers=config['workers'] > 0)
+
+
+def run_epochs(loader):
+    times = []
+    for _ in range(args.epochs):
+        start = time.perf_counter()
+        for x, y in loader:
+            pass
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def per_sample(fn, n):
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return (time.perf_counter() - start) / n
+
+
+def breakdown(base, batch_size):
+    '''
+        seconds per sample of every transform step, noise, filter, indexing and collation
+    '''
+    n = min(args.breakdown_samples, len(base))
+    plain = skewed(base, 'none')
+    costs = {}
+    steps = transform_steps()
+    for k, step in enumerate(steps):
+        inputs = []
+        for i in range(n):
+            x = plain.x[i]
+            for previous in steps[:k]:
+                x = previous(x)
+            inputs.append(x)
+        costs[type(step).__name__] = per_sample(lambda i: step(inputs[i]), n)
+    getitem = per_sample(plain.__getitem__, n)
+    costs['index'] = max(getitem - sum(costs.values()), 0.)
+    for skew in ['noise', 'filter']:
+        dataset = skewed(base, skew)
+        costs[skew] = max(per_sample(dataset.__getitem__, n) - getitem, 0.)
+    samples = [plain[i] for i in range(min(batch_size, n))]
+    costs['collate'] = per_sample(lambda i: default_collate(samples), 5) / len(samples)
+    return costs
+
+
+if __name__ == '__main__':
+    torch.manual_seed(args.seed)
+    rows = []
+    breakdowns = {}
+    configs = loader_configs()
+    print('{:<8} {:<10} {:<9} {:<12} {:>6} {:>7} {:>4} {:>10} {:>10} {:>12}'.format(
+        'dataset', 'source', 'skew', 'loader', 'batch', 'workers', 'pin', 'first s', 'epoch s', 'samples/s'))
+    for name in args.datasets.split(','):
+        base, source = base_dataset(name)
+        for skew in args.skews.split(','):
+            dataset = skewed(base, skew)
+            for config in configs:
+                row = {'dataset': name, 'source': source, 'skew': skew, 'samples': len(dataset)}
+                row.update(config)
+                try:
+                    times = run_epochs(make_loader(dataset, config))
+                except RuntimeError as e:
+                    # e.g. the filter moves samples to the GPU, which worker processes cannot
+                    row['error'] = str(e).splitlines()[0]
+                    rows.append(row)
+                    print('{:<8} {:<10} {:<9} {:<12} {:>6} {:>7} {:>4} failed: {}'.format(
+                        name, source, skew, config['loader'], config['batch_size'], config['workers'], 'on' if config['pin'] else 'off', row['error']))
+                    continue
+                steady = times[1:] or times
+                row['first_epoch_s'] = times[0]
+                row['epoch_s'] = sum(steady) / len(steady)
+                row['samples_per_s'] = len(dataset) / row['epoch_s']
+                rows.append(row)
+                print('{:<8} {:<10} {:<9} {:<12} {:>6} {:>7} {:>4} {:>10.3f} {:>10.3f} {:>12.0f}'.format(
+                    name, source, skew, config['loader'], config['batch_size'], config['workers'],
+                    'on' if config['pin'] else 'off', row['first_epoch_s'], row['epoch_s'], row['samples_per_s']))
+        if args.breakdown_samples > 0:
+            breakdowns[name] = breakdown(base, int(args.batch_sizes.split(',')[0]))
+
+    for name, costs in breakdowns.items():
+        total = sum(costs[k] for k in costs if k not in ['noise', 'filter'])
+        print('transform breakdown of {} ({:.1f} us per sample without skew)'.format(name, total * 1e6))
+        for step, seconds in costs.items():
+            print('    {:<20} {:>10.1f} us {:>6.1f}%'.format(step, seconds * 1e6, 100 * seconds / max(total, 1e-12)))
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'args': vars(args), 'rows': rows, 'breakdown': breakdowns}, f, indent=2)
@@ -0,0 +1,63 @@
+'''
+    Root-node aggregation time per round, flat server against edge-tier
+    aggregation (hierarchy.py), at growing client counts.
+
+        Every client uploads a copy of the model's state (the values do not
+        matter for the timing). The flat server adds up all N of them, with
+        edges the root only adds the partial sums of the top tier. The
+        speedup compares the flat server with the whole hierarchical reduce
+        (edge tier and root, wall time), not with the root alone.
+
+    How to use:
+        python bench_hierarchy.py --clients 100,1000,10000 --edges 0 --regions 0 --workers 8
+
+        --edges 0 uses sqrt(N) edges per client count
+'''
+
+import argparse
+import math
+import time
+
+import torch
+
+from models.digit import DigitModel
+from models.resnet import *
+from hierarchy import HierarchicalAggregator, reduce_clients
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, default="DigitModel", help = 'model used:| DigitModel | resnet20 | resnet32 | resnet44 | resnet56 | resnet110 | resnet1202 |')
+parser.add_argument('--clients', type=str, default='100,1000,10000', help='comma separated client counts')
+parser.add_argument('--edges', type=int, default=0, help='edge aggregators, 0 for sqrt(clients)')
+parser.add_argument('--regions', type=int, default=0, help='regional aggregators, 0 for two tiers')
+parser.add_argument('--workers', type=int, default=0, help='threads running the edges')
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    template = {key: value.float() for key, value in eval(args.model)().state_dict().items()}
+    mb = sum(t.nelement() * t.element_size() for t in template.values()) / 2**20
+    print('model {} | update {:.2f} MB'.format(args.model, mb))
+    print('{:>8} {:>6} {:>8} {:>12} {:>12} {:>12} {:>12} {:>8}'.format('clients', 'edges', 'regions', 'flat root s', 'root s', 'edge tier s', 'reduce s', 'speedup'))
+
+    for nclient in [int(n) for n in args.clients.split(',')]:
+        weight = 1. / nclient
+        zeros = lambda: {key: torch.zeros_like(t) for key, t in template.items()}
+
+        def contribute(acc, client):
+            for key, t in acc.items():
+                t.add_(template[key], alpha=weight)
+
+        start = time.perf_counter()
+        reduce_clients(None, range(nclient), contribute, zeros)
+        flat_time = time.perf_counter() - start
+
+        edges = args.edges or max(1, int(round(math.sqrt(nclient))))
+        aggregator = HierarchicalAggregator(edges, args.regions, args.workers)
+        start = time.perf_counter()
+        aggregator.reduce(range(nclient), contribute, zeros)
+        reduce_time = time.perf_counter() - start
+        aggregator.close()
+
+        print('{:>8} {:>6} {:>8} {:>12.4f} {:>12.4f} {:>12.4f} {:>12.4f} {:>7.1f}x'.format(
+            nclient, edges, args.regions, flat_time, aggregator.root_time,
+            aggregator.edge_time + aggregator.region_time, reduce_time, flat_time / max(reduce_time, 1e-9)))
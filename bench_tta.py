@@ -0,0 +1,222 @@
+'''
+    Time-to-target-accuracy benchmark across algorithms
+
+        Runs every algorithm of the manifest on every dataset / skew config
+        of it and records, for each target accuracy, what it took the run to
+        first reach it (server test accuracy):
+
+            round, wall seconds, CPU seconds, MB communicated, peak RSS
+
+        A run is stopped once it reached its highest target (--full runs
+        every round). The report is JSON; against a stored baseline a metric
+        more than --tolerance worse, or a target the baseline reached and
+        this run did not, is a regression and the exit code is 1.
+
+    The manifest (tta_manifest.json) holds the targets, the rounds, the
+    arguments passed to every run ('args', and per algorithm in
+    'algorithm_args'), the algorithms and the configs.
+
+    How to use:
+        python bench_tta.py --manifest tta_manifest.json --save_baseline tta_baseline.json
+        python bench_tta.py --manifest tta_manifest.json --baseline tta_baseline.json --tolerance 0.1
+'''
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--manifest', type=str, default='tta_manifest.json', help='benchmark manifest')
+parser.add_argument('--report', type=str, default='tta_report.json', help='where to write the report')
+parser.add_argument('--baseline', type=str, default='', help='report to compare against')
+parser.add_argument('--save_baseline', type=str, default='', help='also store this report as a baseline')
+parser.add_argument('--tolerance', type=float, default=0.1, help='relative slack before a metric counts as a regression')
+parser.add_argument('--algorithms', type=str, default='', help='comma separated subset of the manifest algorithms')
+parser.add_argument('--full', action='store_true', help='run every round instead of stopping at the highest target')
+parser.add_argument('--out_path', type=str, default='./bench_tta/', help='logs and checkpoints of the runs')
+args = parser.parse_args()
+
+# algorithm -> (script, extra arguments)
+ALGORITHMS = {
+    'fedavg': ('FedBN_label_weighted.py', ['--mode', 'fedavg']),
+    'fedprox': ('FedBN_label_weighted.py', ['--mode', 'fedprox']),
+    'fedbn': ('FedBN_label_weighted.py', ['--mode', 'fedbn']),
+    'scaffold': ('Scaffold.py', ['--mode', 'scaffold']),
+    'moon': ('Moon.py', ['--mode', 'moon']),
+    'perfedavg': ('PerFedAvg_PFedMe.py', ['--mode', 'perfedavg']),
+    'pfedme': ('PerFedAvg_PFedMe.py', ['--mode', 'pfedme']),
+}
+# Scaffold counts its rounds in --max_round
+ROUNDS_ARG = {'Scaffold.py': '--max_round'}
+
+SERVER_ACC = re.compile(r'^ server\s*\|.*Test  Acc: ([0-9.]+)')
+COMM_TOTAL = re.compile(r'^ comm\s*\|.*Total: ([0-9.]+) MB')
+METRICS = ['wall_s', 'cpu_s', 'comm_mb', 'peak_rss_mb']
+
+
+def to_argv(options):
+    argv = []
+    for key, value in options.items():
+        if value is True:
+            argv.append('--{}'.format(key))
+        elif value is not False:
+            argv += ['--{}'.format(key), str(value)]
+    return argv
+
+
+def proc_usage(pid):
+    '''
+        CPU seconds and peak RSS (MB) of a running process, from /proc
+    '''
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # the command name may hold spaces, the fields after it do not
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        cpu = sum(int(v) for v in fields[11:15]) / ticks # utime stime cutime cstime
+        rss = 0.
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    rss = int(line.split()[1]) / 1024
+        return cpu, rss
+    except (OSError, IndexError, ValueError):
+        return None, None
+
+
+def command(algorithm, config, manifest):
+    script, extra = ALGORITHMS[algorithm]
+    options = dict(manifest.get('args', {}))
+    options.update(manifest.get('algorithm_args', {}).get(algorithm, {}))
+    options.update(config)
+    name = '{}_{}_{}'.format(algorithm, config['dataset'], config['skew'])
+    options['log_path'] = os.path.join(args.out_path, 'logs', name)
+    options['save_path'] = os.path.join(args.out_path, 'checkpoint', name)
+    argv = [sys.executable, '-u', script] + extra
+    argv += [ROUNDS_ARG.get(script, '--iters'), str(manifest['rounds'])]
+    return argv + to_argv(options)
+
+
+def run_one(algorithm, config, manifest):
+    targets = sorted(manifest['targets'])
+    argv = command(algorithm, config, manifest)
+    print(' run    | {}'.format(' '.join(argv)))
+
+    reached = {}
+    rounds = 0
+    acc = 0.
+    comm_mb = 0.
+    start = time.time()
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    for line in proc.stdout:
+        m = COMM_TOTAL.match(line)
+        if m:
+            # the meter prints the running total
+            comm_mb = float(m.group(1))
+            continue
+        m = SERVER_ACC.match(line)
+        if not m:
+            continue
+        rounds += 1
+        acc = float(m.group(1))
+        for target in targets:
+            if acc >= target and str(target) not in reached:
+                cpu, rss = proc_usage(proc.pid)
+                reached[str(target)] = {'round': rounds, 'wall_s': time.time() - start, 'cpu_s': cpu,
+                                        'comm_mb': comm_mb, 'peak_rss_mb': rss}
+                print(' target | {} reached {:.2f} in round {} after {:.1f}s'.format(algorithm, target, rounds, time.time() - start))
+        if len(reached) == len(targets) and not args.full:
+            proc.terminate()
+            break
+    # wait4 gives the rusage of this child alone
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status
+    proc.stdout.close()
+
+    return {
+        'algorithm': algorithm,
+        'dataset': config['dataset'],
+        'skew': config['skew'],
+        'argv': argv,
+        'returncode': proc.returncode,
+        'rounds': rounds,
+        'final_acc': acc,
+        'targets': {str(target): reached.get(str(target)) for target in targets},
+        'total': {'wall_s': time.time() - start, 'cpu_s': usage.ru_utime + usage.ru_stime,
+                  'comm_mb': comm_mb, 'peak_rss_mb': usage.ru_maxrss / 1024},
+    }
+
+
+def run_key(run):
+    return (run['algorithm'], run['dataset'], run['skew'])
+
+
+def compare(report, baseline):
+    '''
+        list of regressions of report against baseline
+    '''
+    base_runs = {run_key(run): run for run in baseline['runs']}
+    regressions = []
+    for run in report['runs']:
+        base = base_runs.get(run_key(run))
+        if base is None:
+            continue
+        for target, hit in run['targets'].items():
+            base_hit = base['targets'].get(target)
+            if base_hit is None:
+                continue
+            if hit is None:
+                regressions.append((run_key(run), target, 'reached', 'baseline round {}'.format(base_hit['round'])))
+                continue
+            for metric in ['round'] + METRICS:
+                if hit.get(metric) is None or base_hit.get(metric) is None:
+                    continue
+                if hit[metric] > base_hit[metric] * (1 + args.tolerance) and hit[metric] - base_hit[metric] > 1e-6:
+                    regressions.append((run_key(run), target, metric, '{:.2f} -> {:.2f}'.format(base_hit[metric], hit[metric])))
+    return regressions
+
+
+if __name__ == '__main__':
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    algorithms = manifest['algorithms']
+    if args.algorithms:
+        algorithms = [a for a in args.algorithms.split(',') if a in algorithms]
+    for algorithm in algorithms:
+        assert(algorithm in ALGORITHMS)
+
+    report = {'created': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), 'manifest': manifest, 'runs': []}
+    for config in manifest['configs']:
+        for algorithm in algorithms:
+            run = run_one(algorithm, config, manifest)
+            report['runs'].append(run)
+            # the report is rewritten after every run, a killed suite keeps what it had
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    print('{:<10} {:<8} {:<13} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('algorithm', 'dataset', 'skew', 'target', 'round', 'wall s', 'cpu s', 'comm MB'))
+    for run in report['runs']:
+        for target, hit in run['targets'].items():
+            if hit is None:
+                print('{:<10} {:<8} {:<13} {:>7} {:>9}'.format(run['algorithm'], run['dataset'], run['skew'], target, '-'))
+                continue
+            print('{:<10} {:<8} {:<13} {:>7} {:>9} {:>9.1f} {:>9.1f} {:>9.2f}'.format(
+                run['algorithm'], run['dataset'], run['skew'], target, hit['round'], hit['wall_s'], hit['cpu_s'] or 0., hit['comm_mb']))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline)
+        for key, target, metric, detail in regressions:
+            print(' regression | {} {} {} | target {} | {}: {}'.format(key[0], key[1], key[2], target, metric, detail))
+        if regressions:
+            sys.exit(1)
+        print(' no regression against {}'.format(args.baseline))
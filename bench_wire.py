@@ -0,0 +1,96 @@
+'''
+    Benchmark of the wire format (wire.py) against torch.save / torch.load
+    through an in-memory BytesIO, on the models of this repo.
+
+        torch.save:   torch.save(state, BytesIO) + torch.load
+        flat copy:    FlatState.from_state(state) + tobytes + decode_update
+        flat module:  flatten_module(model) once, then to_buffers + decode_update
+                      of its parameters and of its buffers
+        pickle:       pickle.dumps(FlatState, protocol 5) + pickle.loads with the
+                      payload out-of-band (buffer_callback / buffers), the zero-copy path
+
+    How to use:
+        python bench_wire.py --repeat 20
+'''
+
+import argparse
+import io
+import pickle
+import time
+
+import torch
+
+from models.digit import DigitModel
+from models.resnet import resnet20, resnet56, resnet110
+from wire import FlatState, flatten_module, decode_update
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--repeat', type=int, default=20, help='timed repetitions per case')
+parser.add_argument('--models', type=str, default='digit,resnet20,resnet56,resnet110', help='comma separated models')
+args = parser.parse_args()
+
+MODELS = {
+    'digit': lambda: DigitModel(),
+    'resnet20': resnet20,
+    'resnet56': resnet56,
+    'resnet110': resnet110,
+}
+
+
+def timeit(fn, repeat):
+    fn() # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return (time.perf_counter() - start) / repeat * 1000, out
+
+
+def bench_torch_save(state):
+    def encode():
+        buf = io.BytesIO()
+        torch.save(state, buf)
+        return buf.getvalue()
+    enc_ms, data = timeit(encode, args.repeat)
+    dec_ms, _ = timeit(lambda: torch.load(io.BytesIO(data)), args.repeat)
+    return enc_ms, dec_ms, len(data)
+
+
+def bench_flat_copy(state):
+    enc_ms, data = timeit(lambda: FlatState.from_state(state).tobytes(), args.repeat)
+    dec_ms, _ = timeit(lambda: decode_update(data), args.repeat)
+    return enc_ms, dec_ms, len(data)
+
+
+def bench_flat_module(model):
+    flats = flatten_module(model)
+    enc_ms, parts = timeit(lambda: [flat.to_buffers() for flat in flats], args.repeat)
+    dec_ms, _ = timeit(lambda: [decode_update(header, payload) for header, payload in parts], args.repeat)
+    return enc_ms, dec_ms, sum(len(header) + payload.nbytes for header, payload in parts)
+
+
+def bench_pickle(state):
+    flat = FlatState.from_state(state)
+
+    def dumps():
+        buffers = []
+        data = pickle.dumps(flat, protocol=5, buffer_callback=buffers.append)
+        return data, buffers
+    enc_ms, (data, buffers) = timeit(dumps, args.repeat)
+    dec_ms, _ = timeit(lambda: pickle.loads(data, buffers=buffers), args.repeat)
+    return enc_ms, dec_ms, len(data) + sum(buffer.raw().nbytes for buffer in buffers)
+
+
+if __name__ == '__main__':
+    print('{:<10} {:<12} {:>10} {:>10} {:>10}'.format('model', 'format', 'encode ms', 'decode ms', 'MB'))
+    for name in args.models.split(','):
+        model = MODELS[name]()
+        state = model.state_dict()
+        rows = [
+            ('torch.save', bench_torch_save(state)),
+            ('flat copy', bench_flat_copy(state)),
+            ('pickle', bench_pickle(state)),
+            # last, flatten_module rebinds the model's tensors
+            ('flat module', bench_flat_module(model)),
+        ]
+        for fmt, (enc_ms, dec_ms, nbytes) in rows:
+            print('{:<10} {:<12} {:>10.3f} {:>10.3f} {:>10.2f}'.format(name, fmt, enc_ms, dec_ms, nbytes / 2**20))
@@ -0,0 +1,307 @@
+'''
+    Asynchronous, atomic checkpoints
+
+        A checkpoint is a dict holding everything a run needs to go on
+        exactly where it stopped: the round index, the server and client
+        states, control variates and residuals, and the RNG states.
+
+        save() takes a cpu snapshot of the dict right away (training goes on
+        changing the live tensors) and hands it to a background thread. A
+        ClientStateStore in the dict is snapshotted by the store itself: its
+        states are copied once, and its spilled states are read by the
+        thread. The
+        thread writes it to <path>.tmp, syncs it and renames it over <path>,
+        so a crash mid-write leaves the previous checkpoint intact. At most
+        one write is in flight: a save() while the last one is still
+        writing waits for it.
+
+    How to use:
+        checkpointer = AsyncCheckpointer(SAVE_PATH, every=args.save_every, fmt=args.ckpt_format)
+        for a_iter in range(resume_iter, args.iters):
+            ...
+            if checkpointer.due(a_iter, last=a_iter == args.iters - 1):
+                checkpointer.save({'a_iter': a_iter, 'server_model': ..., 'rng': rng_state()})
+        checkpointer.close()
+
+        checkpoint = load_checkpoint(SAVE_PATH)
+        set_rng_state(checkpoint['rng'])
+
+    Sharded layout (fmt='sharded', SAVE_PATH = checkpoint_path(SAVE_PATH, 'sharded') a directory):
+
+        <path>/manifest.json    round index and which object holds what
+        <path>/objects/<sha256>.pt
+
+        Every state dict of the checkpoint ('server_model', ...) is one
+        object, every client of a per-client dict ('clients',
+        'client_controls', 'residuals', ...) is one object of its own, the
+        rest (round index, RNG states, ...) goes into one 'meta' object.
+        Objects are named by the hash of their content: a shard that did
+        not change since the last checkpoint is not written again. The
+        manifest is replaced last and atomically, objects nobody refers to
+        any more are removed afterwards.
+
+        load_checkpoint() of such a directory gives a ShardedCheckpoint,
+        which reads a shard (torch.load with mmap=True) only when it is
+        accessed.
+'''
+
+import copy
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    # cpu copies of every tensor, containers rebuilt around them
+    if hasattr(obj, 'snapshot'):
+        # a ClientStateStore
+        return obj.snapshot()
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, path):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def is_state(obj):
+    return isinstance(obj, dict) and len(obj) > 0 and all(torch.is_tensor(v) for v in obj.values())
+
+
+def is_client_states(obj):
+    return isinstance(obj, dict) and len(obj) > 0 and all(is_state(v) for v in obj.values())
+
+
+def state_hash(state):
+    h = hashlib.sha256()
+    for name, t in state.items():
+        t = t.detach().cpu().contiguous()
+        h.update('{}|{}|{}|'.format(name, t.dtype, tuple(t.shape)).encode('utf-8'))
+        h.update(t.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def _put_object(path, obj, digest):
+    # content addressed: an object already on disk is the same object
+    name = '{}.pt'.format(digest)
+    obj_path = os.path.join(path, 'objects', name)
+    if not os.path.exists(obj_path):
+        atomic_save(obj, obj_path)
+    return name
+
+
+def save_sharded(state, path):
+    if not os.path.exists(os.path.join(path, 'objects')):
+        os.makedirs(os.path.join(path, 'objects'))
+    manifest = {'a_iter': state.get('a_iter'), 'states': {}, 'clients': {}, 'meta': None}
+    meta = {}
+    for key, value in state.items():
+        if is_state(value):
+            manifest['states'][key] = _put_object(path, value, state_hash(value))
+        elif is_client_states(value):
+            # json keys are strings, keep the client ids as they are
+            manifest['clients'][key] = [[client, _put_object(path, s, state_hash(s))] for client, s in value.items()]
+        else:
+            meta[key] = value
+    meta_bytes = io.BytesIO()
+    torch.save(meta, meta_bytes)
+    manifest['meta'] = _put_object(path, meta, hashlib.sha256(meta_bytes.getvalue()).hexdigest())
+
+    tmp_path = os.path.join(path, 'manifest.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(path, 'manifest.json'))
+
+    # objects of older checkpoints that this one does not share
+    used = set(manifest['states'].values()) | {manifest['meta']}
+    used |= {name for clients in manifest['clients'].values() for _, name in clients}
+    for name in os.listdir(os.path.join(path, 'objects')):
+        if name not in used:
+            os.remove(os.path.join(path, 'objects', name))
+
+
+def torch_load(path, mmap=False):
+    # our own files, they hold the python and numpy rng states which torch >= 2.6 refuses by default
+    try:
+        if mmap:
+            return torch.load(path, map_location='cpu', weights_only=False, mmap=True)
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        # torch before 2.1 has no mmap, before 1.13 no weights_only
+        return torch.load(path, map_location='cpu')
+
+
+def _load_object(path):
+    return torch_load(path, mmap=True)
+
+
+class LazyClients():
+    '''
+        {client: state} of a sharded checkpoint, a client's shard is read on access
+    '''
+    def __init__(self, path, shards):
+        self.path = path
+        self.shards = OrderedDict((client, name) for client, name in shards)
+
+    def __getitem__(self, client):
+        return _load_object(os.path.join(self.path, 'objects', self.shards[client]))
+
+    def __contains__(self, client):
+        return client in self.shards
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def keys(self):
+        return self.shards.keys()
+
+    def get(self, client, default=None):
+        return self[client] if client in self.shards else default
+
+    def items(self):
+        for client in self.shards:
+            yield client, self[client]
+
+
+class ShardedCheckpoint():
+    '''
+        Read side of save_sharded(), works like the checkpoint dict
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.meta = None
+
+    def _meta(self):
+        if self.meta is None:
+            self.meta = _load_object(os.path.join(self.path, 'objects', self.manifest['meta']))
+        return self.meta
+
+    def __getitem__(self, key):
+        if key in self.manifest['states']:
+            return _load_object(os.path.join(self.path, 'objects', self.manifest['states'][key]))
+        if key in self.manifest['clients']:
+            return LazyClients(self.path, self.manifest['clients'][key])
+        return self._meta()[key]
+
+    def __contains__(self, key):
+        return key in self.manifest['states'] or key in self.manifest['clients'] or key in self._meta()
+
+    def keys(self):
+        return list(self.manifest['states']) + list(self.manifest['clients']) + list(self._meta())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+SAVE_FNS = {'single': atomic_save, 'sharded': save_sharded}
+
+
+def checkpoint_path(path, fmt):
+    # a sharded checkpoint is a directory next to where the single file would be
+    if fmt == 'sharded':
+        return os.path.splitext(path)[0] + '.ckpt'
+    return path
+
+
+def load_checkpoint(path):
+    if os.path.isdir(path):
+        return ShardedCheckpoint(path)
+    if not os.path.exists(path) and path.endswith('.ckpt'):
+        # a run saved in the single format, before sharded became the default
+        single = path[:-len('.ckpt')] + '.bin'
+        if os.path.exists(single):
+            path = single
+    return torch_load(path)
+
+
+class AsyncCheckpointer():
+    def __init__(self, path, every=1, fmt='single'):
+        assert(fmt in SAVE_FNS)
+        self.path = path
+        self.every = every # checkpoint every k rounds, 0: only the last one
+        self.save_fn = SAVE_FNS[fmt] # (state, path), runs on the writer thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.lock = threading.Lock()
+
+        self.saved = 0
+        self.write_time = 0. # seconds spent writing, off the training thread
+        self.stall_time = 0. # seconds training waited for a previous write and for the snapshot
+
+    def due(self, a_iter, last=False):
+        return last or (self.every > 0 and (a_iter + 1) % self.every == 0)
+
+    def save(self, state):
+        start = time.perf_counter()
+        self.wait()
+        state = snapshot(state)
+        self.stall_time += time.perf_counter() - start
+        self.future = self.executor.submit(self._write, state)
+
+    def _write(self, state):
+        start = time.perf_counter()
+        self.save_fn(state, self.path)
+        with self.lock:
+            self.saved += 1
+            self.write_time += time.perf_counter() - start
+
+    def wait(self):
+        if self.future is not None:
+            future, self.future = self.future, None
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
+
+    def log_line(self):
+        with self.lock:
+            return ' ckpt   | Saved: {} | Write: {:.2f}s | Stall: {:.2f}s'.format(self.saved, self.write_time, self.stall_time)
@@ -0,0 +1,231 @@
+'''
+    Per-client state storage
+
+        Algorithms that keep something for every client (FedBN's private
+        models, MOON's previous local models, SCAFFOLD's control variates)
+        hold it in a ClientStateStore instead of a list/dict of full copies.
+
+        A client state is a dict {name: tensor}, the same shape as a
+        state_dict. At most `capacity` states are kept in memory, least
+        recently used first out. Evicted states are spilled to one flat file
+        per client and memory-mapped back on the next access.
+
+    How to use:
+        store = ClientStateStore(capacity=64, spill_dir='./client_states/run')
+
+        store.prefetch(next_client)     # read it back in the background
+        state = store.get(client)       # None if the client was never put
+        ...
+        store.put(client, model.state_dict())
+
+        store.stats() gives the hit / miss / spill counters
+'''
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+# offsets inside a spill file are aligned so every tensor view is aligned too
+ALIGN = 64
+
+
+class ClientStateStore():
+    def __init__(self, capacity=0, spill_dir='./client_states'):
+        self.capacity = capacity # 0: never spill, keep every client in memory
+        self.spill_dir = spill_dir
+
+        self.cache = OrderedDict() # client -> state, most recently used last
+        self.layouts = {} # client -> [(name, dtype, shape, offset, nbytes)] of spilled states
+        self.files = set() # clients with a spill file, also after it was loaded back or replaced
+        self.pending = {} # client -> future of a running prefetch
+
+        self.lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_spilled = 0
+        self.bytes_loaded = 0
+
+    def __contains__(self, client):
+        with self.lock:
+            return client in self.cache or client in self.layouts or client in self.pending
+
+    def __len__(self):
+        with self.lock:
+            return len(set(self.cache) | set(self.layouts) | set(self.pending))
+
+    def clients(self):
+        with self.lock:
+            return sorted(set(self.cache) | set(self.layouts) | set(self.pending))
+
+    def get(self, client, default=None):
+        """ the stored state of client, or default if it was never put
+
+            the returned tensors are the stored ones, not copies: call put()
+            after changing them, otherwise a spilled client loses the change
+        """
+        future = None
+        with self.lock:
+            future = self.pending.pop(client, None)
+        if future is not None:
+            future.result()
+
+        with self.lock:
+            if client in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(client)
+                return self.cache[client]
+            if client not in self.layouts:
+                return default
+            self.misses += 1
+            state = self._load(client)
+            self._insert(client, state)
+            return state
+
+    def put(self, client, state):
+        # copy, since a state_dict() still aliases the live module tensors
+        state = {name: t.detach().to('cpu', copy=True) for name, t in state.items()}
+        with self.lock:
+            future = self.pending.pop(client, None)
+            if future is not None:
+                future.cancel()
+            self.layouts.pop(client, None)
+            self._insert(client, state)
+
+    def prefetch(self, client):
+        """ start reading a spilled client back before it is scheduled
+        """
+        with self.lock:
+            if client not in self.layouts or client in self.pending:
+                return
+            self.pending[client] = self.executor.submit(self._prefetch, client)
+
+    def clear(self):
+        with self.lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending = {}
+            for client in list(self.files):
+                self._remove_file(client)
+            self.layouts = {}
+            self.cache = OrderedDict()
+
+    def snapshot(self):
+        """ every client state for checkpoints, without churning the LRU
+
+            in-memory states are copied, spilled states are mapped from their
+            files: nothing is read until the tensors are (by the checkpoint
+            writer), and a later spill replaces the file, it does not change
+            the mapped one
+        """
+        with self.lock:
+            states = {client: {name: t.detach().to('cpu', copy=True) for name, t in state.items()}
+                      for client, state in self.cache.items()}
+            for client, layout in self.layouts.items():
+                if client in states:
+                    continue
+                buf = np.memmap(self._path(client), dtype=np.uint8, mode='c')
+                states[client] = self._views(layout, buf)
+            return states
+
+    def restore(self, states):
+        for client, state in states.items():
+            self.put(client, state)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes_spilled': self.bytes_spilled,
+                'bytes_loaded': self.bytes_loaded,
+                'in_memory': len(self.cache),
+                'bytes_in_memory': sum(t.nelement() * t.element_size() for state in self.cache.values() for t in state.values()),
+                'on_disk': len(self.layouts),
+            }
+
+    def _prefetch(self, client):
+        with self.lock:
+            layout = self.layouts.get(client)
+        if layout is None:
+            return
+        # the read happens outside the lock, so training can go on meanwhile
+        buf = np.fromfile(self._path(client), dtype=np.uint8)
+        with self.lock:
+            # a put() in between makes what we read stale
+            if self.layouts.get(client) is not layout:
+                return
+            state = self._load(client, buf)
+            self._insert(client, state)
+
+    def _insert(self, client, state):
+        self.cache[client] = state
+        self.cache.move_to_end(client)
+        while self.capacity > 0 and len(self.cache) > self.capacity:
+            victim, victim_state = self.cache.popitem(last=False)
+            self._spill(victim, victim_state)
+
+    def _path(self, client):
+        return os.path.join(self.spill_dir, 'client_{}.bin'.format(client))
+
+    def _spill(self, client, state):
+        if not os.path.exists(self.spill_dir):
+            os.makedirs(self.spill_dir)
+
+        layout = []
+        offset = 0
+        arrays = []
+        for name, t in state.items():
+            # np.ascontiguousarray would make a 0-d tensor (num_batches_tracked) 1-d
+            arr = t.detach().cpu().contiguous().numpy()
+            offset = (offset + ALIGN - 1) // ALIGN * ALIGN
+            layout.append((name, arr.dtype.str, tuple(t.shape), offset, arr.nbytes))
+            arrays.append((offset, arr))
+            offset += arr.nbytes
+
+        # write aside and rename: states loaded earlier may still map the old file
+        path = self._path(client)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for off, arr in arrays:
+                f.seek(off)
+                f.write(arr.tobytes())
+            f.truncate(max(offset, 1))
+        os.replace(tmp_path, path)
+
+        self.files.add(client)
+        self.layouts[client] = layout
+        self.evictions += 1
+        self.bytes_spilled += offset
+
+    def _views(self, layout, buf):
+        state = {}
+        for name, dtype, shape, offset, nbytes in layout:
+            arr = buf[offset:offset + nbytes].view(np.dtype(dtype)).reshape(shape)
+            state[name] = torch.from_numpy(arr)
+        return state
+
+    def _load(self, client, buf=None):
+        layout = self.layouts.pop(client)
+        if buf is None:
+            # copy-on-write mapping: pages are read lazily and the tensors stay writable
+            buf = np.memmap(self._path(client), dtype=np.uint8, mode='c')
+        self.bytes_loaded += sum(nbytes for _, _, _, _, nbytes in layout)
+        return self._views(layout, buf)
+
+    def _remove_file(self, client):
+        self.files.discard(client)
+        path = self._path(client)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,88 @@
+'''
+    Per-round communication cost accounting
+
+        Counts the bytes every client downloads and uploads in a round,
+        split into model parameters, model buffers (BatchNorm running stats
+        and num_batches_tracked) and control variates (SCAFFOLD). Compressed
+        uploads are counted by their encoded size.
+
+    How to use:
+        meter = CommMeter(model, runlog)
+        meter.start_round(a_iter)
+        meter.add(client_idx, 'down', server_model.state_dict())
+        meter.add(client_idx, 'up', encoded_update)
+        meter.add(client_idx, 'up', delta_control, category='controls')
+        meter.end_round()               # writes the records, returns the round totals
+'''
+
+import threading
+
+import torch
+from compress import payload_nbytes
+
+CATEGORIES = ['params', 'buffers', 'controls']
+
+
+def value_nbytes(value):
+    if torch.is_tensor(value):
+        return value.nelement() * value.element_size()
+    # a compressed payload
+    return payload_nbytes(value)
+
+
+class CommMeter():
+    def __init__(self, model, runlog=None):
+        self.param_names = set(name for name, _ in model.named_parameters())
+        self.runlog = runlog
+        self.total = 0
+        # edge aggregation adds from its worker threads
+        self.lock = threading.Lock()
+
+    def start_round(self, r):
+        self.round = r
+        self.clients = {}
+
+    def add(self, client_idx, direction, state, category=None, keys=None):
+        '''
+            count state[key] for keys (default: all of them) as moving in
+            direction ('down' or 'up') for client_idx
+        '''
+        assert(direction in ['down', 'up'])
+        nbytes = {}
+        for key in (keys if keys is not None else state.keys()):
+            cat = category
+            if cat is None:
+                cat = 'params' if key in self.param_names else 'buffers'
+            name = '{}_{}'.format(direction, cat)
+            nbytes[name] = nbytes.get(name, 0) + value_nbytes(state[key])
+        with self.lock:
+            counts = self.clients.setdefault(client_idx, {
+                '{}_{}'.format(d, c): 0 for d in ['down', 'up'] for c in CATEGORIES
+            })
+            for name, n in nbytes.items():
+                counts[name] += n
+
+    def client_bytes(self, client_idx, direction):
+        counts = self.clients.get(client_idx, {})
+        return sum(counts.get('{}_{}'.format(direction, c), 0) for c in CATEGORIES)
+
+    def end_round(self):
+        down = 0
+        up = 0
+        with self.lock:
+            clients = {client_idx: dict(counts) for client_idx, counts in self.clients.items()}
+        for client_idx in sorted(clients.keys()):
+            counts = clients[client_idx]
+            down += sum(counts['down_{}'.format(c)] for c in CATEGORIES)
+            up += sum(counts['up_{}'.format(c)] for c in CATEGORIES)
+            if self.runlog:
+                self.runlog.write('comm', round=self.round, client=client_idx, **counts)
+        with self.lock:
+            self.total += down + up
+        if self.runlog:
+            self.runlog.write('comm_round', round=self.round, down=down, up=up, total=self.total)
+            self.runlog.flush()
+        return down, up, self.total
+
+    def log_line(self, down, up, total):
+        return ' comm   | Down: {:.2f} MB | Up: {:.2f} MB | Total: {:.2f} MB'.format(down / 2**20, up / 2**20, total / 2**20)
@@ -0,0 +1,184 @@
+'''
+    Client update compression with error feedback
+
+        Sits between local training and aggregation. A client update is a
+        dict {name: tensor} of deltas (trained - global, or Scaffold's
+        delta_model). Every floating point tensor is encoded with one of
+
+            topk:  the k = ratio * numel largest magnitudes, as (index, value)
+            randk: k random entries, as (index, value)
+            q8/q4: stochastic uniform quantization to 8 / 4 bits (4 bits are
+                   packed two per byte), with a per-tensor min and scale
+            sign:  the signs packed to one bit each, scaled by mean |x|
+
+        Integer tensors (num_batches_tracked) are sent raw.
+
+        With error feedback every client keeps the residual its last upload
+        did not transmit and adds it to its next update. The residuals live
+        in a ClientStateStore, so they spill to disk like the other client
+        state.
+
+    How to use:
+        compressor = UpdateCompressor('topk', ratio=0.01, residuals=store)
+        encoded = compressor.encode(client_idx, update)
+        compressor.decode_add(acc, encoded, weight)     # acc[name] += weight * update[name]
+        ratio = compressor.round_ratio()                # raw bytes / sent bytes since last call
+'''
+
+import threading
+
+import torch
+
+COMPRESSORS = ['none', 'topk', 'randk', 'q8', 'q4', 'sign']
+
+
+def pack_bits(values, nbits):
+    # values: flat uint8 tensor, every value < 2 ** nbits
+    per_byte = 8 // nbits
+    pad = (-values.numel()) % per_byte
+    values = torch.cat([values, values.new_zeros(pad)]).view(-1, per_byte)
+    shifts = torch.arange(per_byte, dtype=torch.uint8, device=values.device) * nbits
+    return (values << shifts).sum(dim=1).to(torch.uint8)
+
+
+def unpack_bits(packed, nbits, numel):
+    per_byte = 8 // nbits
+    shifts = torch.arange(per_byte, dtype=torch.uint8, device=packed.device) * nbits
+    values = (packed.unsqueeze(1) >> shifts) & (2 ** nbits - 1)
+    return values.view(-1)[:numel]
+
+
+def payload_nbytes(payload):
+    nbytes = 0
+    for value in payload.values():
+        if torch.is_tensor(value):
+            nbytes += value.nelement() * value.element_size()
+        elif isinstance(value, float):
+            nbytes += 4
+    return nbytes
+
+
+class UpdateCompressor():
+    def __init__(self, method, ratio=0.01, error_feedback=True, residuals=None):
+        assert(method in COMPRESSORS)
+        self.method = method
+        self.ratio = ratio # share of entries kept by topk / randk
+        self.error_feedback = error_feedback
+        self.residuals = residuals # ClientStateStore of the error feedback residuals
+
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        # edge aggregators may encode from several threads
+        self.lock = threading.Lock()
+
+    def encode(self, client_idx, update):
+        residual = None
+        if self.error_feedback and self.residuals is not None:
+            residual = self.residuals.get(client_idx)
+
+        encoded = {}
+        new_residual = {}
+        for name, t in update.items():
+            t = t.detach()
+            if not t.is_floating_point() or self.method == 'none':
+                encoded[name] = {'kind': 'raw', 'value': t}
+            else:
+                if residual is not None:
+                    t = t + residual[name].to(t.device)
+                encoded[name] = self.encode_tensor(t)
+                if self.error_feedback:
+                    new_residual[name] = t - self.decode_tensor(encoded[name])
+            with self.lock:
+                self.raw_bytes += t.nelement() * t.element_size()
+                self.sent_bytes += payload_nbytes(encoded[name])
+
+        if self.error_feedback and self.residuals is not None and new_residual:
+            self.residuals.put(client_idx, new_residual)
+        return encoded
+
+    def encode_tensor(self, t):
+        flat = t.reshape(-1)
+        numel = flat.numel()
+        if self.method in ['topk', 'randk']:
+            k = max(1, int(self.ratio * numel))
+            if self.method == 'topk':
+                _, index = flat.abs().topk(k, sorted=False)
+            else:
+                index = torch.randperm(numel, device=flat.device)[:k]
+            return {'kind': 'sparse', 'shape': t.shape, 'index': index, 'value': flat[index]}
+
+        if self.method in ['q8', 'q4']:
+            nbits = 8 if self.method == 'q8' else 4
+            levels = 2 ** nbits - 1
+            lo, hi = flat.min(), flat.max()
+            scale = ((hi - lo) / levels).item() or 1.
+            # stochastic rounding keeps the quantizer unbiased
+            q = torch.floor((flat - lo) / scale + torch.rand_like(flat)).clamp_(0, levels).to(torch.uint8)
+            if nbits == 4:
+                q = pack_bits(q, 4)
+            return {'kind': 'quant', 'shape': t.shape, 'nbits': nbits, 'q': q, 'lo': lo.item(), 'scale': scale}
+
+        # sign
+        return {'kind': 'sign', 'shape': t.shape, 'bits': pack_bits((flat >= 0).to(torch.uint8), 1),
+                'scale': flat.abs().mean().item()}
+
+    def expected_nbytes(self, state, keys=None):
+        '''
+            bytes an upload of state[keys] will take once encoded, known
+            before encoding since no method depends on the values
+        '''
+        nbytes = 0
+        for key in (keys if keys is not None else state.keys()):
+            t = state[key]
+            numel = t.nelement()
+            if not t.is_floating_point() or self.method == 'none':
+                nbytes += numel * t.element_size()
+            elif self.method in ['topk', 'randk']:
+                # int64 index and value per kept entry
+                nbytes += max(1, int(self.ratio * numel)) * (8 + t.element_size())
+            elif self.method == 'q8':
+                nbytes += numel + 8
+            elif self.method == 'q4':
+                nbytes += (numel + 1) // 2 + 8
+            else:
+                nbytes += (numel + 7) // 8 + 4
+        return nbytes
+
+    def decode_tensor(self, payload):
+        kind = payload['kind']
+        if kind == 'raw':
+            return payload['value']
+        shape = payload['shape']
+        numel = shape.numel()
+        if kind == 'sparse':
+            dense = torch.zeros(numel, dtype=payload['value'].dtype, device=payload['value'].device)
+            dense[payload['index']] = payload['value']
+            return dense.view(shape)
+        if kind == 'quant':
+            q = payload['q']
+            if payload['nbits'] == 4:
+                q = unpack_bits(q, 4, numel)
+            return (payload['lo'] + q.float() * payload['scale']).view(shape)
+        bits = unpack_bits(payload['bits'], 1, numel)
+        return (payload['scale'] * (2. * bits.float() - 1.)).view(shape)
+
+    def decode_add(self, acc, encoded, weight):
+        '''
+            acc[name] += weight * decoded update, sparse payloads are
+            scatter-added without building the dense tensor
+        '''
+        for name, payload in encoded.items():
+            if name not in acc:
+                continue
+            if payload['kind'] == 'sparse':
+                acc[name].view(-1).index_add_(0, payload['index'].to(acc[name].device),
+                                              (weight * payload['value']).to(acc[name].device, acc[name].dtype))
+            else:
+                acc[name] += weight * self.decode_tensor(payload).to(acc[name].device, acc[name].dtype)
+
+    def round_ratio(self):
+        ratio = self.raw_bytes / self.sent_bytes if self.sent_bytes else 1.
+        sent = self.sent_bytes
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        return ratio, sent
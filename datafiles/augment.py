@@ -0,0 +1,137 @@
+'''
+Batch-level augmentation
+
+The per-sample PIL transforms (RandomCrop, RandomHorizontalFlip) cost more
+than the step of a small model, so the augmentation works on whole batches
+after collation, a few tensor ops per batch:
+
+    crop      pad by `pad` and take a random HxW window per sample (index offsets)
+    flip      horizontal flip of a random half of the batch (masked flip)
+    cutout    zero a random `cutout`x`cutout` square per sample
+
+Each client has its own generator seeded from the run's seed and its index,
+so a client sees the same augmentations whatever the others do. Only the
+training loaders are augmented.
+
+How to use:
+    ops = augment_ops('cifar10', 'on')   # the dataset's defaults, or e.g. 'crop,cutout'
+    loader = AugmentedLoader(loader, BatchAugment(ops, pad=4, cutout=8, seed=seed * 1000 + client))
+'''
+
+import torch
+
+from profiler import phase
+
+# what 'on' means per dataset, datasets without an entry stay as they are
+augment_defaults = {'cifar10': ['crop', 'flip'],
+                    'svhn': ['crop'], # no flip for digits
+                    'synth_cifar10': ['crop', 'flip']}
+
+OPS = ['crop', 'flip', 'cutout']
+
+
+def augment_ops(dataset, spec):
+    '''
+        spec: off | on (the dataset's defaults) | comma separated ops
+    '''
+    if spec == 'off':
+        return []
+    if spec == 'on':
+        return augment_defaults.get(dataset, [])
+    ops = spec.split(',')
+    for op in ops:
+        if op not in OPS:
+            raise ValueError("UNDEFINED AUGMENTATION " + op)
+    return ops
+
+
+class BatchAugment():
+    def __init__(self, ops, pad=4, cutout=8, seed=0):
+        self.ops = ops
+        self.pad = pad
+        self.cutout = cutout
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def random(self, *size):
+        return torch.rand(size, generator=self.generator)
+
+    def offsets(self, n, high):
+        return torch.randint(0, high, (n,), generator=self.generator)
+
+    def crop(self, x):
+        b, c, h, w = x.shape
+        padded = torch.nn.functional.pad(x, (self.pad, self.pad, self.pad, self.pad))
+        top = self.offsets(b, 2 * self.pad + 1).to(x.device)
+        left = self.offsets(b, 2 * self.pad + 1).to(x.device)
+        rows = top[:, None] + torch.arange(h, device=x.device) # (B, H)
+        cols = left[:, None] + torch.arange(w, device=x.device) # (B, W)
+        batch = torch.arange(b, device=x.device)[:, None, None]
+        # the advanced indices go first: (B, H, W, C)
+        return padded[batch, :, rows[:, :, None], cols[:, None, :]].permute(0, 3, 1, 2)
+
+    def flip(self, x):
+        mask = (self.random(x.shape[0]) < 0.5).to(x.device)
+        return torch.where(mask[:, None, None, None], x.flip(3), x)
+
+    def erase(self, x):
+        b, c, h, w = x.shape
+        s = self.cutout
+        # centers anywhere in the image, the square may stick out
+        top = (self.offsets(b, h) - s // 2).to(x.device)
+        left = (self.offsets(b, w) - s // 2).to(x.device)
+        ys = torch.arange(h, device=x.device)[None, :]
+        xs = torch.arange(w, device=x.device)[None, :]
+        inside_y = (ys >= top[:, None]) & (ys < top[:, None] + s) # (B, H)
+        inside_x = (xs >= left[:, None]) & (xs < left[:, None] + s) # (B, W)
+        mask = inside_y[:, :, None] & inside_x[:, None, :]
+        return x.masked_fill(mask[:, None], 0.)
+
+    def __call__(self, x):
+        if 'crop' in self.ops and self.pad > 0:
+            x = self.crop(x)
+        if 'flip' in self.ops:
+            x = self.flip(x)
+        if 'cutout' in self.ops and self.cutout > 0:
+            x = self.erase(x)
+        return x
+
+
+class AugmentedIterator():
+    def __init__(self, iterator, augment, length):
+        self.iterator = iterator
+        self.augment = augment
+        self.length = length
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        x, y = next(self.iterator)
+        with phase('augment'):
+            x = self.augment(x)
+        return x, y
+
+    def __len__(self):
+        # the training loops take len(iter(loader))
+        return self.length
+
+
+class AugmentedLoader():
+    '''
+        a loader whose batches go through augment, the rest is the loader's
+    '''
+    def __init__(self, loader, augment):
+        self.loader = loader
+        self.augment = augment
+
+    def __iter__(self):
+        return AugmentedIterator(iter(self.loader), self.augment, len(self.loader))
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # dataset, batch_size, ...
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
@@ -0,0 +1,175 @@
+'''
+Background prefetching of client batches
+
+The training loops take a batch, move it with .to(device).float() and only
+then compute, so loading (indexing, the transform chain, the skew noise or
+filter, the batch augmentation) and compute never overlap. PrefetchLoader
+prepares the next `depth` batches on a background thread: it draws them from
+the loader, augments them and moves the samples to the device as float (on
+a side CUDA stream from pinned memory, the consumer waits for the copy only).
+The labels stay as the loader gives them, the loops convert them.
+
+The loops are unchanged, their .to(device).float() of a prepared batch is a
+no-op. Every loader adds to the module's totals:
+
+    batches   batches handed out
+    prepare   seconds the thread spent preparing them
+    wait      seconds the training loop waited for one (its 'data' phase)
+    overlap   share of the preparation hidden behind compute, 1 - wait / prepare
+
+How to use:
+    loader = PrefetchLoader(loader, depth=2, device=device)
+    for x, y in loader:   # x already on device, float
+        ...
+    print(summary_line())
+'''
+
+import queue
+import threading
+import time
+
+import torch
+
+from .augment import AugmentedLoader
+
+_lock = threading.Lock()
+totals = {'batches': 0, 'prepare': 0., 'wait': 0., 'empty': 0}
+
+DONE = object()
+
+
+def add(**counts):
+    with _lock:
+        for key, n in counts.items():
+            totals[key] += n
+
+
+def stats(counts=None):
+    '''
+        the totals of this process, or of counts (e.g. summed over processes), with the overlap
+    '''
+    if counts is None:
+        with _lock:
+            counts = dict(totals)
+    result = dict(counts)
+    result['overlap'] = max(1. - result['wait'] / result['prepare'], 0.) if result['prepare'] > 0 else 0.
+    return result
+
+
+def summary_line(s=None):
+    s = s or stats()
+    return ' prefetch | Batches: {} | Prepare: {:.2f}s | Wait: {:.2f}s | Overlap: {:.1f}% | Queue empty: {}'.format(
+        s['batches'], s['prepare'], s['wait'], 100 * s['overlap'], s['empty'])
+
+
+def produce(batches, prepare, out, stop):
+    '''
+        the thread: prepared batches into out until the loader is done or stop is set
+    '''
+    try:
+        while True:
+            # drawing the batch (indexing, transforms, skew) counts as preparing it
+            start = time.perf_counter()
+            try:
+                x, y = next(batches)
+            except StopIteration:
+                break
+            item = prepare(x, y)
+            add(prepare=time.perf_counter() - start)
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                return
+        out.put(DONE)
+    except Exception as e:
+        # raised again on the training thread
+        out.put(e)
+
+
+class PrefetchIterator():
+    def __init__(self, loader):
+        self.length = len(loader)
+        self.queue = queue.Queue(maxsize=loader.depth)
+        self.stop = threading.Event()
+        # the thread holds no reference to the iterator, dropping it stops the thread
+        self.thread = threading.Thread(target=produce,
+                                       args=(iter(loader.source), loader.prepare, self.queue, self.stop),
+                                       daemon=True)
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        empty = self.queue.empty()
+        start = time.perf_counter()
+        item = self.queue.get()
+        add(wait=time.perf_counter() - start, empty=int(empty))
+        if item is DONE:
+            self.stop.set()
+            raise StopIteration
+        if isinstance(item, Exception):
+            self.stop.set()
+            raise item
+        x, y, event = item
+        if event is not None:
+            stream = torch.cuda.current_stream(x.device)
+            stream.wait_event(event)
+            x.record_stream(stream)
+        add(batches=1)
+        return x, y
+
+    def __len__(self):
+        # the training loops take len(iter(loader))
+        return self.length
+
+    def __del__(self):
+        # e.g. a loop that leaves after its first batch
+        self.stop.set()
+
+
+class PrefetchLoader():
+    '''
+        a loader whose next `depth` batches are prepared on a background thread
+    '''
+    def __init__(self, loader, depth=2, device=None):
+        self.loader = loader
+        self.depth = depth
+        self.device = device
+        # the augmentation runs on the thread too, outside the profiler's phases
+        if isinstance(loader, AugmentedLoader):
+            self.source, self.augment = loader.loader, loader.augment
+        else:
+            self.source, self.augment = loader, None
+        self.stream = None
+        if device is not None and torch.device(device).type == 'cuda':
+            self.stream = torch.cuda.Stream(device)
+
+    def prepare(self, x, y):
+        if self.augment is not None:
+            x = self.augment(x)
+        if self.device is None:
+            return x.float(), y, None
+        if self.stream is None:
+            return x.to(self.device).float(), y, None
+        with torch.cuda.stream(self.stream):
+            x = x.pin_memory().to(self.device, non_blocking=True).float()
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return x, y, event
+
+    def __iter__(self):
+        return PrefetchIterator(self)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # dataset, batch_size, ...
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
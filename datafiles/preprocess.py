@@ -2,8 +2,34 @@ from .pydatasets.CIFAR10 import CIFAR10_Dataset
 from .pydatasets.KMNIST import KMNIST_Dataset
 from .pydatasets.MNIST import MNIST_Dataset
 from .pydatasets.SVHN import SVHN_Dataset
+from .pydatasets.SYNTHETIC import SYNTHETIC_MNIST_Dataset, SYNTHETIC_CIFAR10_Dataset
+from .pydatasets.SYNTHETIC import configure as configure_synthetic
 import torchvision.transforms as transforms
 
+name2func = { #'celeba': CELEBA_Dataset,
+             'cifar10': CIFAR10_Dataset,
+             'kmnist': KMNIST_Dataset,
+             'mnist': MNIST_Dataset,
+             'svhn': SVHN_Dataset,
+             # drawn from a seed, offline and at any size, see configure_synthetic()
+             'synth_mnist': SYNTHETIC_MNIST_Dataset,
+             'synth_cifar10': SYNTHETIC_CIFAR10_Dataset}
+synthetic_names = ['synth_mnist', 'synth_cifar10']
+
+
+def transform_steps():
+    # every dataset goes through the same chain, one sample at a time
+    steps = [transforms.ToPILImage(),
+             transforms.Resize([32,32]),
+             transforms.Grayscale(num_output_channels=3)]
+
+    # random crops and flips are done per batch, see datafiles/augment.py
+
+    steps.append(transforms.ToTensor())
+    steps.append(transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
+    return steps
+
+
 def preprocess(dataset_name,
                indices=None,
                noise=False,
@@ -12,14 +38,6 @@ def preprocess(dataset_name,
                filter=False,
                filter_sz=3):
 
-    augment_dataset_name = ['cifar10']
-
-    name2func = { #'celeba': CELEBA_Dataset,
-                 'cifar10': CIFAR10_Dataset,
-                 'kmnist': KMNIST_Dataset,
-                 'mnist': MNIST_Dataset,
-                 'svhn': SVHN_Dataset}
-    
     rootp = './datafiles/datasets/'
     rootp += dataset_name
 
@@ -28,25 +46,7 @@ def preprocess(dataset_name,
     if dataset_func == None:
         raise ValueError("DATASET NOT IMPLEMENTED")
 
-    tf_train = [ transforms.ToPILImage(),
-                transforms.Resize([32,32]),
-                transforms.Grayscale(num_output_channels=3)]
-
-    tf_test = [ transforms.ToPILImage(),
-                transforms.Resize([32,32]),
-                transforms.Grayscale(num_output_channels=3),
-                transforms.ToTensor(),
-                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
-
-    # if dataset_name in augment_dataset_name:
-    #     tf_train.append(transforms.RandomCrop(28))
-    #     tf_train.append(transforms.RandomHorizontalFlip())
-
-    tf_train.append(transforms.ToTensor())
-    tf_train.append(transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
-
-    tf_train = transforms.Compose(tf_train)
-    tf_test = transforms.Compose(tf_test)
+    tf_train = transforms.Compose(transform_steps())
 
     train_set = dataset_func(rootp=rootp,
                              train=True,
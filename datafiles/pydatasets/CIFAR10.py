@@ -3,6 +3,8 @@ import torch.nn.functional as F
 import numpy as np
 import torch
 from .datasets import GeneralDataset
+from ..registry import open_verified
+from ..shared import attach
 from ..utils import add_gaussian_noise
 
 class CIFAR10_Dataset(GeneralDataset):
@@ -47,17 +49,26 @@ class CIFAR10_Dataset(GeneralDataset):
                          tf,
                          ttf,
                          dld):
-        # download dataset to root
-        obj = datasets.CIFAR10(root, train, tf, ttf, dld)
+        # decoded once for the whole machine when a dataset server runs, see datafiles/shared.py
+        shared = attach('cifar10', train, tf, self.indices if self.indices is not None and self.train else None)
+        if shared is not None:
+            x, y, self.tf = shared
+            return x, y
 
-        x, y = obj.data, obj.targets
-        x = np.transpose(x, (0, 3, 1, 2))
-        x, y = torch.from_numpy(x).float(), torch.from_numpy(np.array(y)).float()
+        # download dataset to root, checked once, later opened from the registry
+        def build():
+            obj = datasets.CIFAR10(root, train, tf, ttf, dld)
+            return obj.data, np.array(obj.targets)
+
+        x, y = open_verified(root, 'train' if train else 'test', build)
 
         if self.indices is not None and self.train:
             x = x[self.indices]
             y = y[self.indices]
-        
+
+        x = np.transpose(x, (0, 3, 1, 2))
+        x, y = torch.from_numpy(x.astype(np.float32)), torch.from_numpy(y.astype(np.float32))
+
         return x, y
 
     def __getitem__(self, index):
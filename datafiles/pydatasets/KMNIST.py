@@ -2,7 +2,10 @@ import torchvision.datasets as datasets
 import torch
 import torch.nn.functional as F
 from PIL import Image
+import numpy as np
 from .datasets import GeneralDataset
+from ..registry import open_verified
+from ..shared import attach
 from ..utils import add_gaussian_noise
 
 class KMNIST_Dataset(GeneralDataset):
@@ -46,19 +49,28 @@ class KMNIST_Dataset(GeneralDataset):
                          tf,
                          ttf,
                          dld):
-        # download dataset to root
-        obj = datasets.MNIST(root, train, tf, ttf, dld)
+        # decoded once for the whole machine when a dataset server runs, see datafiles/shared.py
+        shared = attach('kmnist', train, tf, self.indices if self.indices is not None and self.train else None)
+        if shared is not None:
+            x, y, self.tf = shared
+            return x, y
 
-        x, y = obj.data, obj.targets
-        x, y = x.float(), y.float()
+        # download dataset to root, checked once, later opened from the registry
+        def build():
+            obj = datasets.MNIST(root, train, tf, ttf, dld)
+            return obj.data.numpy(), obj.targets.numpy()
+
+        x, y = open_verified(root, 'train' if train else 'test', build)
 
-        if len(x.shape) == 3: # (B, H, W)
-            x = torch.unsqueeze(x, 1)
-        
         if self.indices is not None and self.train:
             x = x[self.indices]
             y = y[self.indices]
-        
+
+        x, y = torch.from_numpy(x.astype(np.float32)), torch.from_numpy(y.astype(np.float32))
+
+        if len(x.shape) == 3: # (B, H, W)
+            x = torch.unsqueeze(x, 1)
+
         return x, y
     
     def __getitem__(self, index):
@@ -1,7 +1,10 @@
 import torchvision.datasets as datasets
 import torch
 import torch.nn.functional as F
+import numpy as np
 from .datasets import GeneralDataset
+from ..registry import open_verified
+from ..shared import attach
 from ..utils import add_gaussian_noise
 
 class SVHN_Dataset(GeneralDataset):
@@ -45,20 +48,28 @@ class SVHN_Dataset(GeneralDataset):
                          tf,
                          ttf,
                          dld):
-        # download dataset to root
-        obj = datasets.SVHN(root, train, tf, ttf, dld)
+        # decoded once for the whole machine when a dataset server runs, see datafiles/shared.py
+        shared = attach('svhn', train, tf, self.indices if self.indices is not None and self.train == 'train' else None)
+        if shared is not None:
+            x, y, self.tf = shared
+            return x, y
 
-        x, y = obj.data, obj.labels
-        x, y = torch.from_numpy(x), torch.from_numpy(y)
-        x, y = x.float(), y.float()
+        # download dataset to root, checked once, later opened from the registry
+        def build():
+            obj = datasets.SVHN(root, train, tf, ttf, dld)
+            return obj.data, obj.labels
 
-        if len(x.shape) == 3: # (B, H, W)
-            x = torch.unsqueeze(x, 1)
+        x, y = open_verified(root, train, build)
 
         if self.indices is not None and self.train == 'train':
             x = x[self.indices]
             y = y[self.indices]
-        
+
+        x, y = torch.from_numpy(x.astype(np.float32)), torch.from_numpy(y.astype(np.float32))
+
+        if len(x.shape) == 3: # (B, H, W)
+            x = torch.unsqueeze(x, 1)
+
         return x, y
 
     def __getitem__(self, index):
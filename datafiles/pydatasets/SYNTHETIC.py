@@ -0,0 +1,158 @@
+import torch
+import torch.nn.functional as F
+from .datasets import GeneralDataset
+from ..utils import add_gaussian_noise
+
+# samples are drawn chunk by chunk, a chunk is a function of (seed, train, chunk index)
+CHUNK = 1024
+
+# set from the run's arguments before the datasets are built, see configure()
+settings = {'size': 0, 'nlabel': 10, 'seed': 0}
+
+
+def configure(size=0, nlabel=10, seed=0):
+    '''
+        size: training samples, 0 for the size of the real dataset (the test
+        set scales along); nlabel: number of classes
+    '''
+    settings['size'] = size
+    settings['nlabel'] = nlabel
+    settings['seed'] = seed
+
+
+class SYNTHETIC_Dataset(GeneralDataset):
+    '''
+        Class-conditional gaussian blobs around one smooth random prototype
+        image per label, deterministic from the seed, nothing to download.
+        Shaped and scaled (0..255 floats) like the real dataset it stands
+        for, so the transforms and every skew of skew.py apply unchanged.
+    '''
+    shape = (1, 28, 28)
+    train_size = 60000
+    test_size = 10000
+    spread = 0.25 # noise std around the prototypes, in units of the value range
+
+    def __init__(self,
+                 rootp,
+                 train,
+                 transform=None,
+                 target_transform=None,
+                 download=False,
+                 indices=None,
+                 noise=False,
+                 noise_mean=0.,
+                 noise_std=1.,
+                 filter=False,
+                 filter_sz=3):
+
+        self.root = rootp # unused, nothing is stored
+        self.train = train # train?
+        self.tf = transform # tf(x)
+        self.ttf = target_transform # ttf(y)
+        self.dld = download # unused
+        self.indices = indices # which part of dset you want?
+
+        self.noise = noise
+        self.noise_mean = noise_mean
+        self.noise_std = noise_std
+
+        self.filter = filter
+        self.filter_sz = filter_sz
+
+        self.nlabel = settings['nlabel']
+        self.seed = settings['seed']
+        size = settings['size'] or self.train_size
+        self.nsample = size if train else max(1, size * self.test_size // self.train_size)
+
+        self.x, self.y = self.download_dataset(self.root,
+                                               self.train,
+                                               self.tf,
+                                               self.ttf,
+                                               self.dld)
+
+    def prototypes(self):
+        # the same for train and test: coarse random patterns blown up to the image size
+        g = torch.Generator().manual_seed(self.seed)
+        c, h, w = self.shape
+        coarse = torch.rand((self.nlabel, c, 7, 7), generator=g)
+        return F.interpolate(coarse, size=(h, w), mode='bilinear', align_corners=False) * 255
+
+    def labels(self):
+        g = torch.Generator().manual_seed(self.seed * 2 + int(bool(self.train)) + 1)
+        return torch.randint(0, self.nlabel, (self.nsample,), generator=g)
+
+    def draw(self, indices, y):
+        '''
+            the samples at indices, only the chunks holding them are generated
+        '''
+        protos = self.prototypes()
+        x = torch.empty((len(indices),) + self.shape)
+        chunks = indices // CHUNK
+        order = torch.argsort(chunks, stable=True)
+        ids, counts = torch.unique_consecutive(chunks[order], return_counts=True)
+        end = 0
+        for chunk, count in zip(ids.tolist(), counts.tolist()):
+            rows = order[end:end + count]
+            end += count
+            g = torch.Generator().manual_seed(((self.seed * 2 + int(bool(self.train))) << 32) + chunk)
+            start = chunk * CHUNK
+            blob = torch.randn((min(CHUNK, self.nsample - start),) + self.shape, generator=g) * (self.spread * 255)
+            offsets = indices[rows] - start
+            x[rows] = (protos[y[indices[rows]]] + blob[offsets]).clamp_(0, 255)
+        return x
+
+    def download_dataset(self,
+                         root,
+                         train,
+                         tf,
+                         ttf,
+                         dld):
+        # nothing to download, the samples are drawn
+        y = self.labels()
+
+        if self.indices is not None and self.train:
+            indices = torch.as_tensor(self.indices, dtype=torch.long)
+        else:
+            indices = torch.arange(self.nsample)
+        x = self.draw(indices, y)
+        y = y[indices]
+
+        x, y = x.float(), y.float()
+        return x, y
+
+    def __getitem__(self, index):
+        x, y = self.x[index], self.y[index]
+
+        if self.tf:
+            x = self.tf(x)
+        if self.ttf:
+            y = self.ttf(y)
+
+        if self.noise:
+            x = add_gaussian_noise(x,
+                                   mean=self.noise_mean,
+                                   std=self.noise_std)
+
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if self.filter:
+            x = x.to(device)
+            y = y.to(device)
+            sz = [[1 for _ in range(self.filter_sz)] for _ in range(self.filter_sz)]
+            filt = torch.tensor(sz) / (self.filter_sz ** 2)
+            filt = filt.expand(3, 3, self.filter_sz, self.filter_sz)
+            filt.to(device)
+            x = F.conv2d(x, filt, stride=1, padding=1)
+
+        return x, y
+
+
+class SYNTHETIC_MNIST_Dataset(SYNTHETIC_Dataset):
+    shape = (1, 28, 28)
+    train_size = 60000
+    test_size = 10000
+
+
+class SYNTHETIC_CIFAR10_Dataset(SYNTHETIC_Dataset):
+    shape = (3, 32, 32)
+    train_size = 50000
+    test_size = 10000
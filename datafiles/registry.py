@@ -0,0 +1,168 @@
+'''
+Verified-once dataset registry
+
+The first time a dataset split is opened it is built the usual way (the
+torchvision class with download=True, which checks the files and their MD5)
+and its decoded arrays are stored next to it as .npy. A manifest in the
+dataset's root records a fingerprint (size, mtime, sha1) of every source
+file and of the arrays. Later calls only compare sizes and mtimes against
+the manifest and memory-map the arrays: no integrity checks, no decoding.
+A changed or missing file rebuilds the split.
+
+Within a process an opened split is kept, so the clients of a skew share it.
+Processes building the same split at once wait for each other (flock).
+
+How to use:
+    def build():
+        obj = datasets.CIFAR10(root, train, tf, ttf, True)
+        return obj.data, np.array(obj.targets)
+    x, y = open_verified(root, 'train', build)   # numpy arrays, x memory-mapped
+
+    python -m datafiles.registry ./datafiles/datasets/cifar10   # re-hash and compare
+'''
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+MANIFEST = 'registry.json'
+CACHE_DIR = 'registry'
+LOCK = 'registry.lock'
+
+_opened = {} # (root, split) -> (x, y)
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def fingerprint(path, hash=True):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, file_hash(path) if hash else None]
+
+
+def source_files(root):
+    # everything the torchvision class left in root, our own files aside
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) != os.path.join(root, CACHE_DIR)]
+        for name in filenames:
+            if dirpath == root and name in [MANIFEST, LOCK]:
+                continue
+            files.append(os.path.relpath(os.path.join(dirpath, name), root))
+    return sorted(files)
+
+
+def read_manifest(root):
+    try:
+        with open(os.path.join(root, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(root, manifest):
+    path = os.path.join(root, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def fresh(root, entry):
+    '''
+        every file of the entry still has the size and mtime it was verified with
+    '''
+    for rel, (size, mtime, _) in list(entry['sources'].items()) + list(entry['arrays'].items()):
+        try:
+            st = os.stat(os.path.join(root, rel))
+        except OSError:
+            return False
+        if st.st_size != size or st.st_mtime_ns != mtime:
+            return False
+    # a file the torchvision class added since would not be covered
+    return sorted(entry['sources']) == source_files(root)
+
+
+def load(root, entry):
+    x = np.load(os.path.join(root, entry['x']), mmap_mode='r')
+    y = np.load(os.path.join(root, entry['y']))
+    return x, y
+
+
+def save_array(root, rel, array):
+    path = os.path.join(root, rel)
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(path + '.tmp', path)
+
+
+def open_verified(root, split, build):
+    '''
+        (data, targets) of a split as numpy arrays, from the registry when its
+        files are unchanged, otherwise from build() (then recorded)
+    '''
+    key = (os.path.abspath(root), split)
+    if key in _opened:
+        return _opened[key]
+
+    entry = read_manifest(root).get(split)
+    if entry is not None and fresh(root, entry):
+        _opened[key] = load(root, entry)
+        return _opened[key]
+
+    if not os.path.exists(root):
+        os.makedirs(root)
+    with open(os.path.join(root, LOCK), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # another process may have recorded it while we waited
+        entry = read_manifest(root).get(split)
+        if entry is None or not fresh(root, entry):
+            x, y = build()
+            x, y = np.asarray(x), np.asarray(y)
+            if not os.path.exists(os.path.join(root, CACHE_DIR)):
+                os.makedirs(os.path.join(root, CACHE_DIR))
+            entry = {'x': os.path.join(CACHE_DIR, split + '_x.npy'), 'y': os.path.join(CACHE_DIR, split + '_y.npy')}
+            save_array(root, entry['x'], x)
+            save_array(root, entry['y'], y)
+            entry['sources'] = {rel: fingerprint(os.path.join(root, rel)) for rel in source_files(root)}
+            entry['arrays'] = {entry['x']: fingerprint(os.path.join(root, entry['x'])),
+                               entry['y']: fingerprint(os.path.join(root, entry['y']))}
+            entry['shape'] = list(x.shape)
+            entry['verified'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+            manifest = read_manifest(root)
+            manifest[split] = entry
+            write_manifest(root, manifest)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    _opened[key] = load(root, entry)
+    return _opened[key]
+
+
+def verify(root):
+    '''
+        re-hash every recorded file, the names of those that differ
+    '''
+    bad = []
+    for split, entry in read_manifest(root).items():
+        for rel, (size, mtime, digest) in list(entry['sources'].items()) + list(entry['arrays'].items()):
+            path = os.path.join(root, rel)
+            if not os.path.exists(path) or file_hash(path) != digest:
+                bad.append('{}: {}'.format(split, rel))
+    return bad
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('roots', type=str, nargs='+', help='dataset roots, e.g. ./datafiles/datasets/cifar10')
+    args = parser.parse_args()
+    for root in args.roots:
+        bad = verify(root)
+        print('{} | {} splits | {}'.format(root, len(read_manifest(root)), 'ok' if not bad else 'changed: ' + ', '.join(bad)))
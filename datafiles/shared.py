@@ -0,0 +1,203 @@
+'''
+Shared-memory dataset server
+
+Every process of a sweep decodes the same datasets into its own float
+tensors, and in the feature skews every client holds a full copy of the
+training set. The server decodes each (dataset, split, transform) once into
+/dev/shm; the pydatasets classes attach to it by name and map the arrays
+read-only, so the processes and clients on the machine share one copy.
+Without a server (or with a stale one) the classes load privately as before.
+
+An entry holds the float samples as the class would (raw), or with the
+transform chain of preprocess() already applied (--transform preprocess),
+which also saves the per-sample PIL work; a dataset attaching with that very
+chain then gets no transform. The chain must be deterministic.
+
+The entries live as long as the server: it removes them on Ctrl-C / SIGTERM,
+unless --keep (then rm -r /dev/shm/fl-datasets).
+
+How to use:
+    python -m datafiles.shared --datasets cifar10,svhn --transform preprocess &
+    python FedBN_label_weighted.py --dataset cifar10 ...   # attaches
+    python -m datafiles.shared --list
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import signal
+import time
+import warnings
+
+import numpy as np
+import torch
+
+SHM_ROOT = os.environ.get('FL_SHM_ROOT', '/dev/shm/fl-datasets')
+
+# attaching can be turned off, e.g. to time the private pipeline
+settings = {'attach': True}
+
+
+def split_name(train):
+    # SVHN takes the split name, the others a bool
+    if isinstance(train, str):
+        return train
+    return 'train' if train else 'test'
+
+
+def transform_key(tf):
+    if tf is None:
+        return 'raw'
+    return hashlib.sha1(repr(tf).encode()).hexdigest()[:12]
+
+
+def entry_path(name, split, key):
+    return os.path.join(SHM_ROOT, '{}.{}.{}'.format(name, split, key))
+
+
+def alive(pid):
+    if pid == 0: # kept after the server
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if alive(meta['pid']) else None
+
+
+def as_tensor(array):
+    # the mapping is read-only, torch warns about it once and never writes
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        return torch.from_numpy(array)
+
+
+def attach(name, train, tf, indices=None):
+    '''
+        (x, y, tf) from the server, tf being what is left to apply per sample,
+        or None when it does not hold the dataset
+    '''
+    if not settings['attach']:
+        return None
+    split = split_name(train)
+    for key, rest in [(transform_key(tf), None), ('raw', tf)]:
+        path = entry_path(name, split, key)
+        if read_meta(path) is None:
+            continue
+        x = np.load(os.path.join(path, 'x.npy'), mmap_mode='r')
+        y = np.load(os.path.join(path, 'y.npy'), mmap_mode='r')
+        if indices is not None:
+            # a client's part is its own (small) copy
+            x, y = torch.from_numpy(x[indices]), torch.from_numpy(y[indices])
+        else:
+            x, y = as_tensor(x), as_tensor(y)
+        return x, y, rest
+    return None
+
+
+def publish(name, split, tf, x, y, keep=False):
+    '''
+        write an entry in place of the previous one, readers see it whole or not at all
+    '''
+    key = transform_key(tf)
+    path = entry_path(name, split, key)
+    tmp = path + '.tmp{}'.format(os.getpid())
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, 'x.npy'), np.ascontiguousarray(x, dtype=np.float32))
+    np.save(os.path.join(tmp, 'y.npy'), np.ascontiguousarray(y, dtype=np.float32))
+    meta = {'name': name, 'split': split, 'transform': repr(tf) if tf is not None else None,
+            'shape': list(x.shape), 'pid': 0 if keep else os.getpid()}
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+    return path
+
+
+def entries():
+    if not os.path.exists(SHM_ROOT):
+        return []
+    return sorted(os.path.join(SHM_ROOT, d) for d in os.listdir(SHM_ROOT))
+
+
+def remove_stale():
+    for path in entries():
+        if read_meta(path) is None:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def decode(name, split, transformed):
+    '''
+        the whole split as float arrays, through the preprocess() chain if transformed
+    '''
+    import torchvision.transforms as transforms
+    from .preprocess import name2func, transform_steps
+
+    tf = transforms.Compose(transform_steps()) if transformed else None
+    dataset = name2func[name](rootp='./datafiles/datasets/' + name,
+                              train=split == 'train', # SVHN_Dataset maps it to the split name
+                              download=True)
+    x, y = dataset.x, dataset.y
+    if tf is not None:
+        x = torch.stack([tf(x[i]) for i in range(len(x))])
+    return tf, x.numpy(), y.numpy()
+
+
+def serve(names, transformed, keep):
+    settings['attach'] = False # decode from the files, not from a previous server
+    if not os.path.exists(SHM_ROOT):
+        os.makedirs(SHM_ROOT)
+    remove_stale()
+    published = []
+    for name in names:
+        for split in ['train', 'test']:
+            start = time.time()
+            tf, x, y = decode(name, split, transformed)
+            published.append(publish(name, split, tf, x, y, keep))
+            print('{}.{} | {} | {:.0f} MB | {:.1f} s'.format(name, split, transform_key(tf), x.nbytes / 2**20, time.time() - start))
+    if keep:
+        return
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    print('serving {} entries from {}, Ctrl-C to stop'.format(len(published), SHM_ROOT))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    for path in published:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets', type=str, default='cifar10,svhn', help='comma separated datasets to serve')
+    parser.add_argument('--transform', type=str, default='raw', help='what the entries hold: | raw | preprocess |')
+    parser.add_argument('--keep', action='store_true', help='publish and exit, the entries stay until removed')
+    parser.add_argument('--list', action='store_true', help='print the live entries and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for path in entries():
+            meta = read_meta(path)
+            print('{} | {}'.format(os.path.basename(path), 'stale' if meta is None else 'pid {} | shape {}'.format(meta['pid'], meta['shape'])))
+    else:
+        serve(args.datasets.split(','), args.transform == 'preprocess', args.keep)
@@ -0,0 +1,130 @@
+'''
+    Hierarchical (edge-tier) aggregation
+
+        A flat server adds up every client update itself, its time and
+        memory grow with the number of clients. Here the clients report to
+        edge aggregators instead: every edge sums the weighted updates of
+        its clients, optionally regional aggregators sum the edges, and the
+        root only combines the partial sums of the top tier.
+
+            2 tiers:  clients -> edges -> root
+            3 tiers:  clients -> edges -> regions -> root
+
+        Client c reports to edge c % edges, edge e to region e % regions.
+        Edges run in a thread pool (torch ops release the GIL) when
+        workers > 0. Since the update of a client is added with its
+        weight, the root sum is the same weighted sum a flat server computes.
+
+    How to use:
+        aggregator = HierarchicalAggregator(edges=32, regions=4, workers=8)
+
+        def zeros():
+            return {name: torch.zeros_like(t) for name, t in template.items()}
+        def contribute(acc, client):            # acc[name] += weight * update[name]
+            ...
+        total = aggregator.reduce(clients, contribute, zeros)
+        aggregator.log_line()                   # root / edge time of the last reduce
+
+        total = aggregator.combine(partials, zeros, edge_time)   # edge sums built elsewhere
+'''
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def add_into(acc, partial):
+    for name, t in partial.items():
+        acc[name] += t
+    return acc
+
+
+class HierarchicalAggregator():
+    def __init__(self, edges, regions=0, workers=0):
+        assert(edges > 0)
+        self.edges = edges
+        self.regions = regions # 0: two tiers, the root combines the edges itself
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+
+        self.root_time = 0.
+        self.edge_time = 0.
+        self.region_time = 0.
+        self.history = [] # root time of every reduce
+
+    def groups(self, clients):
+        edges = {}
+        for client in clients:
+            edges.setdefault(client % self.edges, []).append(client)
+        return [edges[e] for e in sorted(edges)]
+
+    def _edge(self, clients, contribute, zeros):
+        start = time.perf_counter()
+        acc = zeros()
+        for client in clients:
+            contribute(acc, client)
+        return acc, time.perf_counter() - start
+
+    def _map(self, fn, items):
+        if self.executor is None:
+            return [fn(item) for item in items]
+        return list(self.executor.map(fn, items))
+
+    def reduce(self, clients, contribute, zeros):
+        '''
+            sum of contribute() over clients, gathered edge by edge
+        '''
+        groups = self.groups(clients)
+        results = self._map(lambda group: self._edge(group, contribute, zeros), groups)
+        # the slowest edge is the edge tier's share of the round
+        return self.combine([acc for acc, _ in results], zeros, max(t for _, t in results))
+
+    def combine(self, partials, zeros, edge_time=0.):
+        '''
+            the region and root tiers over the edges' partial sums, in edge
+            order, e.g. summed while the clients trained
+        '''
+        self.edge_time = edge_time
+        self.region_time = 0.
+        if self.regions > 0:
+            regions = {}
+            for e, acc in enumerate(partials):
+                regions.setdefault(e % self.regions, []).append(acc)
+
+            def region(accs):
+                start = time.perf_counter()
+                acc = zeros()
+                for partial in accs:
+                    add_into(acc, partial)
+                return acc, time.perf_counter() - start
+            results = self._map(region, [regions[r] for r in sorted(regions)])
+            partials = [acc for acc, _ in results]
+            self.region_time = max(t for _, t in results)
+
+        start = time.perf_counter()
+        total = zeros()
+        for partial in partials:
+            add_into(total, partial)
+        self.root_time = time.perf_counter() - start
+        self.history.append(self.root_time)
+        return total
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def log_line(self):
+        return ' edge   | Root: {:.4f}s | Regions: {:.4f}s | Edges: {:.4f}s | Tiers: {}'.format(
+            self.root_time, self.region_time, self.edge_time, 3 if self.regions > 0 else 2)
+
+
+def reduce_clients(aggregator, clients, contribute, zeros):
+    '''
+        aggregator.reduce(), or the flat server summing every client itself
+        when aggregator is None
+    '''
+    if aggregator is not None:
+        return aggregator.reduce(clients, contribute, zeros)
+    acc = zeros()
+    for client in clients:
+        contribute(acc, client)
+    return acc
@@ -0,0 +1,163 @@
+'''
+    Incremental index of run logs
+
+        Parses the metrics of many logs (runlog.load_metrics) in parallel
+        worker processes and keeps them in one cache file, keyed by the log
+        path. An entry remembers the size and mtime of the log and of its
+        .jsonl / .parquet; only logs where one of them changed are parsed
+        again, the rest is served from the cache.
+
+        Every entry holds the metric columns and a short summary (rounds,
+        best server test accuracy), so record2bacc.py does not even need
+        the columns.
+
+    How to use:
+        index = LogIndex('.logindex.pkl', workers=8)
+        index.update(['logs/DigitModel', 'log_choke'])   # directories or log files
+        index.metrics('logs/DigitModel/fedavg_mnist_none_4_test.log').history('acc')
+        index.summary('logs/DigitModel/fedavg_mnist_none_4_test.log')['best_acc']
+        index.save()
+
+        python logindex.py logs/DigitModel log_choke --workers 8
+'''
+
+import argparse
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from runlog import MetricTable, load_metrics
+
+INDEX_VERSION = 1
+
+
+def source_stamp(logpath):
+    # (size, mtime) of the log and of the structured files next to it
+    base = os.path.splitext(logpath)[0]
+    stamp = []
+    for path in [logpath, base + '.jsonl', base + '.parquet']:
+        try:
+            st = os.stat(path)
+            stamp.append((st.st_size, st.st_mtime_ns))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def parse_entry(logpath):
+    '''
+        runs in a worker process
+    '''
+    stamp = source_stamp(logpath)
+    metrics = load_metrics(logpath)
+    best = metrics.best('acc')
+    summary = {
+        'rounds': len(metrics.history('acc')),
+        'best_acc': None if best is None else float(best),
+        'records': len(metrics),
+    }
+    return logpath, {'stamp': stamp, 'columns': metrics.columns, 'summary': summary}
+
+
+def find_logs(paths):
+    logs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                logs += [os.path.join(root, f) for f in sorted(files) if f.endswith('.log')]
+        else:
+            logs.append(path)
+    return logs
+
+
+class LogIndex():
+    def __init__(self, cache_path='.logindex.pkl', workers=0):
+        self.cache_path = cache_path
+        self.workers = workers or os.cpu_count() or 1
+        self.entries = {}
+        self.dirty = False
+        self.parsed = 0
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'rb') as f:
+                    cache = pickle.load(f)
+                if cache.get('version') == INDEX_VERSION:
+                    self.entries = cache['entries']
+            except (OSError, EOFError, pickle.UnpicklingError):
+                # a broken cache is rebuilt
+                self.entries = {}
+
+    @staticmethod
+    def key(logpath):
+        return os.path.normpath(os.path.abspath(logpath))
+
+    def stale(self, logpath):
+        entry = self.entries.get(self.key(logpath))
+        return entry is None or entry['stamp'] != source_stamp(logpath)
+
+    def update(self, paths):
+        '''
+            parse the logs under paths that are new or changed, returns how many
+        '''
+        todo = [self.key(p) for p in find_logs(paths) if self.stale(p)]
+        if not todo:
+            return 0
+        if len(todo) == 1 or self.workers == 1:
+            results = list(map(parse_entry, todo))
+        else:
+            workers = min(self.workers, len(todo))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(parse_entry, todo, chunksize=max(1, len(todo) // (4 * workers))))
+        for key, entry in results:
+            self.entries[key] = entry
+        self.parsed += len(todo)
+        self.dirty = True
+        return len(todo)
+
+    def _entry(self, logpath):
+        if self.stale(logpath):
+            key, entry = parse_entry(self.key(logpath))
+            self.entries[key] = entry
+            self.parsed += 1
+            self.dirty = True
+        return self.entries[self.key(logpath)]
+
+    def metrics(self, logpath):
+        return MetricTable(self._entry(logpath)['columns'])
+
+    def summary(self, logpath):
+        return self._entry(logpath)['summary']
+
+    def prune(self):
+        # entries of logs that are gone
+        for key in [k for k in self.entries if not os.path.exists(k)]:
+            del self.entries[key]
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': INDEX_VERSION, 'entries': self.entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.cache_path)
+        self.dirty = False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', type=str, nargs='+', help='log directories or files')
+    parser.add_argument('--cache', type=str, default='.logindex.pkl', help='index cache file')
+    parser.add_argument('--workers', type=int, default=0, help='parser processes, 0: one per core')
+    parser.add_argument('--rebuild', action='store_true', help='drop the cache and parse everything again')
+    args = parser.parse_args()
+
+    if args.rebuild and os.path.exists(args.cache):
+        os.remove(args.cache)
+    start = time.perf_counter()
+    index = LogIndex(args.cache, workers=args.workers)
+    index.prune()
+    parsed = index.update(args.paths)
+    index.save()
+    print(' index  | {} logs | {} parsed | {:.2f}s'.format(len(find_logs(args.paths)), parsed, time.perf_counter() - start))
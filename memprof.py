@@ -0,0 +1,386 @@
+'''
+    Memory profile of a run
+
+        Where the memory of a run goes: the resident set size (RSS) of the
+        process, the CUDA memory and the bytes of live tensors by category
+
+            datasets, client models, optimizer state, control variates,
+            error feedback, checkpoint, ...
+
+        A category is a name and a function returning the objects holding
+        it: tensors, numpy arrays, modules (parameters, buffers and their
+        gradients), optimizers (their state), ClientStateStores (what is in
+        memory), data loaders and datasets (their tensors), or lists and
+        dicts of them. A storage is counted once, for the first category
+        that reaches it, so views and test sets shared by the clients are
+        not counted twice. snapshot() measures the categories at a point of
+        the round, plus any that only exist there (the uploads waiting for
+        aggregation), end_round() once more at its end.
+
+        Every profiler phase (profiler.py) also records the peak RSS and
+        CUDA memory while it ran and how far they rose above where the phase
+        started: that rise is what the phase needed on top of what was
+        already there, e.g. the temporaries of 'aggregate'. The peak RSS is
+        reset at the start of a phase through /proc/self/clear_refs where
+        the kernel allows it, otherwise it is the peak of the process so far.
+
+        end_round() writes what the round saw as a 'memory' record of the
+        run log and flags its top allocators: the largest categories and
+        phase temporaries and, with lines > 0, the source lines that
+        allocated most Python side memory (numpy arrays included) since the
+        last round, through tracemalloc.
+
+    How to use:
+        memory = MemoryProfiler(runlog, top=3, lines=0)
+        memory.track('datasets', lambda: (train_loaders, test_loaders))
+        memory.track('client models', lambda: (server_model, store))
+        profiler = Profiler(..., memory=memory)    # phases and rounds
+        ...
+        memory.snapshot('train', {'uploads': local_models})  # after the local updates
+        profiler.end_round()
+        logfile.write(memory.table() + '\\n')
+        memory.save_summary(os.path.splitext(logfile.name)[0] + '.memory.json')
+'''
+
+import json
+import os
+import threading
+import tracemalloc
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from client_store import ClientStateStore
+
+MB = 2**20
+MAX_DEPTH = 4 # attribute levels followed into plain objects (loader -> dataset -> tensors)
+TRACE_FRAMES = 16
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_status():
+    '''
+        (rss, peak rss) of this process in bytes, None where unknown
+    '''
+    rss = peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        try:
+            import resource
+            # kilobytes on linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except ImportError:
+            pass
+    return rss, peak
+
+
+def reset_peak():
+    # linux >= 4.0: '5' resets VmHWM to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def cuda_allocated():
+    if not torch.cuda.is_available():
+        return 0, 0
+    return torch.cuda.memory_allocated(), torch.cuda.max_memory_allocated()
+
+
+class TensorCounter():
+    '''
+        bytes of the storages reachable from some objects, every storage once
+    '''
+    def __init__(self):
+        self.storages = set()
+        self.visited = set()
+
+    def count(self, obj):
+        sizes = {'cpu': 0, 'cuda': 0}
+        self._walk(obj, sizes, 0)
+        return sizes
+
+    def _tensor(self, t, sizes):
+        if t.layout != torch.strided:
+            return
+        try:
+            storage = t.untyped_storage()
+        except AttributeError:
+            storage = t.storage()
+        ptr = storage.data_ptr()
+        if ptr == 0 or (t.device.type, ptr) in self.storages:
+            return
+        self.storages.add((t.device.type, ptr))
+        nbytes = storage.nbytes() if hasattr(storage, 'nbytes') else storage.size() * t.element_size()
+        sizes['cuda' if t.is_cuda else 'cpu'] += nbytes
+
+    def _array(self, a, sizes):
+        while isinstance(a.base, np.ndarray):
+            a = a.base
+        ptr = a.__array_interface__['data'][0]
+        if ('cpu', ptr) in self.storages:
+            return
+        self.storages.add(('cpu', ptr))
+        sizes['cpu'] += a.nbytes
+
+    def _walk(self, obj, sizes, depth):
+        if obj is None or isinstance(obj, (str, bytes, int, float, bool)):
+            return
+        if torch.is_tensor(obj):
+            self._tensor(obj, sizes)
+            return
+        if isinstance(obj, np.ndarray):
+            self._array(obj, sizes)
+            return
+        if id(obj) in self.visited:
+            return
+        self.visited.add(id(obj))
+        if isinstance(obj, nn.Module):
+            for p in obj.parameters():
+                self._tensor(p, sizes)
+                if p.grad is not None:
+                    self._tensor(p.grad, sizes)
+            for b in obj.buffers():
+                self._tensor(b, sizes)
+        elif isinstance(obj, torch.optim.Optimizer):
+            # the parameters belong to the model, only the state is the optimizer's
+            for state in list(obj.state.values()):
+                self._walk(state, sizes, depth + 1)
+        elif isinstance(obj, ClientStateStore):
+            with obj.lock:
+                states = list(obj.cache.values())
+            for state in states:
+                self._walk(state, sizes, depth + 1)
+        elif isinstance(obj, dict):
+            for value in list(obj.values()):
+                self._walk(value, sizes, depth + 1)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            for value in list(obj):
+                self._walk(value, sizes, depth + 1)
+        elif hasattr(obj, '__dict__') and depth < MAX_DEPTH:
+            for value in list(vars(obj).values()):
+                self._walk(value, sizes, depth + 1)
+
+
+class Frame():
+    __slots__ = ('name', 'rss', 'cuda', 'peak_rss', 'peak_cuda')
+
+    def __init__(self, name, rss, cuda):
+        self.name = name
+        self.rss = rss
+        self.cuda = cuda
+        self.peak_rss = rss or 0
+        self.peak_cuda = cuda
+
+
+class MemoryProfiler():
+    def __init__(self, runlog=None, top=3, lines=0):
+        self.runlog = runlog
+        self.top = top
+        self.lines = lines
+        self.categories = [] # (name, fn), measured in this order
+        self.can_reset = reset_peak()
+        self.lock = threading.Lock()
+        self.stack = [] # open phases, the round at the bottom
+        self.owner = None # the thread of the round, the only one whose phases get frames
+
+        self.round = None
+        self.phases = {} # name -> {'calls', 'peak_rss', 'peak_cuda', 'rise_rss', 'rise_cuda'} of the current round
+        self.snapshots = {} # label -> {category: {'cpu', 'cuda'}}
+        self.trace_start = None
+        self.rows = []
+        if lines > 0:
+            tracemalloc.start(TRACE_FRAMES)
+
+    def track(self, name, fn):
+        self.categories.append((name, fn))
+
+    def measure(self, extra=None):
+        counter = TensorCounter()
+        sizes = {}
+        for name, fn in self.categories:
+            sizes[name] = counter.count(fn())
+        for name, obj in (extra or {}).items():
+            sizes[name] = counter.count(obj)
+        return sizes
+
+    def snapshot(self, label, extra=None):
+        '''
+            extra: {category: objects} measured at this point only
+        '''
+        self.snapshots[label] = self.measure(extra)
+
+    def _peaks(self):
+        # peak rss / cuda since the last reset, folded into every open frame
+        _, peak = read_status()
+        _, peak_cuda = cuda_allocated()
+        for frame in self.stack:
+            frame.peak_rss = max(frame.peak_rss, peak or 0)
+            frame.peak_cuda = max(frame.peak_cuda, peak_cuda)
+
+    def _push(self, name):
+        with self.lock:
+            self._peaks()
+            if self.can_reset:
+                reset_peak()
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            rss, _ = read_status()
+            cuda, _ = cuda_allocated()
+            self.stack.append(Frame(name, rss, cuda))
+
+    def _pop(self):
+        with self.lock:
+            self._peaks()
+            return self.stack.pop()
+
+    def phase_start(self, name):
+        # the peaks are process-wide: phases of worker threads (edge aggregators,
+        # prefetching) would nest out of order, they count in the enclosing frames
+        if threading.get_ident() != self.owner:
+            return
+        self._push(name)
+
+    def phase_end(self, name):
+        if threading.get_ident() != self.owner:
+            return
+        frame = self._pop()
+        entry = self.phases.setdefault(name, {'calls': 0, 'peak_rss': 0, 'peak_cuda': 0, 'rise_rss': 0, 'rise_cuda': 0})
+        entry['calls'] += 1
+        entry['peak_rss'] = max(entry['peak_rss'], frame.peak_rss)
+        entry['peak_cuda'] = max(entry['peak_cuda'], frame.peak_cuda)
+        entry['rise_rss'] = max(entry['rise_rss'], frame.peak_rss - (frame.rss or frame.peak_rss))
+        entry['rise_cuda'] = max(entry['rise_cuda'], frame.peak_cuda - frame.cuda)
+
+    def start_round(self, r):
+        self.round = r
+        self.phases = {}
+        self.snapshots = {}
+        self.stack = []
+        self.owner = threading.get_ident()
+        self._push('round')
+        if self.lines > 0:
+            self.trace_start = tracemalloc.take_snapshot()
+
+    def end_round(self):
+        self.snapshot('end')
+        frame = self._pop()
+        rss, _ = read_status()
+        cuda, _ = cuda_allocated()
+
+        categories = {}
+        for sizes in self.snapshots.values():
+            for name, size in sizes.items():
+                entry = categories.setdefault(name, {'cpu': 0, 'cuda': 0})
+                entry['cpu'] = max(entry['cpu'], size['cpu'])
+                entry['cuda'] = max(entry['cuda'], size['cuda'])
+        tracked = sum(size['cpu'] for size in self.snapshots['end'].values())
+
+        # the largest holders of memory this round: categories and what phases needed on top
+        allocators = [(name, size['cpu'] + size['cuda']) for name, size in categories.items()]
+        allocators += [('{} temporaries'.format(name), p['rise_rss'] + p['rise_cuda']) for name, p in self.phases.items()]
+        allocators = sorted([a for a in allocators if a[1] > 0], key=lambda a: -a[1])[:self.top]
+
+        lines = []
+        if self.lines > 0 and self.trace_start is not None:
+            # not what the profiling itself allocates
+            ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+            stats = tracemalloc.take_snapshot().filter_traces(ignore).compare_to(self.trace_start.filter_traces(ignore), 'traceback')
+            by_line = {}
+            for stat in stats:
+                where = allocator(stat.traceback)
+                by_line[where] = by_line.get(where, 0) + stat.size_diff
+            lines = [[where, size] for where, size in sorted(by_line.items(), key=lambda l: -l[1]) if size > 0][:self.lines]
+
+        row = {
+            'round': self.round,
+            'rss': rss,
+            'peak_rss': frame.peak_rss,
+            'cuda': cuda,
+            'peak_cuda': frame.peak_cuda,
+            'untracked': None if rss is None else max(rss - tracked, 0),
+            'categories': categories,
+            'snapshots': self.snapshots,
+            'phases': self.phases,
+            'top': [list(a) for a in allocators],
+            'lines': lines,
+        }
+        self.rows.append(row)
+        if self.runlog:
+            self.runlog.write('memory', **row)
+        return row
+
+    def table(self, row=None):
+        '''
+            the memory of a round (default: the last one) as log lines
+        '''
+        if not self.rows:
+            return ''
+        row = row or self.rows[-1]
+        lines = [' mem    | Round: {} | RSS: {} | Peak RSS: {} | CUDA: {:.1f} MB | Peak CUDA: {:.1f} MB'.format(
+            row['round'], mb(row['rss']), mb(row['peak_rss']), row['cuda'] / MB, row['peak_cuda'] / MB)]
+        for name, size in row['categories'].items():
+            lines.append(' mem    |   {:<20} {:>10.1f} MB cpu {:>10.1f} MB cuda'.format(name, size['cpu'] / MB, size['cuda'] / MB))
+        if row['untracked'] is not None:
+            lines.append(' mem    |   {:<20} {:>10.1f} MB cpu'.format('untracked', row['untracked'] / MB))
+        for name, p in row['phases'].items():
+            lines.append(' mem    |   {:<20} peak {:>10.1f} MB rss {:>10.1f} MB cuda | rise {:>8.1f} MB rss {:>8.1f} MB cuda'.format(
+                name, p['peak_rss'] / MB, p['peak_cuda'] / MB, p['rise_rss'] / MB, p['rise_cuda'] / MB))
+        lines.append(' mem    | Top: ' + ', '.join('{} {:.1f} MB'.format(name, size / MB) for name, size in row['top']))
+        for where, size in row['lines']:
+            lines.append(' mem    |   {:+.1f} MB {}'.format(size / MB, where))
+        return '\n'.join(lines)
+
+    def summary(self):
+        peaks = {}
+        for row in self.rows:
+            for name, size in row['categories'].items():
+                peaks[name] = max(peaks.get(name, 0), size['cpu'] + size['cuda'])
+        return {
+            'rounds': len(self.rows),
+            'peak_rss': max([row['peak_rss'] for row in self.rows] or [0]),
+            'peak_cuda': max([row['peak_cuda'] for row in self.rows] or [0]),
+            'categories': peaks,
+            'breakdown': self.rows,
+        }
+
+    def summary_lines(self):
+        summary = self.summary()
+        lines = [' mem    | Rounds: {} | Peak RSS: {} | Peak CUDA: {:.1f} MB'.format(
+            summary['rounds'], mb(summary['peak_rss']), summary['peak_cuda'] / MB)]
+        for name, size in sorted(summary['categories'].items(), key=lambda c: -c[1]):
+            lines.append(' mem    |   {:<20} {:>10.1f} MB'.format(name, size / MB))
+        return '\n'.join(lines)
+
+    def save_summary(self, path):
+        if not self.rows:
+            return
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def close(self):
+        if self.lines > 0:
+            tracemalloc.stop()
+
+
+def allocator(traceback):
+    # the innermost line of this repo, not the numpy / torch internals it called
+    for frame in reversed(traceback):
+        if frame.filename.startswith(ROOT):
+            return '{}:{}'.format(os.path.relpath(frame.filename, ROOT), frame.lineno)
+    frame = traceback[-1]
+    return '{}:{}'.format(frame.filename, frame.lineno)
+
+
+def mb(nbytes):
+    return 'n/a' if nbytes is None else '{:.1f} MB'.format(nbytes / MB)
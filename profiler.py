@@ -0,0 +1,269 @@
+'''
+    Per-phase timers and counters
+
+        The hot paths (tr_utils.train*, communication(), the local updates
+        of SCAFFOLD, MOON, PerFedAvg and pFedMe, evaluation) time what they
+        do in named phases:
+
+            data (augment inside it), forward, backward, step, prox,
+            contrastive, meta, control, aggregate, broadcast, eval
+
+        and count samples and batches. A Profiler collects these per round;
+        end_round() gives the breakdown of the round (seconds, share of the
+        round's wall time and calls per phase, 'other' is what no phase
+        covered) and writes it to the run log as a 'profile' record.
+        summary() / save_summary() give the totals over the run.
+
+        Phases are timed on the host. With sync=True every phase waits for
+        the GPU before it is closed, which is slower but attributes GPU time
+        to the phase that queued the work.
+
+        Only one profiler is active; the instrumented code calls phase() and
+        count() of this module, which cost next to nothing while profiling
+        is off (the default).
+
+        capture_round=r runs torch.profiler over round r as well, the phases
+        show up in it as record_function ranges. Its Chrome trace goes to
+        <trace_path> and its top operators into the round's table.
+
+        Given a timeline (timeline.py) every phase and round is also a span
+        of it, on the track of the client whose work it is: on_client() of
+        this module marks that work. This works with or without the timers.
+        Given a MemoryProfiler (memprof.py) every phase and round records
+        its peak memory too.
+
+    How to use:
+        profiler = Profiler(args.profile, args.profile_sync, args.profile_round, trace_path, runlog, timeline)
+        set_profiler(profiler)
+        for a_iter in range(args.iters):
+            profiler.start_round(a_iter)
+            with on_client(client_idx), phase('forward'):
+                output = model(x)
+            count('samples', y.size(0))
+            ...
+            profiler.end_round()
+            logfile.write(profiler.table() + '\\n')
+        profiler.save_summary(os.path.splitext(logfile.name)[0] + '.profile.json')
+'''
+
+import json
+import threading
+import time
+
+import torch
+from timeline import SERVER
+
+PHASES = ['data', 'augment', 'forward', 'backward', 'step', 'prox', 'contrastive', 'meta',
+          'control', 'aggregate', 'broadcast', 'eval']
+# timed inside another phase ('augment' runs in 'data'), not counted twice
+NESTED = ['augment']
+
+
+class NullPhase():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_PHASE = NullPhase()
+
+
+class Phase():
+    __slots__ = ('profiler', 'name', 'start', 'record')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        if self.profiler.memory is not None:
+            self.profiler.memory.phase_start(self.name)
+        if self.profiler.capture is not None:
+            self.record = torch.autograd.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        profiler = self.profiler
+        if profiler.sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        end = time.perf_counter()
+        if profiler.enabled:
+            profiler.add(self.name, end - self.start)
+        if profiler.timeline is not None:
+            profiler.timeline.complete(self.name, self.start, end)
+        if self.record is not None:
+            self.record.__exit__(*exc)
+        if profiler.memory is not None:
+            profiler.memory.phase_end(self.name)
+        return False
+
+
+class Profiler():
+    def __init__(self, enabled=False, sync=False, capture_round=-1, trace_path=None, runlog=None, timeline=None, memory=None):
+        self.enabled = enabled
+        self.timeline = timeline
+        self.memory = memory
+        self.sync = sync
+        self.capture_round = capture_round
+        self.trace_path = trace_path
+        self.runlog = runlog
+        self.capture = None
+        self.capture_table = ''
+        # aggregation may run on edge worker threads
+        self.lock = threading.Lock()
+
+        self.round = None
+        self.round_start = 0.
+        self.times = {} # phase -> [seconds, calls] of the current round
+        self.counters = {}
+        self.rows = [] # one breakdown per finished round
+
+    def phase(self, name):
+        if not self.enabled and self.timeline is None and self.memory is None:
+            return NULL_PHASE
+        return Phase(self, name)
+
+    def add(self, name, seconds):
+        with self.lock:
+            entry = self.times.setdefault(name, [0., 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def start_round(self, r):
+        if self.timeline is not None:
+            self.timeline.round = r
+        if self.memory is not None:
+            self.memory.start_round(r)
+        if self.enabled:
+            self.round = r
+            self.times = {}
+            self.counters = {}
+            self.capture_table = ''
+            if r == self.capture_round:
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                self.capture = torch.profiler.profile(activities=activities, profile_memory=True)
+                self.capture.__enter__()
+        self.round_start = time.perf_counter()
+
+    def end_round(self):
+        if self.timeline is not None:
+            # on the server track, even when a client scope is open on this thread
+            self.timeline.complete('round {}'.format(self.timeline.round), self.round_start, time.perf_counter(),
+                                   SERVER, cat='round')
+        if self.memory is not None:
+            self.memory.end_round()
+        if not self.enabled:
+            return None
+        if self.sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        wall = time.perf_counter() - self.round_start
+        if self.capture is not None:
+            self.capture.__exit__(None, None, None)
+            if self.trace_path:
+                self.capture.export_chrome_trace(self.trace_path)
+            sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+            self.capture_table = self.capture.key_averages().table(sort_by=sort_by, row_limit=15)
+            self.capture = None
+        with self.lock:
+            phases = {name: {'seconds': s, 'calls': c} for name, (s, c) in self.times.items()}
+            counters = dict(self.counters)
+        row = {'round': self.round, 'wall': wall, 'phases': phases, 'counters': counters}
+        self.rows.append(row)
+        if self.runlog:
+            self.runlog.write('profile', **row)
+        return row
+
+    def table(self, row=None):
+        '''
+            the breakdown of a round (default: the last one) as log lines
+        '''
+        if not self.rows:
+            return ''
+        row = row or self.rows[-1]
+        wall = row['wall']
+        covered = sum(p['seconds'] for name, p in row['phases'].items() if name not in NESTED)
+        lines = [' prof   | Round: {} | Wall: {:.3f}s | {}'.format(
+            row['round'], wall, ' | '.join('{}: {}'.format(k, v) for k, v in sorted(row['counters'].items())))]
+        for name in order(row['phases']):
+            p = row['phases'][name]
+            lines.append(' prof   |   {:<12} {:>9.3f}s {:>6.1f}% {:>8} calls'.format(
+                name, p['seconds'], 100 * p['seconds'] / max(wall, 1e-12), p['calls']))
+        lines.append(' prof   |   {:<12} {:>9.3f}s {:>6.1f}%'.format('other', max(wall - covered, 0.), 100 * max(wall - covered, 0.) / max(wall, 1e-12)))
+        if self.capture_table and row is self.rows[-1]:
+            lines.append(self.capture_table)
+        return '\n'.join(lines)
+
+    def summary(self):
+        wall = sum(row['wall'] for row in self.rows)
+        phases = {}
+        counters = {}
+        for row in self.rows:
+            for name, p in row['phases'].items():
+                entry = phases.setdefault(name, {'seconds': 0., 'calls': 0})
+                entry['seconds'] += p['seconds']
+                entry['calls'] += p['calls']
+            for name, n in row['counters'].items():
+                counters[name] = counters.get(name, 0) + n
+        for entry in phases.values():
+            entry['share'] = entry['seconds'] / wall if wall > 0 else 0.
+            entry['per_round'] = entry['seconds'] / len(self.rows)
+        return {'rounds': len(self.rows), 'wall': wall, 'phases': phases, 'counters': counters, 'breakdown': self.rows}
+
+    def summary_lines(self):
+        summary = self.summary()
+        lines = [' prof   | Rounds: {} | Wall: {:.2f}s'.format(summary['rounds'], summary['wall'])]
+        for name in order(summary['phases']):
+            p = summary['phases'][name]
+            lines.append(' prof   |   {:<12} {:>9.2f}s {:>6.1f}% {:>8.3f}s/round'.format(name, p['seconds'], 100 * p['share'], p['per_round']))
+        return '\n'.join(lines)
+
+    def save_summary(self, path):
+        if not self.enabled or not self.rows:
+            return
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def order(phases):
+    # the known phases in pipeline order, anything else after them
+    return [name for name in PHASES if name in phases] + sorted(name for name in phases if name not in PHASES)
+
+
+_active = Profiler()
+
+
+def set_profiler(profiler):
+    global _active
+    _active = profiler
+
+
+def get_profiler():
+    return _active
+
+
+def phase(name):
+    return _active.phase(name)
+
+
+def count(name, n=1):
+    _active.count(name, n)
+
+
+def on_client(client_idx):
+    # what runs inside is client_idx's work, for the timeline
+    if _active.timeline is None:
+        return NULL_PHASE
+    return _active.timeline.client(client_idx)
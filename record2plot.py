@@ -1,50 +1,15 @@
 import argparse
 import os
 import matplotlib.pyplot as plt
+from logindex import LogIndex
 
-# use this to parse train_loss, other loss is meaning less to be analyzed
-def parse_dict(logpath, keyword):
-    '''
-        Args:
-            - logpath: the path of logfile
-            - keyword: the keyword to find in the file
-
-        Returns the parsed dictionary
-    '''
-    d = {}
-    with open(logpath, mode='r') as f:
-        rows = f.readlines()
-        target_word = keyword
-        for row in rows:
-            pos = row.find(target_word)  # row must have word "Train Loss: "
-            if pos != -1:
-                # find dataset name, as key
-                dataset_name = row[:row.find("|")].strip()
-                if dataset_name not in d:
-                    d[dataset_name] = []
-
-                pos += len(target_word)
-                row = row[pos:]  # strip all the things before the loss
-
-                spacepos = row.find(' ')  # find the space after the number
-                if spacepos != -1:
-                    row = row[:spacepos]  # strip all things after the loss
-
-                loss = float(row)
-                d[dataset_name].append(loss)
-    return d
-
-def average_loss_history(loss_history_dict):
-    keys = list(loss_history_dict.keys())
-    nhist = len(loss_history_dict[keys[0]])
-    hist = []
-    for i in range(nhist):
-        val = 0
-        for key in keys:
-            val += loss_history_dict[key][i]
-        val /= len(keys)
-        hist.append(val)
-    return hist
+def loss_history(logpath):
+    # train loss of every round averaged over the clients
+    return index.metrics(logpath).mean_history('loss', split='train')
+
+def acc_history(logpath):
+    # server test accuracy of every round
+    return index.metrics(logpath).history('acc')
 
 def draw_plot(x_hist,
               y_hists,
@@ -87,25 +52,21 @@ def draw_per_dataset_per_skew():
 
             # loss_history_{algorithm}: has key(client 0, client1, client2 and client 3)
             # we average the loss history of nclient to be our final loss history
-            loss_history_fedbn = parse_dict(logfile_fedbn, "Train Loss: ")
-            loss_history_fedbn = average_loss_history(loss_history_fedbn)
-            acc_history_fedbn = parse_dict(logfile_fedbn, "Test  Acc: ")['server']
+            loss_history_fedbn = loss_history(logfile_fedbn)
+            acc_history_fedbn = acc_history(logfile_fedbn)
 
-            loss_history_fedprox = parse_dict(logfile_fedprox, "Train Loss: ")
-            loss_history_fedprox = average_loss_history(loss_history_fedprox)
-            acc_history_fedprox = parse_dict(logfile_fedprox, "Test  Acc: ")['server']
+            loss_history_fedprox = loss_history(logfile_fedprox)
+            acc_history_fedprox = acc_history(logfile_fedprox)
 
-            loss_history_fedavg = parse_dict(logfile_fedavg, "Train Loss: ")
-            loss_history_fedavg = average_loss_history(loss_history_fedavg)
-            acc_history_fedavg = parse_dict(logfile_fedavg, "Test  Acc: ")['server']
+            loss_history_fedavg = loss_history(logfile_fedavg)
+            acc_history_fedavg = acc_history(logfile_fedavg)
 
-            # loss_history_moon = parse_dict(logfile_moon, "Train Loss: ")
-            # loss_history_moon = average_loss_history(loss_history_moon)
-            acc_history_moon = parse_dict(logfile_moon, "Test  Acc: ")['server']
+            # loss_history_moon = loss_history(logfile_moon)
+            acc_history_moon = acc_history(logfile_moon)
 
-            acc_history_pfedme = parse_dict(logfile_pfedme, "Test  Acc: ")['server']
+            acc_history_pfedme = acc_history(logfile_pfedme)
 
-            acc_history_perfedavg = parse_dict(logfile_perfedavg, "Test  Acc: ")['server']
+            acc_history_perfedavg = acc_history(logfile_perfedavg)
 
             print(dataset, skew)
             print(len(acc_history_fedavg), len(acc_history_fedprox), len(acc_history_fedbn), len(acc_history_moon), len(acc_history_perfedavg), len(acc_history_pfedme))
@@ -162,12 +123,12 @@ def draw_per_dataset_per_algo():
             logfile_la = os.path.join(folder, logname_label_across)
             logfile_lw = os.path.join(folder, logname_label_within)
 
-            acc_history_n = parse_dict(logfile_n, "Test  Acc: ")['server']
-            acc_history_q = parse_dict(logfile_q, "Test  Acc: ")['server']
-            acc_history_ff = parse_dict(logfile_ff, "Test  Acc: ")['server']
-            acc_history_fn = parse_dict(logfile_fn, "Test  Acc: ")['server']
-            acc_history_la = parse_dict(logfile_la, "Test  Acc: ")['server']
-            acc_history_lw = parse_dict(logfile_lw, "Test  Acc: ")['server']
+            acc_history_n = acc_history(logfile_n)
+            acc_history_q = acc_history(logfile_q)
+            acc_history_ff = acc_history(logfile_ff)
+            acc_history_fn = acc_history(logfile_fn)
+            acc_history_la = acc_history(logfile_la)
+            acc_history_lw = acc_history(logfile_lw)
 
             nepochs = range(1, len(acc_history_ff) + 1)
 
@@ -200,21 +161,17 @@ def draw_lbfedbn():
 
             # loss_history_{algorithm}: has key(client 0, client1, client2 and client 3)
             # we average the loss history of nclient to be our final loss history
-            loss_history_fedbn = parse_dict(logfile_fedbn, "Train Loss: ")
-            loss_history_fedbn = average_loss_history(loss_history_fedbn)
-            acc_history_fedbn = parse_dict(logfile_fedbn, "Test  Acc: ")['server']
+            loss_history_fedbn = loss_history(logfile_fedbn)
+            acc_history_fedbn = acc_history(logfile_fedbn)
 
-            loss_history_fedprox = parse_dict(logfile_fedprox, "Train Loss: ")
-            loss_history_fedprox = average_loss_history(loss_history_fedprox)
-            acc_history_fedprox = parse_dict(logfile_fedprox, "Test  Acc: ")['server']
+            loss_history_fedprox = loss_history(logfile_fedprox)
+            acc_history_fedprox = acc_history(logfile_fedprox)
 
-            loss_history_fedavg = parse_dict(logfile_fedavg, "Train Loss: ")
-            loss_history_fedavg = average_loss_history(loss_history_fedavg)
-            acc_history_fedavg = parse_dict(logfile_fedavg, "Test  Acc: ")['server']
+            loss_history_fedavg = loss_history(logfile_fedavg)
+            acc_history_fedavg = acc_history(logfile_fedavg)
 
-            loss_history_lbfedbn = parse_dict(logfile_lbfedbn, "Train Loss: ")
-            loss_history_lbfedbn = average_loss_history(loss_history_lbfedbn)
-            acc_history_lbfedbn = parse_dict(logfile_lbfedbn, "Test  Acc: ")['server']
+            loss_history_lbfedbn = loss_history(logfile_lbfedbn)
+            acc_history_lbfedbn = acc_history(logfile_lbfedbn)
 
             nepochs = range(1, len(loss_history_fedavg) + 1)
 
@@ -259,25 +216,20 @@ def draw_choke():
 
             # loss_history_{algorithm}: has key(client 0, client1, client2 and client 3)
             # we average the loss history of nclient to be our final loss history
-            loss_history_fedbn = parse_dict(logfile_fedbn, "Train Loss: ")
-            loss_history_fedbn = average_loss_history(loss_history_fedbn)
-            acc_history_fedbn = parse_dict(logfile_fedbn, "Test  Acc: ")['server']
+            loss_history_fedbn = loss_history(logfile_fedbn)
+            acc_history_fedbn = acc_history(logfile_fedbn)
 
-            loss_history_fedprox = parse_dict(logfile_fedprox, "Train Loss: ")
-            loss_history_fedprox = average_loss_history(loss_history_fedprox)
-            acc_history_fedprox = parse_dict(logfile_fedprox, "Test  Acc: ")['server']
+            loss_history_fedprox = loss_history(logfile_fedprox)
+            acc_history_fedprox = acc_history(logfile_fedprox)
 
-            loss_history_fedavg = parse_dict(logfile_fedavg, "Train Loss: ")
-            loss_history_fedavg = average_loss_history(loss_history_fedavg)
-            acc_history_fedavg = parse_dict(logfile_fedavg, "Test  Acc: ")['server']
+            loss_history_fedavg = loss_history(logfile_fedavg)
+            acc_history_fedavg = acc_history(logfile_fedavg)
 
-            loss_history_cavg = parse_dict(logfile_cavg, "Train Loss: ")
-            loss_history_cavg = average_loss_history(loss_history_cavg)
-            acc_history_cavg = parse_dict(logfile_cavg, "Test  Acc: ")['server']
+            loss_history_cavg = loss_history(logfile_cavg)
+            acc_history_cavg = acc_history(logfile_cavg)
 
-            loss_history_cprox = parse_dict(logfile_cprox, "Train Loss: ")
-            loss_history_cprox = average_loss_history(loss_history_cprox)
-            acc_history_cprox = parse_dict(logfile_cprox, "Test  Acc: ")['server']
+            loss_history_cprox = loss_history(logfile_cprox)
+            acc_history_cprox = acc_history(logfile_cprox)
 
             nepochs = range(1, len(loss_history_fedavg) + 1)
 
@@ -304,7 +256,13 @@ def draw_choke():
                     y_label="Accuracy (%)",
                     name=os.path.join('choke', f'Tacc_{dataset}_{skew}.png'))
 
-draw_per_dataset_per_skew()
-# draw_per_dataset_per_algo()
-# draw_lbfedbn()
-# draw_choke()
\ No newline at end of file
+if __name__ == '__main__':
+    # parsed logs are cached, only new or changed ones are parsed (in parallel) again
+    index = LogIndex()
+    index.update([folder, './log_choke'])
+
+    draw_per_dataset_per_skew()
+    # draw_per_dataset_per_algo()
+    # draw_lbfedbn()
+    # draw_choke()
+    index.save()
@@ -0,0 +1,203 @@
+'''
+    Structured run log
+
+        An append-only JSONL file written next to the text log of a run,
+        one record per line. Every record has a 'kind' and whatever fields
+        belong to it, e.g.
+
+            {"kind": "comm", "round": 3, "client": 0, "down_params": 1024, ...}
+            {"kind": "metric", "round": 3, "client": -1, "split": "test", "loss": 0.41, "acc": 0.87}
+
+        Metric records are what the text log shows on its ' client i|' and
+        ' server |' lines: client -1 is the server, split is 'train' or
+        'test', loss and acc are there when the line has them.
+
+        load_metrics() gives the metric records of a run as a MetricTable,
+        one numpy column per field, from (in this order) the compacted
+        .parquet, the .jsonl, or for runs that predate this file the text
+        log itself. compact() turns a .jsonl into a .parquet (needs pyarrow).
+
+    How to use:
+        runlog = RunLog(logfile_path)   # writes logfile_path with .jsonl
+        runlog.write('comm', round=3, client=0, up_params=1024)
+        runlog.metric(3, SERVER, 'test', loss=0.41, acc=0.87)
+        runlog.close()
+
+        metrics = load_metrics(logfile_path)
+        metrics.history('acc')                     # server test accuracy per round
+        metrics.mean_history('loss', split='train') # train loss averaged over the clients
+
+        python runlog.py --compact logs/DigitModel/*.jsonl
+'''
+
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+
+SERVER = -1 # client id of the server in metric records
+METRIC_FIELDS = ['loss', 'acc']
+
+
+class RunLog():
+    def __init__(self, logpath):
+        self.path = os.path.splitext(logpath)[0] + '.jsonl'
+        self.f = open(self.path, 'w')
+
+    def write(self, kind, **fields):
+        record = {'kind': kind}
+        record.update(fields)
+        self.f.write(json.dumps(record) + '\n')
+
+    def metric(self, round, client, split, **values):
+        self.write('metric', round=round, client=client, split=split, **values)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def read_records(logpath, kind=None):
+    records = []
+    with open(os.path.splitext(logpath)[0] + '.jsonl') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if kind is None or record['kind'] == kind:
+                records.append(record)
+    return records
+
+
+# ' client 0| Train Loss: 1.1397 | Train Acc: 0.7754', ' server  | Loss: 0.52 | Test  Acc: 0.81'
+LINE = re.compile(r'^ (?:client (\d+)|server)\s*\|(.*)$', re.M)
+FIELD = re.compile(r'(Train |Test  )?(Loss|Acc): ([0-9.]+)')
+
+
+def parse_text_log(logpath):
+    '''
+        metric records of a text log, the round counts the server lines
+    '''
+    with open(logpath) as f:
+        text = f.read()
+    records = []
+    rnd = 0
+    for client, rest in LINE.findall(text):
+        by_split = {}
+        for prefix, name, value in FIELD.findall(rest):
+            # a bare 'Loss:' (MOON, Scaffold) is the local training loss
+            split = 'test' if prefix == 'Test  ' or (not prefix and name == 'Acc') else 'train'
+            by_split.setdefault(split, {})[name.lower()] = float(value)
+        for split, values in by_split.items():
+            record = {'kind': 'metric', 'round': rnd, 'client': int(client) if client else SERVER, 'split': split}
+            record.update(values)
+            records.append(record)
+        if not client:
+            rnd += 1
+    return records
+
+
+class MetricTable():
+    '''
+        metric records as columns: round, client, split, loss, acc (nan where missing)
+    '''
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def from_records(cls, records):
+        records = [r for r in records if r.get('kind', 'metric') == 'metric']
+        columns = {
+            'round': np.array([r['round'] for r in records], dtype=np.int64),
+            'client': np.array([r['client'] for r in records], dtype=np.int64),
+            'split': np.array([r['split'] for r in records], dtype=object),
+        }
+        for name in METRIC_FIELDS:
+            columns[name] = np.array([r.get(name, np.nan) for r in records], dtype=np.float64)
+        return cls(columns)
+
+    def __len__(self):
+        return len(self.columns['round'])
+
+    def select(self, client=None, split=None):
+        mask = np.ones(len(self), dtype=bool)
+        if client is not None:
+            mask &= self.columns['client'] == client
+        if split is not None:
+            mask &= self.columns['split'] == split
+        return mask
+
+    def history(self, field, client=SERVER, split='test'):
+        '''
+            values of field per round for one client
+        '''
+        mask = self.select(client, split) & ~np.isnan(self.columns[field])
+        rounds = self.columns['round'][mask]
+        return self.columns[field][mask][np.argsort(rounds, kind='stable')]
+
+    def mean_history(self, field, split='train'):
+        '''
+            values of field per round averaged over the clients (not the server)
+        '''
+        mask = self.select(split=split) & (self.columns['client'] != SERVER) & ~np.isnan(self.columns[field])
+        rounds = self.columns['round'][mask]
+        if len(rounds) == 0:
+            return np.zeros(0)
+        sums = np.bincount(rounds, weights=self.columns[field][mask])
+        counts = np.bincount(rounds)
+        seen = counts > 0
+        return sums[seen] / counts[seen]
+
+    def best(self, field='acc', client=SERVER, split='test'):
+        values = self.history(field, client, split)
+        return values.max() if len(values) else None
+
+
+def load_metrics(logpath):
+    base = os.path.splitext(logpath)[0]
+    if os.path.exists(base + '.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(base + '.parquet')
+        columns = {name: table.column(name).to_numpy(zero_copy_only=False) for name in table.column_names}
+        mask = columns['kind'] == 'metric'
+        metric_columns = {
+            'round': columns['round'][mask].astype(np.int64),
+            'client': columns['client'][mask].astype(np.int64),
+            'split': columns['split'][mask].astype(object),
+        }
+        for name in METRIC_FIELDS:
+            # null in parquet comes back as nan for float columns
+            metric_columns[name] = columns[name][mask].astype(np.float64) if name in columns else np.full(mask.sum(), np.nan)
+        return MetricTable(metric_columns)
+    if os.path.exists(base + '.jsonl'):
+        records = read_records(logpath, kind='metric')
+        # runs from before the metric records only have the comm ones
+        if records:
+            return MetricTable.from_records(records)
+    return MetricTable.from_records(parse_text_log(logpath))
+
+
+def compact(path):
+    '''
+        <run>.jsonl -> <run>.parquet, every kind of record, missing fields are null
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    records = read_records(path)
+    table = pa.Table.from_pylist(records)
+    out_path = os.path.splitext(path)[0] + '.parquet'
+    pq.write_table(table, out_path + '.tmp')
+    os.replace(out_path + '.tmp', out_path)
+    return out_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--compact', type=str, nargs='+', default=[], help='run logs (.jsonl) to compact into .parquet')
+    args = parser.parse_args()
+    for path in args.compact:
+        print('{} -> {}'.format(path, compact(path)))
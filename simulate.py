@@ -0,0 +1,152 @@
+'''
+    Straggler and heterogeneity simulation on a virtual clock
+
+        Every client gets a compute speed and a link bandwidth drawn once from
+        configurable distributions. The training scripts report, per round,
+        how many batches each client ran and how many bytes it moved; the
+        simulator turns that into a finish time per client and advances a
+        virtual clock, no real waiting is involved.
+
+        With a deadline, the round closes at the deadline. Late clients are
+        either dropped (credit 0) or credited with the fraction of their local
+        work done in time (--sim_late partial). If nobody makes the deadline,
+        the round waits for the first client instead.
+
+    Distributions are given as 'name:p1,p2', e.g.
+        const:1
+        uniform:0.5,2
+        lognormal:0,0.5     (mean and sigma of the underlying normal)
+        exponential:1       (scale)
+
+    How to use:
+        sim = HeteroSimulator(args.nclient, args.sim_speed, args.sim_bandwidth,
+                              args.sim_batch_time, args.sim_deadline, args.sim_late, args.seed)
+        sim.start_round()
+        sim.add_compute(client_idx, len(train_loader))
+        sim.add_transfer(client_idx, down_bytes, up_bytes)
+        credits = sim.end_round()       # one credit in [0, 1] per client
+        client_weights = apply_credits(client_weights, credits)
+        logfile.write(sim.log_line() + '\\n')
+'''
+
+import numpy as np
+import torch
+
+
+def sample(spec, n, rng):
+    name, _, params = spec.partition(':')
+    params = [float(p) for p in params.split(',') if p]
+    if name == 'const':
+        return np.full(n, params[0])
+    if name == 'uniform':
+        return rng.uniform(params[0], params[1], n)
+    if name == 'lognormal':
+        return rng.lognormal(params[0], params[1], n)
+    if name == 'exponential':
+        return rng.exponential(params[0], n)
+    raise ValueError("UNDEFINED DISTRIBUTION")
+
+
+def state_nbytes(state):
+    return sum(t.nelement() * t.element_size() for t in state.values())
+
+
+def apply_credits(client_weights, credits):
+    '''
+        Scale the aggregation weights by the clients' credits and renormalize
+    '''
+    weights = [w * c for w, c in zip(client_weights, credits)]
+    total = sum(weights)
+    return [w / total for w in weights]
+
+
+def weighted_mean(vs, weights):
+    '''
+        Mean over the clients in dim 0 of vs, weighted when the simulator credits them
+    '''
+    if weights is None or not vs.is_floating_point():
+        return vs.mean(dim=0)
+    w = torch.tensor(weights, dtype=vs.dtype, device=vs.device)
+    return (vs * w.view(-1, *([1] * (vs.dim() - 1)))).sum(dim=0)
+
+
+class HeteroSimulator():
+    def __init__(self, nclient, speed='lognormal:0,0.5', bandwidth='lognormal:2,0.5',
+                 batch_time=0.05, deadline=0., late='drop', seed=400):
+        assert(late in ['drop', 'partial'])
+        rng = np.random.RandomState(seed)
+        self.nclient = nclient
+        self.speeds = sample(speed, nclient, rng) # relative compute speed
+        self.bandwidths = sample(bandwidth, nclient, rng) # MB/s
+        self.batch_time = batch_time # virtual seconds per batch at speed 1
+        self.deadline = deadline # 0: wait for every client
+        self.late = late
+
+        self.wall_time = 0.
+        self.idle_time = 0.
+        self.rounds = []
+
+    def start_round(self):
+        self.nbatches = [0 for _ in range(self.nclient)]
+        self.down_bytes = [0 for _ in range(self.nclient)]
+        self.up_bytes = [0 for _ in range(self.nclient)]
+
+    def add_compute(self, client_idx, nbatches):
+        self.nbatches[client_idx] += nbatches
+
+    def add_transfer(self, client_idx, down_bytes, up_bytes):
+        self.down_bytes[client_idx] += down_bytes
+        self.up_bytes[client_idx] += up_bytes
+
+    def end_round(self):
+        down = [self.down_bytes[i] / 2**20 / self.bandwidths[i] for i in range(self.nclient)]
+        up = [self.up_bytes[i] / 2**20 / self.bandwidths[i] for i in range(self.nclient)]
+        compute = [self.nbatches[i] * self.batch_time / self.speeds[i] for i in range(self.nclient)]
+        finish = [down[i] + compute[i] + up[i] for i in range(self.nclient)]
+
+        credits = [1. for _ in range(self.nclient)]
+        round_time = max(finish)
+        if self.deadline > 0 and round_time > self.deadline:
+            round_time = self.deadline
+            for i in range(self.nclient):
+                if finish[i] <= self.deadline:
+                    continue
+                credits[i] = 0.
+                if self.late == 'partial' and compute[i] > 0:
+                    # the share of local work that still leaves time to upload
+                    credits[i] = min(max((self.deadline - down[i] - up[i]) / compute[i], 0.), 1.)
+                if credits[i] > 0:
+                    # it stops computing there, and uploads by the deadline
+                    compute[i] *= credits[i]
+                    finish[i] = down[i] + compute[i] + up[i]
+            if sum(credits) == 0:
+                first = int(np.argmin(finish))
+                credits[first] = 1.
+                round_time = finish[first]
+
+        # the last of the clients that count, a dropped one is not on the critical path
+        kept = [i for i in range(self.nclient) if credits[i] > 0]
+        critical = max(kept, key=lambda i: finish[i])
+        idle = sum(round_time - finish[i] for i in range(self.nclient) if finish[i] < round_time)
+        self.wall_time += round_time
+        self.idle_time += idle
+        self.rounds.append({
+            'round': len(self.rounds),
+            'round_time': round_time,
+            'wall_time': self.wall_time,
+            'critical_client': critical,
+            'critical_path': {'download': down[critical], 'compute': compute[critical], 'upload': up[critical]},
+            'idle_time': idle,
+            'late': [i for i in range(self.nclient) if credits[i] < 1.],
+            'credits': credits,
+        })
+        return credits
+
+    def log_line(self):
+        r = self.rounds[-1]
+        cp = r['critical_path']
+        return ' sim    | Round Time: {:.2f}s | Wall Time: {:.2f}s | Critical: client {} (down {:.2f}s, compute {:.2f}s, up {:.2f}s) | Idle: {:.2f}s | Late: {}'.format(
+            r['round_time'], r['wall_time'], r['critical_client'], cp['download'], cp['compute'], cp['upload'], r['idle_time'], r['late'])
+
+    def summary_line(self):
+        return ' sim    | Rounds: {} | Wall Time: {:.2f}s | Idle: {:.2f}s'.format(len(self.rounds), self.wall_time, self.idle_time)
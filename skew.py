@@ -23,7 +23,10 @@
         Using the dictionary to acquire the dataset is all
 '''
 
-from datafiles.preprocess import preprocess
+from datafiles.loaders import dset2loader
+from datafiles.preprocess import preprocess, synthetic_names, configure_synthetic
+from datafiles.augment import augment_ops, AugmentedLoader, BatchAugment
+from datafiles.prefetch import PrefetchLoader
 import numpy.random as random
 import numpy as np
 
@@ -202,10 +205,12 @@ def label_skew_by_within_labels(dataset_name, nclient, nlabel=10, alpha=.5):
     
     return client2dataset, te_set
  
-def prepare_data(args):
+def prepare_data(args, device=None):
     train_loaders = []
     test_loaders  = []
     tr_sets, te_set = [],[]
+    if args.dataset in synthetic_names:
+        configure_synthetic(args.synth_size, args.nlabel, args.seed)
         
     if args.skew == 'none':
         tr_sets, te_set = feature_skew_noise(args.dataset, args.nclient, 0)
@@ -227,6 +232,16 @@ def prepare_data(args):
         te_l = dset2loader(te_set,args.batch_size)
         train_loaders.append(tr_l)
         test_loaders.append(te_l)
+
+    # batch augmentation of the training data, one generator per client
+    ops = augment_ops(args.dataset, args.augment)
+    if ops:
+        train_loaders = [AugmentedLoader(tr_l, BatchAugment(ops, args.augment_pad, args.cutout, args.seed * 1000 + client))
+                         for client, tr_l in enumerate(train_loaders)]
+
+    # the next batches prepared (and moved to device) while the current one trains
+    if args.prefetch > 0:
+        train_loaders = [PrefetchLoader(tr_l, args.prefetch, device) for tr_l in train_loaders]
     
 
     return train_loaders, test_loaders
\ No newline at end of file
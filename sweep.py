@@ -0,0 +1,208 @@
+'''
+    Parallel experiment sweep runner
+
+        Expands the grids of a sweep spec (JSON) into runs of the entry
+        points and packs them onto the cores of the machine: every run gets
+        --threads cores of its own (CPU affinity plus OMP/MKL thread
+        counts), so cores // threads runs go at once. With --gpus the runs
+        are spread over the given GPUs through CUDA_VISIBLE_DEVICES.
+
+        A failed run is retried up to --retries times. Every run has a
+        directory under --out_path with its output and, once it succeeded,
+        a done.json: runs that have one are skipped, so a sweep can be
+        killed and started again.
+
+    Spec:
+        {"runs": [{"script": "FedBN_label_weighted.py",
+                   "grid": {"mode": ["fedavg", "fedbn"], "skew": ["none", "quantity"]},
+                   "args": {"iters": 50}}]}
+
+        every combination of the grid values, on top of args. Options are
+        checked against the script's argparse before anything starts.
+
+    How to use:
+        python sweep.py --spec sweep_readme.json --threads 2 --retries 1
+        python sweep.py --spec sweep_readme.json --gpus 0,1 --dry_run
+'''
+
+import argparse
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--spec', type=str, default='sweep_readme.json', help='sweep spec')
+parser.add_argument('--threads', type=int, default=1, help='cores (and torch threads) per run')
+parser.add_argument('--max_runs', type=int, default=0, help='runs at once, 0: as many as the cores allow')
+parser.add_argument('--gpus', type=str, default='', help='comma separated GPU ids to spread the runs over, none hides the GPUs, empty leaves the scripts\' default')
+parser.add_argument('--retries', type=int, default=1, help='retries of a failed run')
+parser.add_argument('--out_path', type=str, default='./sweeps/', help='per run output and done markers')
+parser.add_argument('--dry_run', action='store_true', help='only list the runs')
+args = parser.parse_args()
+
+
+def script_options(script):
+    # the scripts parse their args on import, read the option names from the source instead
+    with open(script) as f:
+        return set(re.findall(r"add_argument\(\s*'--(\w+)'", f.read()))
+
+
+def to_argv(options):
+    argv = []
+    for key, value in options.items():
+        if value is True:
+            argv.append('--{}'.format(key))
+        elif value is not False:
+            argv += ['--{}'.format(key), str(value)]
+    return argv
+
+
+def expand(spec):
+    runs = []
+    for entry in spec['runs']:
+        script = entry['script']
+        known = script_options(script)
+        grid = entry.get('grid', {})
+        keys = list(grid.keys())
+        for key in keys + list(entry.get('args', {}).keys()):
+            if key not in known:
+                raise ValueError("{} HAS NO OPTION --{}".format(script, key))
+        for values in itertools.product(*[grid[key] for key in keys]):
+            options = dict(entry.get('args', {}))
+            options.update(zip(keys, values))
+            name = '{}/{}'.format(os.path.splitext(os.path.basename(script))[0],
+                                  ','.join('{}={}'.format(k, v) for k, v in zip(keys, values)) or 'default')
+            runs.append({'name': name, 'script': script, 'options': options})
+    return runs
+
+
+class Slot():
+    def __init__(self, idx, cores, gpu):
+        self.idx = idx
+        self.cores = cores
+        self.gpu = gpu
+        self.run = None
+        self.proc = None
+        self.out = None
+        self.start = 0.
+
+
+def make_slots():
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    nslot = max(1, len(cores) // args.threads)
+    if args.max_runs > 0:
+        nslot = min(nslot, args.max_runs)
+    gpus = [g for g in args.gpus.split(',') if g] if args.gpus not in ['', 'none'] else []
+    slots = []
+    for i in range(nslot):
+        gpu = None
+        if args.gpus == 'none':
+            gpu = ''
+        elif gpus:
+            gpu = gpus[i % len(gpus)]
+        slots.append(Slot(i, cores[i * args.threads:(i + 1) * args.threads] or cores, gpu))
+    return slots
+
+
+def launch(slot, run):
+    run_dir = os.path.join(args.out_path, run['name'])
+    if not os.path.exists(run_dir):
+        os.makedirs(run_dir)
+    options = dict(run['options'])
+    # every run keeps its checkpoints (and logs, unless the spec says where) apart
+    options.setdefault('log_path', os.path.join(run_dir, 'logs'))
+    options.setdefault('save_path', os.path.join(run_dir, 'checkpoint'))
+    argv = [sys.executable, '-u', run['script']] + to_argv(options)
+
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(args.threads)
+    env['MKL_NUM_THREADS'] = str(args.threads)
+    if slot.gpu is not None:
+        env['CUDA_VISIBLE_DEVICES'] = slot.gpu
+    cores = slot.cores
+
+    def pin():
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+
+    slot.out = open(os.path.join(run_dir, 'stdout.log'), 'a')
+    slot.out.write('=== attempt {} | {}\n'.format(run['attempt'], ' '.join(argv)))
+    slot.out.flush()
+    slot.proc = subprocess.Popen(argv, stdout=slot.out, stderr=subprocess.STDOUT, env=env, preexec_fn=pin)
+    slot.run = run
+    slot.start = time.time()
+    print(' start  | slot {} | cores {} | {}'.format(slot.idx, cores, run['name']))
+
+
+def finish(slot, returncode, queue, results):
+    run = slot.run
+    slot.out.close()
+    elapsed = time.time() - slot.start
+    run_dir = os.path.join(args.out_path, run['name'])
+    if returncode == 0:
+        with open(os.path.join(run_dir, 'done.json'), 'w') as f:
+            json.dump({'script': run['script'], 'options': run['options'], 'attempts': run['attempt'] + 1,
+                       'seconds': elapsed}, f, indent=2)
+        results['done'].append(run['name'])
+        print(' done   | {:.1f}s | {}'.format(elapsed, run['name']))
+    elif run['attempt'] < args.retries:
+        run['attempt'] += 1
+        queue.append(run)
+        print(' retry  | exit {} | {}'.format(returncode, run['name']))
+    else:
+        results['failed'].append(run['name'])
+        print(' failed | exit {} | {}'.format(returncode, run['name']))
+    slot.run = slot.proc = slot.out = None
+
+
+if __name__ == '__main__':
+    with open(args.spec) as f:
+        spec = json.load(f)
+    runs = expand(spec)
+
+    results = {'done': [], 'skipped': [], 'failed': []}
+    queue = []
+    for run in runs:
+        if os.path.exists(os.path.join(args.out_path, run['name'], 'done.json')):
+            results['skipped'].append(run['name'])
+            continue
+        run['attempt'] = 0
+        queue.append(run)
+
+    slots = make_slots()
+    print(' sweep  | {} runs | {} already done | {} slots of {} cores'.format(len(runs), len(results['skipped']), len(slots), args.threads))
+    if args.dry_run:
+        for run in queue:
+            print(' run    | {} {}'.format(run['script'], ' '.join(to_argv(run['options']))))
+        sys.exit(0)
+
+    start = time.time()
+    try:
+        while queue or any(slot.proc for slot in slots):
+            for slot in slots:
+                if slot.proc is not None:
+                    returncode = slot.proc.poll()
+                    if returncode is None:
+                        continue
+                    finish(slot, returncode, queue, results)
+                if queue:
+                    launch(slot, queue.pop(0))
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        for slot in slots:
+            if slot.proc is not None:
+                slot.proc.terminate()
+        raise
+
+    results['seconds'] = time.time() - start
+    if not os.path.exists(args.out_path):
+        os.makedirs(args.out_path)
+    with open(os.path.join(args.out_path, 'sweep_summary.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+    print(' sweep  | done {} | skipped {} | failed {} | {:.1f}s'.format(
+        len(results['done']), len(results['skipped']), len(results['failed']), results['seconds']))
+    sys.exit(1 if results['failed'] else 0)
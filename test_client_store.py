@@ -0,0 +1,76 @@
+'''
+Tests for client_store.py
+
+    python -m pytest -q test_client_store.py
+'''
+
+import os
+
+import torch
+
+from client_store import ClientStateStore
+
+
+def make_state(seed):
+    g = torch.Generator().manual_seed(seed)
+    return {'conv.weight': torch.randn(4, 3, 3, 3, generator=g),
+            'bn.running_mean': torch.randn(4, generator=g),
+            'bn.num_batches_tracked': torch.tensor(seed, dtype=torch.long), # 0-d
+            'fc.index': torch.randint(0, 100, (5,), generator=g, dtype=torch.int32)}
+
+
+def assert_same(state, expected):
+    assert state.keys() == expected.keys()
+    for name, t in expected.items():
+        assert state[name].dtype == t.dtype, name
+        assert state[name].shape == t.shape, name
+        assert torch.equal(state[name], t), name
+
+
+def test_spill_round_trip(tmp_path):
+    store = ClientStateStore(capacity=2, spill_dir=str(tmp_path))
+    states = {client: make_state(client) for client in range(4)}
+    for client, state in states.items():
+        store.put(client, state)
+    assert store.stats()['on_disk'] == 2
+
+    for client in range(4):
+        assert_same(store.get(client), states[client])
+    assert store.stats()['misses'] >= 2
+
+    # prefetched and loaded back in the background
+    store.put(4, make_state(4))
+    store.put(5, make_state(5))
+    store.prefetch(0)
+    assert_same(store.get(0), states[0])
+    store.close()
+
+
+def test_clear_removes_spill_files(tmp_path):
+    store = ClientStateStore(capacity=1, spill_dir=str(tmp_path))
+    for client in range(4):
+        store.put(client, make_state(client))
+    # loaded back, and spilled then replaced: their files must go too
+    store.get(0)
+    store.put(1, make_state(10))
+    assert len(os.listdir(str(tmp_path))) > 0
+
+    store.clear()
+    assert os.listdir(str(tmp_path)) == []
+    assert len(store) == 0
+    store.close()
+
+
+def test_snapshot_of_spilled_states(tmp_path):
+    store = ClientStateStore(capacity=1, spill_dir=str(tmp_path))
+    states = {client: make_state(client) for client in range(3)}
+    for client, state in states.items():
+        store.put(client, state)
+    snapshot = store.snapshot()
+    # spilling client 1 again replaces its file, the snapshot keeps what it mapped
+    store.get(1)
+    store.put(1, make_state(11))
+    store.put(2, make_state(12))
+    for client in range(3):
+        assert_same(snapshot[client], states[client])
+    store.close()
@@ -0,0 +1,145 @@
+'''
+    Chrome trace timeline of client and server activity
+
+        Records spans (name, start, end, client, round, process, thread)
+        and writes them as Chrome Trace Event JSON, which Perfetto
+        (ui.perfetto.dev) and chrome://tracing open. Every client is a
+        track of its own ('client 3'), the rest goes to the 'server' track,
+        and every round is a 'round r' span on the server track, so the
+        timeline lines up with the rounds of the text log. The process and
+        thread that ran a span are in its args.
+
+        Which client a span belongs to is a per-thread setting: code run
+        inside `with timeline.client(c):` lands on the track of client c.
+
+        Spans are timed with the wall clock of the run unless given
+        explicitly (add_span), e.g. in seconds of a virtual clock.
+
+    How to use:
+        timeline = Timeline()
+        with timeline.client(3):
+            with timeline.span('forward', round=r):
+                ...
+        timeline.add_span('train', start=12.5, end=14.0, client=3)    # seconds
+        timeline.add_span('aggregate', start=14.0, end=14.1, client=SERVER)
+        timeline.save(os.path.splitext(logfile.name)[0] + '.trace.json')
+
+        The profiler records its phases here when it is given a timeline,
+        see profiler.py.
+'''
+
+import json
+import os
+import threading
+import time
+
+SERVER = -1 # client id of the server, as in runlog
+SERVER_TRACK = 0
+
+
+class Span():
+    __slots__ = ('timeline', 'name', 'client', 'args', 'start')
+
+    def __init__(self, timeline, name, client, args):
+        self.timeline = timeline
+        self.name = name
+        self.client = client
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timeline.complete(self.name, self.start, time.perf_counter(), self.client, **self.args)
+        return False
+
+
+class ClientScope():
+    def __init__(self, timeline, client_idx, args):
+        self.timeline = timeline
+        self.client_idx = client_idx
+        self.args = args
+
+    def __enter__(self):
+        local = self.timeline.local
+        self.previous = getattr(local, 'client', None)
+        local.client = self.client_idx
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timeline.complete('client {}'.format(self.client_idx), self.start, time.perf_counter(),
+                               self.client_idx, cat='client', **self.args)
+        self.timeline.local.client = self.previous
+        return False
+
+
+class Timeline():
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.round = None # stamped on every span
+
+    def current_client(self):
+        return getattr(self.local, 'client', None)
+
+    def client(self, client_idx, **args):
+        return ClientScope(self, client_idx, args)
+
+    def span(self, name, client=None, **args):
+        return Span(self, name, client, args)
+
+    def complete(self, name, start, end, client=None, cat='phase', **args):
+        '''
+            a span from start to end (time.perf_counter() values)
+        '''
+        self.add_span(name, start - self.t0, end - self.t0, client, cat, **args)
+
+    def add_span(self, name, start, end, client=None, cat='phase', **args):
+        '''
+            a span from start to end in seconds since the start of the timeline
+        '''
+        if client is None:
+            client = self.current_client()
+        thread = threading.current_thread()
+        event_args = {'round': self.round, 'pid': os.getpid(), 'thread': thread.name}
+        event_args.update(args)
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': start * 1e6,
+            'dur': max(end - start, 0.) * 1e6,
+            'pid': self.pid,
+            'tid': SERVER_TRACK if client is None or client == SERVER else client + 1,
+            'args': event_args,
+        }
+        with self.lock:
+            self.events.append(event)
+            if client is not None and client != SERVER:
+                self.clients.add(client)
+
+    def metadata(self):
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'tid': SERVER_TRACK, 'args': {'name': 'federated run'}},
+                  {'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': SERVER_TRACK, 'args': {'name': 'server'}},
+                  {'name': 'thread_sort_index', 'ph': 'M', 'pid': self.pid, 'tid': SERVER_TRACK, 'args': {'sort_index': 0}}]
+        for client_idx in sorted(self.clients):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': client_idx + 1,
+                           'args': {'name': 'client {}'.format(client_idx)}})
+            events.append({'name': 'thread_sort_index', 'ph': 'M', 'pid': self.pid, 'tid': client_idx + 1,
+                           'args': {'sort_index': client_idx + 1}})
+        return events
+
+    def save(self, path):
+        with self.lock:
+            events = self.metadata() + sorted(self.events, key=lambda e: (e['ts'], -e['dur']))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        os.replace(tmp_path, path)
+        return len(events)
@@ -1,4 +1,5 @@
 import torch
+from profiler import phase, count
 
 def train(model, train_loader, optimizer, loss_fun, client_num, device):
     model.train()
@@ -8,17 +9,23 @@ def train(model, train_loader, optimizer, loss_fun, client_num, device):
     train_iter = iter(train_loader)
     for step in range(len(train_iter)):
         optimizer.zero_grad()
-        x, y = next(train_iter)
-       
-        num_data += y.size(0)
-        x = x.to(device).float()
-        y = y.to(device).long()
-        output = model(x)
-
-        loss = loss_fun(output, y)
-        loss.backward()
+        with phase('data'):
+            x, y = next(train_iter)
+
+            num_data += y.size(0)
+            x = x.to(device).float()
+            y = y.to(device).long()
+        with phase('forward'):
+            output = model(x)
+
+            loss = loss_fun(output, y)
+        with phase('backward'):
+            loss.backward()
         loss_all += loss.item()
-        optimizer.step()
+        with phase('step'):
+            optimizer.step()
+        count('batches')
+        count('samples', y.size(0))
 
         pred = output.data.max(1)[1]
         correct += pred.eq(y.view(-1)).sum().item()
@@ -33,23 +40,34 @@ def train_LW(model, train_loader, optimizer, loss_fun, client_num, device,args):
     train_iter = iter(train_loader)
     for step in range(len(train_iter)):
         optimizer.zero_grad()
-        x, y = next(train_iter)
-        labels = torch.add(labels,torch.sum(y,dim=0))
-        num_data += y.size(0)
-        x = x.to(device).float()
-        y = y.to(device).long()
-        output = model(x)
-
-        loss = loss_fun(output, y)
-        loss.backward()
+        with phase('data'):
+            x, y = next(train_iter)
+            labels = torch.add(labels,torch.sum(y,dim=0))
+            num_data += y.size(0)
+            x = x.to(device).float()
+            y = y.to(device).long()
+        with phase('forward'):
+            output = model(x)
+
+            loss = loss_fun(output, y)
+        with phase('backward'):
+            loss.backward()
         loss_all += loss.item()
-        optimizer.step()
+        with phase('step'):
+            optimizer.step()
+        count('batches')
+        count('samples', y.size(0))
 
         pred = output.data.max(1)[1]
         correct += pred.eq(y.view(-1)).sum().item()
     
     return loss_all/len(train_iter), correct/num_data, labels
 
+def count_labels(train_loader, args):
+    # the labels train_LW counts over an epoch, from the dataset: the loaders keep every sample
+    labels = torch.tensor([0 for i in range(args.nlabel)])
+    return torch.add(labels, torch.sum(torch.as_tensor(train_loader.dataset.y), dim=0))
+
 def train_fedprox(args, model, server_model, train_loader, optimizer, loss_fun, client_num, device):
     model.train()
     num_data = 0
@@ -59,27 +77,34 @@ def train_fedprox(args, model, server_model, train_loader, optimizer, loss_fun,
 
     for step in range(len(train_iter)):
         optimizer.zero_grad()
-        x, y = next(train_iter)
+        with phase('data'):
+            x, y = next(train_iter)
 
-        num_data += y.size(0)
-        x = x.to(device).float()
-        y = y.to(device).long()
-        output = model(x)
+            num_data += y.size(0)
+            x = x.to(device).float()
+            y = y.to(device).long()
+        with phase('forward'):
+            output = model(x)
 
-        loss = loss_fun(output, y)
+            loss = loss_fun(output, y)
 
         #########################we implement FedProx Here###########################
         # referring to https://github.com/IBM/FedMA/blob/4b586a5a22002dc955d025b890bc632daa3c01c7/main.py#L819
         if step>0:
-            w_diff = torch.tensor(0., device=device)
-            for w, w_t in zip(server_model.parameters(), model.parameters()):
-                w_diff += torch.pow(torch.norm(w - w_t), 2)
-            loss += args.mu / 2. * w_diff
+            with phase('prox'):
+                w_diff = torch.tensor(0., device=device)
+                for w, w_t in zip(server_model.parameters(), model.parameters()):
+                    w_diff += torch.pow(torch.norm(w - w_t), 2)
+                loss += args.mu / 2. * w_diff
         #############################################################################
 
-        loss.backward()
+        with phase('backward'):
+            loss.backward()
         loss_all += loss.item()
-        optimizer.step()
+        with phase('step'):
+            optimizer.step()
+        count('batches')
+        count('samples', y.size(0))
 
         pred = output.data.max(1)[1]
         correct += pred.eq(y.view(-1)).sum().item()
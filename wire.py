@@ -0,0 +1,232 @@
+'''
+    Zero-copy wire format for client updates
+
+        | b'FLUP' | header length (u64, little endian) | header | padding | payload |
+
+        header:  JSON {"entries": [[name, dtype, shape, offset, nbytes], ...], "nbytes": payload size}
+        payload: every tensor back to back, offsets aligned to 64 bytes, the
+                 payload itself starts 64-byte aligned too
+
+    A FlatState keeps a whole state in one uint8 buffer, every tensor of it
+    is a view into that buffer. flatten_module() rebinds the parameters and
+    the buffers of a module to views of two such states: from then on the
+    module's state goes on the wire as (header, payload) pairs without a
+    per-tensor copy. Decoding gives views of the received bytes
+    (torch.frombuffer), again no copies.
+
+    The buffers get a storage of their own: views of one storage share one
+    autograd version counter, and a BatchNorm forward in train mode updates
+    its running stats in place, which would invalidate the weights saved
+    for backward.
+
+    How to use:
+        params, buffers = flatten_module(model) # once, before the optimizer is built
+        ...
+        header, payload = params.to_buffers()   # sock.sendall(header); sock.sendall(payload)
+        flat = decode_update(header + payload)  # or recv_update(sock)
+        flat['conv1.weight']                    # a view, FlatState works like a state dict
+
+        flat = FlatState.from_state(state)      # any state dict, one copy per tensor
+
+    FlatState pickles through its wire format, so it also crosses process
+    pools. Tensors decoded from a read-only buffer (bytes) must not be
+    written to.
+'''
+
+import json
+import pickle
+import struct
+import warnings
+
+import torch
+
+MAGIC = b'FLUP'
+ALIGN = 64
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _dtype(name):
+    # 'torch.float32' -> torch.float32
+    return getattr(torch, name.split('.')[-1])
+
+
+class FlatState():
+    def __init__(self, entries, buffer):
+        self.entries = entries # [(name, dtype, shape, offset, nbytes)]
+        self.buffer = buffer # flat uint8 tensor
+        self.views = {}
+        for name, dtype, shape, offset, nbytes in entries:
+            if nbytes == 0:
+                self.views[name] = torch.empty(shape, dtype=dtype, device=buffer.device)
+            else:
+                self.views[name] = buffer[offset:offset + nbytes].view(dtype).view(shape)
+
+    @staticmethod
+    def layout(state):
+        entries = []
+        offset = 0
+        for name, t in state.items():
+            nbytes = t.nelement() * t.element_size()
+            entries.append((name, t.dtype, tuple(t.shape), offset, nbytes))
+            offset = _align(offset + nbytes)
+        return entries, offset
+
+    @classmethod
+    def empty_like(cls, state, device=None):
+        entries, nbytes = cls.layout(state)
+        if device is None:
+            device = next(iter(state.values())).device if len(state) else 'cpu'
+        # zeroed, so the alignment padding is defined when the buffer is reduced as a whole
+        return cls(entries, torch.zeros(nbytes, dtype=torch.uint8, device=device))
+
+    @classmethod
+    def from_state(cls, state, device=None):
+        flat = cls.empty_like(state, device)
+        for name, t in state.items():
+            flat.views[name].copy_(t.detach())
+        return flat
+
+    def __getitem__(self, name):
+        return self.views[name]
+
+    def __contains__(self, name):
+        return name in self.views
+
+    def __iter__(self):
+        return iter(self.views)
+
+    def __len__(self):
+        return len(self.views)
+
+    def keys(self):
+        return self.views.keys()
+
+    def values(self):
+        return self.views.values()
+
+    def items(self):
+        return self.views.items()
+
+    def span(self, keys, dtype=torch.float32):
+        '''
+            One tensor of dtype over the bytes of keys, which must be laid out
+            back to back (see flatten_module) and all be of dtype
+        '''
+        entries = [entry for entry in self.entries if entry[0] in keys]
+        assert(len(entries) == len(keys))
+        assert(all(entry[1] == dtype for entry in entries))
+        start = min(entry[3] for entry in entries)
+        end = max(entry[3] + entry[4] for entry in entries)
+        assert(end - start <= sum(_align(entry[4]) for entry in entries))
+        return self.buffer[start:end].view(dtype)
+
+    def header(self):
+        header = json.dumps({
+            'entries': [[name, str(dtype), list(shape), offset, nbytes] for name, dtype, shape, offset, nbytes in self.entries],
+            'nbytes': self.buffer.numel(),
+        }).encode('utf-8')
+        prefix = MAGIC + struct.pack('<Q', len(header)) + header
+        return prefix + b'\0' * (_align(len(prefix)) - len(prefix))
+
+    def to_buffers(self):
+        '''
+            (header bytes, payload memoryview), the payload is the flat
+            buffer itself (copied once if it lives on the GPU)
+        '''
+        return self.header(), memoryview(self.buffer.cpu().numpy())
+
+    def tobytes(self):
+        header, payload = self.to_buffers()
+        return header + payload.tobytes()
+
+    def __reduce_ex__(self, protocol):
+        header, payload = self.to_buffers()
+        if protocol >= 5:
+            return decode_update, (header, pickle.PickleBuffer(payload))
+        return decode_update, (header, payload.tobytes())
+
+
+def flatten_module(model, first=None):
+    '''
+        Move the parameters of model into one FlatState and its buffers into
+        another, and make them views of these. Build optimizers after this
+        call. Returns (params, buffers).
+
+        The keys in first are laid out before the rest, params.span(keys) and
+        buffers.span(keys) of keys in first are then contiguous slices.
+    '''
+    state = model.state_dict()
+    if first is not None:
+        state = dict([(key, state[key]) for key in first] + [(key, t) for key, t in state.items() if key not in first])
+    param_names = set(name for name, _ in model.named_parameters())
+    params = FlatState.from_state({key: t for key, t in state.items() if key in param_names})
+    buffers = FlatState.from_state({key: t for key, t in state.items() if key not in param_names})
+    for module_name, module in model.named_modules():
+        prefix = module_name + '.' if module_name else ''
+        for name, param in module._parameters.items():
+            if param is not None and prefix + name in params:
+                param.data = params[prefix + name]
+        for name, buf in module._buffers.items():
+            if buf is not None and prefix + name in buffers:
+                module._buffers[name] = buffers[prefix + name]
+    return params, buffers
+
+
+def _parse_header(data):
+    view = memoryview(data)
+    if bytes(view[:4]) != MAGIC:
+        raise ValueError("NOT A WIRE UPDATE")
+    header_len = struct.unpack('<Q', bytes(view[4:12]))[0]
+    header = json.loads(bytes(view[12:12 + header_len]).decode('utf-8'))
+    entries = [(name, _dtype(dtype), tuple(shape), offset, nbytes) for name, dtype, shape, offset, nbytes in header['entries']]
+    return entries, header['nbytes'], _align(12 + header_len)
+
+
+def decode_update(data, payload=None):
+    '''
+        FlatState of a wire update, its tensors are views of the given
+        buffer(s). Takes either the whole update, or header and payload apart.
+    '''
+    entries, nbytes, payload_start = _parse_header(data)
+    if payload is None:
+        payload, offset = data, payload_start
+    else:
+        offset = 0
+    with warnings.catch_warnings():
+        # read-only buffers (bytes) are fine as long as nobody writes to the views
+        warnings.simplefilter('ignore', UserWarning)
+        if nbytes == 0:
+            buffer = torch.empty(0, dtype=torch.uint8)
+        else:
+            buffer = torch.frombuffer(payload, dtype=torch.uint8, count=nbytes, offset=offset)
+    return FlatState(entries, buffer)
+
+
+def _recv_exact(sock, nbytes):
+    buf = bytearray(nbytes)
+    view = memoryview(buf)
+    got = 0
+    while got < nbytes:
+        n = sock.recv_into(view[got:], nbytes - got)
+        if n == 0:
+            raise ConnectionError("SOCKET CLOSED")
+        got += n
+    return buf
+
+
+def send_update(sock, flat):
+    header, payload = flat.to_buffers()
+    sock.sendall(header)
+    sock.sendall(payload)
+
+
+def recv_update(sock):
+    prefix = _recv_exact(sock, 12)
+    header_len = struct.unpack('<Q', bytes(prefix[4:12]))[0]
+    rest = _recv_exact(sock, _align(12 + header_len) - 12)
+    header = bytes(prefix) + bytes(rest)
+    entries, nbytes, _ = _parse_header(header)
+    return decode_update(header, _recv_exact(sock, nbytes))